@@ -0,0 +1,92 @@
+# So sánh thời gian khởi động nguội (cold start) khi có / không có template biên dịch sẵn.
+#   python benchmarks/cold_start.py [--runs 5] [--json]
+# Mỗi lần đo chạy một tiến trình Python mới: import main rồi gửi request đầu tiên tới từng
+# trang (lần render đầu phải nạp/biên dịch template). Database và template biên dịch sẵn
+# nằm trong thư mục tạm.
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PAGES = ["/login", "/dashboard", "/products", "/reports", "/profile", "/admin/approve-products", "/admin/users"]
+
+def child():
+    # Chạy trong tiến trình con: in kết quả đo dạng JSON
+    started = time.perf_counter()
+    sys.path.insert(0, ROOT)
+    os.chdir(ROOT)
+    import main
+    from fastapi.testclient import TestClient
+    imported = time.perf_counter()
+    client = TestClient(main.app, follow_redirects=False)
+    timings = {}
+    for page in PAGES:
+        page_started = time.perf_counter()
+        response = client.get(page)
+        timings[page] = (time.perf_counter() - page_started) * 1000
+        if page == "/login":
+            client.post("/login", data={"email": "admin@warehouse.com", "password": "admin123"})
+        elif response.status_code != 200:
+            raise SystemExit(f"{page} trả về {response.status_code}")
+    print(json.dumps({
+        "import_ms": (imported - started) * 1000,
+        "pages_ms": timings,
+        "first_render_total_ms": sum(timings.values()),
+        "precompiled": len(main.PRECOMPILED_TEMPLATES),
+    }))
+
+def run_child(env):
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--child"], env=env, cwd=ROOT,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def summarize(runs):
+    return {
+        "import_ms": round(statistics.median(run["import_ms"] for run in runs), 1),
+        "first_render_total_ms": round(statistics.median(run["first_render_total_ms"] for run in runs), 1),
+        "pages_ms": {page: round(statistics.median(run["pages_ms"][page] for run in runs), 1) for page in PAGES},
+        "precompiled": runs[0]["precompiled"],
+    }
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description="Benchmark cold start với template biên dịch sẵn")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--json", action="store_true", help="In kết quả dạng JSON")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child()
+        return
+    
+    workdir = tempfile.mkdtemp(prefix="bench-cold-start-")
+    env = dict(os.environ, VERCEL="1", TMPDIR=workdir, SECRET_KEY="benchmark",
+               MEDIA_DIR=os.path.join(workdir, "media"),
+               TEMPLATES_COMPILED_DIR=os.path.join(workdir, "templates_compiled"))
+    subprocess.run([sys.executable, "main.py", "precompile-templates"], env=env, cwd=ROOT,
+                   check=True, capture_output=True)
+    # Lần chạy đầu tạo database và dữ liệu mẫu, không tính
+    run_child(env)
+    
+    results = {}
+    for mode, flag in (("compile_on_demand", "0"), ("precompiled", "1")):
+        results[mode] = summarize([run_child(dict(env, TEMPLATES_PRECOMPILED=flag)) for _ in range(args.runs)])
+    
+    if args.json:
+        print(json.dumps({"runs": args.runs, "results": results}, indent=2))
+        return
+    print(f"Trung vị của {args.runs} lần chạy (ms)")
+    print(f"{'':<28} {'biên dịch khi render':>20} {'biên dịch sẵn':>15}")
+    rows = [("import main", "import_ms"), ("tổng request đầu", "first_render_total_ms")]
+    for label, key in rows:
+        print(f"{label:<28} {results['compile_on_demand'][key]:>20} {results['precompiled'][key]:>15}")
+    for page in PAGES:
+        print(f"  {page:<26} {results['compile_on_demand']['pages_ms'][page]:>20} {results['precompiled']['pages_ms'][page]:>15}")
+    print(f"(template nạp từ bản biên dịch sẵn: {results['precompiled']['precompiled']})")
+
+if __name__ == "__main__":
+    main_benchmark()
@@ -0,0 +1,109 @@
+# Đo dung lượng truyền đi và chi phí CPU khi nén response theo từng route / thuật toán / mức nén.
+#   python benchmarks/compression.py [--products 2000] [--repeat 5] [--json]
+# Chạy trên database tạm (SQLite) với dữ liệu sinh ngẫu nhiên, không đụng tới data/database.db.
+import argparse
+import csv
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROUTES = [
+    "/products?page_size=200",
+    "/dashboard",
+    "/reports",
+    "/reports?type=products",
+    "/api/stats/series?bucket=day",
+    "/export/transactions.csv",
+]
+LEVELS = {
+    "gzip": (1, 6, 9),
+    "br": (1, 4, 6, 11),
+    "zstd": (1, 3, 9, 19),
+}
+
+def setup_app(workdir):
+    # Database và thư mục ảnh nằm trong thư mục tạm; phải đặt trước khi import main
+    os.environ["VERCEL"] = "1"
+    os.environ.setdefault("SECRET_KEY", "benchmark")
+    os.environ["MEDIA_DIR"] = os.path.join(workdir, "media")
+    tempfile.tempdir = workdir
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, root)
+    os.chdir(root)
+    import main
+    return main
+
+def seed(client, products):
+    rng = random.Random(42)
+    categories = ["Điện tử", "Phụ kiện", "Văn phòng phẩm", "Gia dụng", "Thực phẩm"]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(["name", "category", "sku", "stock", "min_stock", "price", "supplier", "location", "description"])
+    for i in range(products):
+        writer.writerow([f"Sản phẩm mẫu {i}", rng.choice(categories), f"BENCH-{i:06d}", rng.randint(0, 500),
+                         rng.randint(1, 20), rng.randint(10, 5000) * 1000, f"Nhà cung cấp {i % 37}",
+                         f"Kệ {chr(65 + i % 8)}{i % 20}", "Mô tả sản phẩm dùng cho benchmark " * 3])
+    response = client.post("/products/import", files={"file": ("bench.csv", buffer.getvalue().encode("utf-8"), "text/csv")})
+    response.raise_for_status()
+    movements = [{"sku": f"BENCH-{rng.randrange(products):06d}", "type": "in", "quantity": rng.randint(1, 20)}
+                 for _ in range(min(products, 1000))]
+    client.post("/api/stock-movements", json={"movements": movements}).raise_for_status()
+
+def measure(main, body, encoding, level, repeat):
+    cpu = 0.0
+    size = 0
+    for _ in range(repeat):
+        started = time.process_time()
+        compressor = main.StreamCompressor(encoding, level)
+        size = len(compressor.finish(body))
+        cpu += time.process_time() - started
+    return size, cpu / repeat * 1000
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description="Benchmark nén response")
+    parser.add_argument("--products", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", action="store_true", help="In kết quả dạng JSON")
+    args = parser.parse_args()
+    
+    main = setup_app(tempfile.mkdtemp(prefix="bench-compression-"))
+    from fastapi.testclient import TestClient
+    client = TestClient(main.app, follow_redirects=False)
+    client.post("/login", data={"email": "admin@warehouse.com", "password": "admin123"})
+    seed(client, args.products)
+    
+    results = []
+    for route in ROUTES:
+        started = time.perf_counter()
+        response = client.get(route, headers={"Accept-Encoding": "identity"})
+        render_ms = (time.perf_counter() - started) * 1000
+        body = response.content
+        row = {"route": route, "status": response.status_code, "bytes": len(body),
+               "render_ms": round(render_ms, 2), "encodings": []}
+        for encoding in main.available_encodings():
+            for level in LEVELS[encoding]:
+                size, cpu_ms = measure(main, body, encoding, level, args.repeat)
+                row["encodings"].append({
+                    "encoding": encoding, "level": level, "bytes": size,
+                    "ratio": round(size / len(body), 4) if body else 0, "cpu_ms": round(cpu_ms, 3),
+                    "default": main.COMPRESSION_LEVELS[encoding] == level,
+                })
+        results.append(row)
+    
+    if args.json:
+        print(json.dumps({"products": args.products, "routes": results}, ensure_ascii=False, indent=2))
+        return
+    for row in results:
+        print(f"\n{row['route']}  ({row['status']}, {row['bytes']:,} byte, render {row['render_ms']} ms)")
+        print(f"  {'encoding':<8} {'level':>5} {'byte':>12} {'tỉ lệ':>7} {'CPU ms':>8}")
+        for item in row["encodings"]:
+            mark = " *" if item["default"] else ""
+            print(f"  {item['encoding']:<8} {item['level']:>5} {item['bytes']:>12,} {item['ratio']:>7.1%} {item['cpu_ms']:>8.3f}{mark}")
+    print("\n* = mức nén đang dùng (ZSTD_LEVEL / BROTLI_QUALITY / GZIP_LEVEL)")
+
+if __name__ == "__main__":
+    main_benchmark()
@@ -0,0 +1,189 @@
+# Sinh dữ liệu giả lập với khối lượng thực tế để đo hiệu năng (mặc định 100k sản phẩm,
+# 10 triệu giao dịch, 300 nhân viên tên tiếng Việt).
+#   python benchmarks/generate_data.py [--database data/benchmark.db] [--products 100000]
+#          [--transactions 10000000] [--staff 300] [--days 365] [--seed 42]
+# Đặt DATABASE_URL để sinh vào PostgreSQL thay vì SQLite. Sau khi sinh, bộ đếm dashboard,
+# transactions_daily và chỉ mục tìm kiếm được dựng lại như dữ liệu thật.
+import argparse
+import csv
+import io
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CHUNK_SIZE = 50000
+SKU_PREFIX = "GEN-"
+
+FAMILY_NAMES = ["Nguyễn", "Trần", "Lê", "Phạm", "Hoàng", "Huỳnh", "Phan", "Vũ", "Võ", "Đặng",
+                "Bùi", "Đỗ", "Hồ", "Ngô", "Dương", "Lý"]
+MIDDLE_NAMES = ["Văn", "Thị", "Minh", "Thu", "Ngọc", "Quốc", "Thanh", "Hữu", "Đức", "Gia", "Hoài", "Bảo"]
+GIVEN_NAMES = ["An", "Bình", "Chi", "Dũng", "Giang", "Hà", "Hải", "Hạnh", "Hiếu", "Hoa", "Hùng", "Hương",
+               "Khánh", "Lan", "Linh", "Long", "Mai", "Nam", "Nga", "Ngân", "Phong", "Phúc", "Quân",
+               "Quang", "Sơn", "Tâm", "Thảo", "Trang", "Trung", "Tuấn", "Vy", "Yến"]
+CITIES = ["Hà Nội", "TP.HCM", "Đà Nẵng", "Hải Phòng", "Cần Thơ", "Bắc Ninh", "Bình Dương"]
+CATEGORIES = {
+    "Điện tử": ["Laptop", "Màn hình", "Tai nghe", "Loa bluetooth", "Ổ cứng SSD", "Bàn phím cơ", "Chuột không dây"],
+    "Gia dụng": ["Nồi cơm điện", "Ấm siêu tốc", "Quạt đứng", "Máy xay sinh tố", "Bàn là hơi nước", "Nồi chiên không dầu"],
+    "Văn phòng phẩm": ["Bút bi", "Giấy A4", "Sổ tay", "Kẹp tài liệu", "Bìa hồ sơ", "Máy tính bỏ túi"],
+    "Thực phẩm": ["Gạo ST25", "Cà phê rang xay", "Nước mắm", "Trà Thái Nguyên", "Bánh đa nem", "Mật ong rừng"],
+    "Thời trang": ["Áo sơ mi", "Quần jean", "Áo khoác gió", "Giày thể thao", "Nón lá", "Túi xách"],
+    "Mỹ phẩm": ["Sữa rửa mặt", "Kem chống nắng", "Son môi", "Dầu gội thảo dược", "Nước hoa hồng"],
+    "Vật liệu xây dựng": ["Xi măng", "Gạch men", "Sơn nước", "Ống nhựa PVC", "Dây điện"],
+}
+VARIANTS = ["Tiêu chuẩn", "Cao cấp", "Mini", "Pro", "Plus", "Loại 1", "Gói tiết kiệm", "Phiên bản 2024"]
+SUPPLIERS = ["Công ty TNHH Minh Phát", "Công ty CP Hòa Bình", "Tổng kho Sài Gòn", "Công ty TNHH Thành Công",
+             "Nhà phân phối Hưng Thịnh", "Công ty CP Việt Tiến", "Công ty TNHH An Khang", "Đại lý Phú Quý"]
+COUNTRIES = ["Việt Nam"] * 5 + ["Trung Quốc", "Nhật Bản", "Hàn Quốc", "Thái Lan", "Đức", "Mỹ"]
+NOTES = {
+    "in": ["Nhập hàng từ nhà cung cấp", "Nhập bổ sung cuối tháng", "Khách trả hàng", "Chuyển kho đến"],
+    "out": ["Xuất bán lẻ", "Xuất cho đại lý", "Xuất chuyển kho", "Hàng lỗi, hủy", "Kiểm kê điều chỉnh"],
+}
+
+def import_main(database):
+    # SQLite: database nằm ở đường dẫn chỉ định thay vì data/database.db
+    sys.path.insert(0, ROOT)
+    os.chdir(ROOT)
+    import main
+    if not main.IS_POSTGRES:
+        os.makedirs(os.path.dirname(os.path.abspath(database)), exist_ok=True)
+        main.DB_PATH = database
+    return main
+
+def insert_rows(main, conn, table, columns, rows):
+    # Postgres: COPY nhanh hơn nhiều so với INSERT từng dòng; SQLite: executemany
+    if main.IS_POSTGRES:
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        buffer.seek(0)
+        conn.conn.cursor().copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH CSV", buffer)
+    else:
+        placeholders = ", ".join("?" for _ in columns)
+        conn.conn.executemany(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})", rows)
+    conn.commit()
+
+def random_time(rng, now, days):
+    return (now - timedelta(seconds=rng.randrange(days * 86400))).strftime('%Y-%m-%d %H:%M:%S')
+
+def generate_staff(main, conn, rng, count, now, days):
+    rows = []
+    for i in range(count):
+        name = f"{rng.choice(FAMILY_NAMES)} {rng.choice(MIDDLE_NAMES)} {rng.choice(GIVEN_NAMES)}"
+        email = ".".join(main.search_terms(name)) + f".{i}@warehouse.com"
+        rows.append((email, main.hash_password("staff123"), name, "staff", f"09{rng.randrange(10 ** 8):08d}",
+                     rng.choice(CITIES), random_time(rng, now, days)))
+    insert_rows(main, conn, "users", ("email", "password", "full_name", "role", "phone", "address", "created_at"), rows)
+    cursor = conn.cursor()
+    cursor.execute("SELECT id FROM users WHERE role = 'staff'")
+    return [row[0] for row in cursor.fetchall()]
+
+def generate_products(main, conn, rng, count, staff_ids, admin_id, now, days):
+    columns = ("name", "category", "sku", "stock", "min_stock", "price", "supplier", "supplier_country",
+               "manufacturer", "distributor", "location", "description", "status", "added_by", "approved_by",
+               "last_updated")
+    categories = list(CATEGORIES)
+    rows = []
+    for i in range(count):
+        category = rng.choice(categories)
+        noun = rng.choice(CATEGORIES[category])
+        supplier = rng.choice(SUPPLIERS)
+        status = rng.choices(("approved", "pending", "rejected"), (90, 7, 3))[0]
+        rows.append((
+            f"{noun} {rng.choice(VARIANTS)} {i}", category, f"{SKU_PREFIX}{i:07d}", rng.randint(0, 2000),
+            rng.randint(5, 50), rng.randint(5, 50000) * 1000, supplier, rng.choice(COUNTRIES),
+            f"Nhà máy {rng.choice(CITIES)}", rng.choice(SUPPLIERS),
+            f"Kho {rng.choice(CITIES)} - Kệ {chr(65 + rng.randrange(12))}{rng.randrange(1, 40)}",
+            f"{noun} nhập từ {supplier}, bảo hành {rng.choice((6, 12, 24))} tháng",
+            status, rng.choice(staff_ids), admin_id if status != "pending" else None, random_time(rng, now, days),
+        ))
+        if len(rows) >= CHUNK_SIZE:
+            insert_rows(main, conn, "products", columns, rows)
+            rows = []
+    if rows:
+        insert_rows(main, conn, "products", columns, rows)
+
+def generate_transactions(main, conn, rng, count, products, staff_ids, now, days):
+    columns = ("product_id", "type", "quantity", "user_id", "notes", "created_at")
+    rows = []
+    started = time.perf_counter()
+    for i in range(count):
+        product_id, added_by = rng.choice(products)
+        type = "in" if rng.random() < 0.45 else "out"
+        # Phần lớn giao dịch do chính người thêm sản phẩm thực hiện
+        user_id = added_by if rng.random() < 0.7 else rng.choice(staff_ids)
+        rows.append((product_id, type, rng.randint(1, 100), user_id, rng.choice(NOTES[type]), random_time(rng, now, days)))
+        if len(rows) >= CHUNK_SIZE:
+            insert_rows(main, conn, "transactions", columns, rows)
+            rows = []
+            if (i + 1) % (CHUNK_SIZE * 20) == 0:
+                rate = (i + 1) / (time.perf_counter() - started)
+                print(f"   {i + 1:,}/{count:,} giao dịch ({rate:,.0f} dòng/giây)")
+    if rows:
+        insert_rows(main, conn, "transactions", columns, rows)
+
+def main_generate():
+    parser = argparse.ArgumentParser(description="Sinh dữ liệu giả lập cho benchmark")
+    parser.add_argument("--database", default=os.path.join(ROOT, "data", "benchmark.db"),
+                        help="File SQLite (bỏ qua khi có DATABASE_URL)")
+    parser.add_argument("--products", type=int, default=100000)
+    parser.add_argument("--transactions", type=int, default=10000000)
+    parser.add_argument("--staff", type=int, default=300)
+    parser.add_argument("--days", type=int, default=365, help="Giao dịch rải đều trong bấy nhiêu ngày gần nhất")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    main = import_main(os.path.abspath(args.database))
+    main.prepare_database()
+    rng = random.Random(args.seed)
+    conn = main.get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM products WHERE sku LIKE ?", (f"{SKU_PREFIX}%",))
+        if cursor.fetchone()[0]:
+            print("❌ Database đã có dữ liệu sinh sẵn, hãy dùng file/database khác")
+            sys.exit(1)
+        if not main.IS_POSTGRES:
+            # Chỉ cho lần nạp này: không fsync sau mỗi lô
+            conn.conn.execute("PRAGMA synchronous = OFF")
+        now = datetime.strptime(main.db_now(cursor)[:19], '%Y-%m-%d %H:%M:%S')
+        cursor.execute("SELECT id FROM users WHERE role = 'admin' ORDER BY id")
+        admin_id = cursor.fetchone()[0]
+        cursor.execute("SELECT COALESCE(MAX(id), 0) FROM products")
+        last_product_id = cursor.fetchone()[0]
+        started = time.perf_counter()
+
+        print(f"👤 Sinh {args.staff} nhân viên...")
+        staff_ids = generate_staff(main, conn, rng, args.staff, now, args.days)
+        print(f"📦 Sinh {args.products:,} sản phẩm...")
+        generate_products(main, conn, rng, args.products, staff_ids, admin_id, now, args.days)
+        cursor.execute("SELECT id, added_by FROM products WHERE status = 'approved' AND id > ?", (last_product_id,))
+        products = [tuple(row) for row in cursor.fetchall()]
+        print(f"🔄 Sinh {args.transactions:,} giao dịch...")
+        generate_transactions(main, conn, rng, args.transactions, products, staff_ids, now, args.days)
+
+        print("🔍 Dựng chỉ mục tìm kiếm...")
+        while True:
+            cursor.execute(f"SELECT id, {', '.join(main.SEARCH_COLUMNS)} FROM products WHERE id > ? ORDER BY id LIMIT ?",
+                           (last_product_id, CHUNK_SIZE))
+            rows = [tuple(row) for row in cursor.fetchall()]
+            if not rows:
+                break
+            main.bulk_sync_product_search(cursor, rows)
+            conn.commit()
+            last_product_id = rows[-1][0]
+        print("📊 Dựng bộ đếm dashboard và transactions_daily...")
+        main.rebuild_dashboard_stats(cursor)
+        main.bump_data_versions(cursor, *main.DATA_VERSION_TABLES)
+        conn.commit()
+        main.backfill_transactions_daily(conn)
+        cursor.execute("ANALYZE")
+        conn.commit()
+    finally:
+        conn.close()
+    target = "PostgreSQL" if main.IS_POSTGRES else main.DB_PATH
+    print(f"✅ Đã sinh dữ liệu vào {target} trong {time.perf_counter() - started:.0f}s")
+
+if __name__ == "__main__":
+    main_generate()
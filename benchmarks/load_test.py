@@ -0,0 +1,199 @@
+# Đo độ trễ (p50/p95/p99) và thông lượng của các trang chính, gọi thẳng ứng dụng ASGI trong
+# tiến trình (không qua mạng), kết quả dạng JSON để so sánh giữa các commit.
+#   python benchmarks/generate_data.py --database data/benchmark.db     # một lần
+#   python benchmarks/load_test.py [--database data/benchmark.db] [--duration 10] [--concurrency 8]
+#          [--scenarios dashboard,api_stats] [--output results.json] [--compare baseline.json]
+# Đặt DATABASE_URL để đo trên PostgreSQL. Kịch bản cập nhật tồn kho ghi thật vào database.
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SEARCH_TERMS = ["laptop", "noi com dien", "ao so mi", "ca phe", "Minh Phát", "GEN-00012", "tai nghe pro", "son moi"]
+ADMIN = {"email": "admin@warehouse.com", "password": "admin123"}
+STAFF = {"email": "staff@warehouse.com", "password": "staff123"}
+
+def build_scenarios(product_ids):
+    # tên -> (tài khoản, hàm tạo request (method, path, form) từ random.Random)
+    def get(path):
+        return lambda rng: ("GET", path, None)
+    return {
+        "dashboard": (ADMIN, get("/dashboard")),
+        "dashboard_staff": (STAFF, get("/dashboard")),
+        "products": (ADMIN, get("/products")),
+        "products_search": (ADMIN, lambda rng: ("GET", "/products", {"search": rng.choice(SEARCH_TERMS)})),
+        "reports": (ADMIN, get("/reports")),
+        "reports_products": (ADMIN, get("/reports?type=products")),
+        "reports_suppliers": (ADMIN, get("/reports?type=suppliers")),
+        "reports_staff": (ADMIN, get("/reports?type=staff")),
+        "api_stats": (ADMIN, get("/api/stats")),
+        "stock_update": (ADMIN, lambda rng: ("POST", f"/products/{rng.choice(product_ids)}/update",
+                                             {"stock_change": rng.randint(1, 5), "type": "in", "notes": "load test"})),
+    }
+
+def import_main(database):
+    sys.path.insert(0, ROOT)
+    os.chdir(ROOT)
+    import main
+    if not main.IS_POSTGRES:
+        if not os.path.exists(database):
+            raise SystemExit(f"❌ Không tìm thấy {database}, hãy chạy benchmarks/generate_data.py trước")
+        main.DB_PATH = database
+    return main
+
+def dataset_info(main):
+    conn = main.get_db_connection()
+    try:
+        cursor = conn.cursor()
+        info = {"backend": "postgres" if main.IS_POSTGRES else "sqlite", "search": main.SEARCH_BACKEND}
+        for table in ("products", "transactions", "users"):
+            cursor.execute(f"SELECT COUNT(*) FROM {table}")
+            info[table] = cursor.fetchone()[0]
+        cursor.execute("SELECT id FROM products WHERE status = 'approved' ORDER BY id LIMIT 5000")
+        return info, [row[0] for row in cursor.fetchall()]
+    finally:
+        conn.close()
+
+def git_revision():
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                                  text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT,
+                               capture_output=True, text=True).stdout.strip()
+        return revision + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def summarize(latencies, errors, elapsed):
+    ordered = sorted(latencies)
+    return {
+        "requests": len(ordered),
+        "errors": errors,
+        "throughput_rps": round(len(ordered) / elapsed, 1),
+        "mean_ms": round(statistics.fmean(ordered), 2),
+        "p50_ms": round(percentile(ordered, 0.50), 2),
+        "p95_ms": round(percentile(ordered, 0.95), 2),
+        "p99_ms": round(percentile(ordered, 0.99), 2),
+        "max_ms": round(ordered[-1], 2),
+    }
+
+async def run_scenario(app, account, make_request, duration, concurrency, warmup, seed):
+    import httpx
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", follow_redirects=False) as client:
+        login = await client.post("/login", data=account)
+        if login.status_code != 302 or login.headers.get("location") != "/dashboard":
+            raise SystemExit(f"❌ Đăng nhập {account['email']} thất bại")
+        rng = random.Random(seed)
+
+        async def send():
+            method, path, form = make_request(rng)
+            if method == "GET":
+                response = await client.get(path, params=form)
+                return response.status_code == 200
+            response = await client.post(path, data=form)
+            return response.status_code == 302 and "error" not in response.headers.get("location", "")
+
+        for _ in range(warmup):
+            await send()
+
+        latencies = []
+        errors = 0
+        deadline = time.perf_counter() + duration
+
+        async def worker():
+            nonlocal errors
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                ok = await send()
+                latencies.append((time.perf_counter() - started) * 1000)
+                if not ok:
+                    errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return summarize(latencies, errors, time.perf_counter() - started)
+
+def print_results(report, baseline=None):
+    print(f"{report['dataset']['products']:,} sản phẩm, {report['dataset']['transactions']:,} giao dịch "
+          f"({report['dataset']['backend']}), {report['config']['concurrency']} request đồng thời, "
+          f"commit {report['revision']}")
+    header = f"{'kịch bản':<20} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'lỗi':>5}"
+    if baseline:
+        header += f" {'p95 so với ' + str(baseline.get('revision')):>22} {'req/s':>8}"
+    print(header)
+    for name, result in report["scenarios"].items():
+        line = (f"{name:<20} {result['throughput_rps']:>8} {result['p50_ms']:>8} {result['p95_ms']:>8} "
+                f"{result['p99_ms']:>8} {result['errors']:>5}")
+        old = (baseline or {}).get("scenarios", {}).get(name)
+        if old:
+            line += (f" {(result['p95_ms'] / old['p95_ms'] - 1) * 100:>+21.1f}%"
+                     f" {(result['throughput_rps'] / old['throughput_rps'] - 1) * 100:>+7.1f}%")
+        print(line)
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description="Benchmark độ trễ/thông lượng qua ASGI trong tiến trình")
+    parser.add_argument("--database", default=os.path.join(ROOT, "data", "benchmark.db"),
+                        help="File SQLite do generate_data.py tạo (bỏ qua khi có DATABASE_URL)")
+    parser.add_argument("--duration", type=float, default=10, help="Số giây đo cho mỗi kịch bản")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--warmup", type=int, default=5, help="Số request chạy trước, không tính")
+    parser.add_argument("--scenarios", help="Danh sách kịch bản, cách nhau bằng dấu phẩy (mặc định: tất cả)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="Ghi kết quả JSON vào file")
+    parser.add_argument("--compare", help="File JSON của lần chạy trước để so sánh")
+    parser.add_argument("--json", action="store_true", help="In kết quả dạng JSON")
+    args = parser.parse_args()
+
+    os.environ.setdefault("SECRET_KEY", "benchmark")
+    main = import_main(os.path.abspath(args.database))
+    main.prepare_database()
+    dataset, product_ids = dataset_info(main)
+    scenarios = build_scenarios(product_ids)
+    selected = args.scenarios.split(",") if args.scenarios else list(scenarios)
+    unknown = [name for name in selected if name not in scenarios]
+    if unknown:
+        raise SystemExit(f"❌ Kịch bản không hợp lệ: {', '.join(unknown)} (có: {', '.join(scenarios)})")
+
+    results = {}
+    for name in selected:
+        account, make_request = scenarios[name]
+        results[name] = asyncio.run(run_scenario(main.app, account, make_request, args.duration,
+                                                 args.concurrency, args.warmup, args.seed))
+    if main.write_queue is not None:
+        main.write_queue.stop()
+
+    report = {
+        "revision": git_revision(),
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "dataset": dataset,
+        "config": {"duration": args.duration, "concurrency": args.concurrency, "warmup": args.warmup},
+        "scenarios": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_results(report, baseline)
+
+if __name__ == "__main__":
+    main_benchmark()
@@ -0,0 +1,231 @@
+# Kiểm tra kế hoạch thực thi của mọi câu SQL mà các handler chạy, trên dữ liệu sinh bởi
+# generate_data.py. Thất bại (exit 1) khi một câu lệnh quét tuần tự bảng lớn hoặc phải dựng
+# B-tree tạm để sắp xếp/gom nhóm mà không có trong ALLOWLIST.
+#   python benchmarks/query_plans.py [--database data/benchmark.db] [--min-rows 10000] [--json]
+# SQLite dùng EXPLAIN QUERY PLAN, PostgreSQL (DATABASE_URL) dùng EXPLAIN. Các request ghi
+# (thêm/sửa/duyệt/xóa một sản phẩm tạm, nhập/xuất kho) ghi thật vào database.
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SKIPPED_PREFIXES = ("PRAGMA", "BEGIN", "SAVEPOINT", "RELEASE", "ROLLBACK", "COMMIT", "CREATE", "ALTER",
+                    "DROP", "ANALYZE", "EXPLAIN", "PREPARE", "EXECUTE", "DEALLOCATE", "SET")
+SQL_KEYWORDS = {"WHERE", "JOIN", "LEFT", "RIGHT", "INNER", "OUTER", "CROSS", "ON", "USING", "GROUP", "ORDER",
+                "LIMIT", "SET", "VALUES", "AS", "UNION", "HAVING", "WINDOW"}
+
+# (regex trên câu SQL, regex trên dòng kế hoạch, lý do chấp nhận)
+ALLOWLIST = [
+    (r"^INSERT INTO transactions_daily .* WHERE t\.product_id = \?", r"TEMP B-TREE FOR GROUP BY",
+     "Dựng lại rollup khi đổi danh mục: chỉ gom nhóm giao dịch của một sản phẩm"),
+    (r"GROUP BY (p\.)?category ORDER BY total_value", r"TEMP B-TREE FOR ORDER BY",
+     "Sắp xếp kết quả đã gom nhóm, mỗi danh mục một dòng"),
+    (r"bm25\(products_fts", r"TEMP B-TREE FOR ORDER BY",
+     "Xếp theo độ liên quan: chỉ sắp xếp các sản phẩm khớp từ khóa"),
+    (r"^SELECT p\.id, p\.sku, .* FROM products p WHERE .* ORDER BY p\.id$", r"^SCAN p$",
+     "Xuất toàn bộ sản phẩm: đọc hết bảng theo thứ tự id là chủ ý"),
+    (r"GROUP BY substr\(t\.created_at", r"TEMP B-TREE FOR GROUP BY",
+     "Biểu đồ theo giờ: chỉ gom nhóm giao dịch trong khoảng ngày đã lọc bằng idx_transactions_created"),
+    (r"GROUP BY supplier, supplier_country", r"TEMP B-TREE",
+     "Báo cáo nhà cung cấp: số nhóm (nhà cung cấp x quốc gia) nhỏ"),
+    (r"WHERE p\.added_by = \? ORDER BY t\.created_at DESC LIMIT", r"TEMP B-TREE FOR ORDER BY",
+     "Giao dịch gần đây của nhân viên: chỉ sắp xếp giao dịch trên sản phẩm của nhân viên đó"),
+    (r"FROM users u LEFT JOIN products p .* GROUP BY u\.id", r"TEMP B-TREE FOR ORDER BY",
+     "Sắp xếp kết quả đã gom nhóm, mỗi nhân viên một dòng"),
+]
+
+def import_main(database):
+    sys.path.insert(0, ROOT)
+    os.chdir(ROOT)
+    import main
+    if not main.IS_POSTGRES:
+        if not os.path.exists(database):
+            raise SystemExit(f"❌ Không tìm thấy {database}, hãy chạy benchmarks/generate_data.py trước")
+        main.DB_PATH = database
+    return main
+
+def normalize(sql):
+    return " ".join(sql.split())
+
+def collect_statements(main):
+    # Chạy các trang/API chính (Admin và nhân viên) và ghi lại mọi câu lệnh kèm tham số đầu tiên
+    from fastapi.testclient import TestClient
+    statements = {}
+
+    def observer(sql, params, elapsed):
+        key = normalize(sql)
+        if key not in statements:
+            statements[key] = (sql, tuple(params))
+
+    today = datetime.now()
+    week_ago = (today - timedelta(days=7)).strftime('%Y-%m-%d')
+    today_str = today.strftime('%Y-%m-%d')
+    pages = [
+        "/dashboard", "/products", "/products?search=laptop", "/products?search=Minh Phát&category=Điện tử",
+        "/products?category=Gia dụng", "/products?min_stock=5", "/admin/approve-products", "/admin/users",
+        "/profile", "/reports", "/reports?type=products", "/reports?type=suppliers", "/reports?type=staff",
+        f"/reports?from={week_ago}&to={today_str}", "/api/stats", "/api/pending-count",
+        "/api/stats/series?bucket=hour", "/api/stats/series?bucket=day", "/api/stats/series?bucket=week",
+        "/api/stats/series?bucket=month&category=Điện tử",
+        f"/export/transactions.csv?from={week_ago}&to={today_str}", "/export/products.jsonl",
+        f"/export/reports/daily.csv?from={week_ago}", "/export/reports/products.csv",
+        "/export/reports/suppliers.csv", "/export/reports/staff.csv",
+    ]
+    main.statement_observers.append(observer)
+    try:
+        for account in (("admin@warehouse.com", "admin123"), ("staff@warehouse.com", "staff123")):
+            client = TestClient(main.app, follow_redirects=False)
+            client.post("/login", data={"email": account[0], "password": account[1]})
+            for page in pages:
+                response = client.get(page)
+                # Trang sau của danh sách có phân trang (keyset)
+                match = re.search(r'href="(/products[^"]*after=[^"]*)"', response.text) if response.status_code == 200 else None
+                if match:
+                    client.get(match.group(1).replace("&amp;", "&"))
+
+            sku = f"PLAN-{account[0][:5]}-{int(time.time())}"
+            client.post("/products/add", data={"name": "Sản phẩm kiểm tra kế hoạch", "category": "Điện tử",
+                                               "sku": sku, "stock": 10, "min_stock": 2, "price": 1000,
+                                               "description": "Tạm thời", "supplier": "Kiểm tra"})
+            row = main.get_db_connection()
+            try:
+                cursor = row.cursor()
+                cursor.execute("SELECT id FROM products WHERE sku = ?", (sku,))
+                product_id = cursor.fetchone()[0]
+            finally:
+                row.close()
+            admin = account[0].startswith("admin")
+            if admin:
+                client.post(f"/admin/products/{product_id}/approve")
+            client.get(f"/products/{product_id}/detail")
+            client.post(f"/products/{product_id}/edit", data={"name": "Sản phẩm kiểm tra kế hoạch", "category": "Gia dụng",
+                                                             "price": 2000, "supplier": "Kiểm tra"})
+            client.post(f"/products/{product_id}/update", data={"stock_change": 1, "type": "out", "notes": "kiểm tra"})
+            client.post("/api/stock-movements", json={"movements": [{"sku": sku, "type": "in", "quantity": 1}]},
+                        headers={"Idempotency-Key": sku})
+            if admin:
+                client.post(f"/admin/products/{product_id}/reject")
+            client.get(f"/products/{product_id}/delete")
+    finally:
+        main.statement_observers.remove(observer)
+    return statements
+
+def table_sizes(main, conn):
+    cursor = conn.cursor()
+    if main.IS_POSTGRES:
+        cursor.execute("SELECT table_name FROM information_schema.tables WHERE table_schema = 'public'")
+    else:
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' "
+                       "AND name NOT LIKE 'products_fts_%'")
+    sizes = {}
+    for (table,) in cursor.fetchall():
+        cursor.execute(f"SELECT COUNT(*) FROM {table}")
+        sizes[table] = cursor.fetchone()[0]
+    return sizes
+
+def table_aliases(sql):
+    aliases = {}
+    for table, alias in re.findall(r"\b(?:FROM|JOIN|UPDATE|INTO)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?", sql, re.IGNORECASE):
+        aliases[table.lower()] = table.lower()
+        if alias and alias.upper() not in SQL_KEYWORDS:
+            aliases[alias.lower()] = table.lower()
+    return aliases
+
+def explain(main, conn, sql, params):
+    stmt = main.statement_registry.get(sql, main.IS_POSTGRES)
+    cursor = conn.conn.cursor()
+    if main.IS_POSTGRES:
+        cursor.execute("EXPLAIN " + stmt.text, params)
+        return [row[0] for row in cursor.fetchall()]
+    cursor.execute("EXPLAIN QUERY PLAN " + stmt.text, params)
+    return [row[3] for row in cursor.fetchall()]
+
+def plan_problems(main, sql, plan, sizes, min_rows):
+    # Trả về các dòng kế hoạch vi phạm: quét tuần tự bảng lớn / B-tree tạm trên câu lệnh đụng bảng lớn
+    aliases = table_aliases(sql)
+    large = {table for table in set(aliases.values()) if sizes.get(table, 0) >= min_rows}
+    problems = []
+    for line in plan:
+        if main.IS_POSTGRES:
+            match = re.search(r"Seq Scan on (\w+)", line)
+            if match and sizes.get(match.group(1), 0) >= min_rows:
+                problems.append(line.strip())
+            continue
+        match = re.match(r"SCAN (\w+)(.*)", line)
+        if match:
+            table = aliases.get(match.group(1).lower(), match.group(1).lower())
+            if "INDEX" not in match.group(2) and sizes.get(table, 0) >= min_rows:
+                problems.append(line)
+        elif line.startswith("USE TEMP B-TREE") and large:
+            problems.append(line)
+    return problems
+
+def allowed(sql, line):
+    for sql_pattern, plan_pattern, reason in ALLOWLIST:
+        if re.search(sql_pattern, sql, re.IGNORECASE) and re.search(plan_pattern, line):
+            return reason
+    return None
+
+def main_check():
+    parser = argparse.ArgumentParser(description="Kiểm tra kế hoạch thực thi SQL trên dữ liệu lớn")
+    parser.add_argument("--database", default=os.path.join(ROOT, "data", "benchmark.db"),
+                        help="File SQLite do generate_data.py tạo (bỏ qua khi có DATABASE_URL)")
+    parser.add_argument("--min-rows", type=int, default=10000, help="Bảng từ bấy nhiêu dòng trở lên là bảng lớn")
+    parser.add_argument("--verbose", action="store_true", help="In kế hoạch của mọi câu lệnh")
+    parser.add_argument("--json", action="store_true", help="In kết quả dạng JSON")
+    args = parser.parse_args()
+
+    os.environ.setdefault("SECRET_KEY", "benchmark")
+    main = import_main(os.path.abspath(args.database))
+    main.prepare_database()
+    statements = collect_statements(main)
+    if main.write_queue is not None:
+        main.write_queue.stop()
+
+    conn = main.get_db_connection()
+    report = []
+    try:
+        sizes = table_sizes(main, conn)
+        for key, (sql, params) in sorted(statements.items()):
+            first = key.split(None, 1)[0].upper()
+            if first in SKIPPED_PREFIXES or (first == "INSERT" and " SELECT " not in f" {key.upper()} "):
+                continue
+            try:
+                plan = explain(main, conn, sql, params)
+            except Exception as e:
+                report.append({"sql": key, "error": str(e), "plan": [], "violations": [], "allowed": []})
+                conn.rollback()
+                continue
+            entry = {"sql": key, "plan": plan, "violations": [], "allowed": []}
+            for line in plan_problems(main, sql, plan, sizes, args.min_rows):
+                reason = allowed(key, line)
+                if reason:
+                    entry["allowed"].append({"plan": line, "reason": reason})
+                else:
+                    entry["violations"].append(line)
+            report.append(entry)
+    finally:
+        conn.close()
+
+    violations = [entry for entry in report if entry["violations"] or entry.get("error")]
+    if args.json:
+        print(json.dumps({"tables": sizes, "statements": report}, ensure_ascii=False, indent=2))
+    else:
+        for entry in report:
+            if args.verbose or entry["violations"] or entry.get("error"):
+                mark = "❌" if entry["violations"] or entry.get("error") else "✅"
+                print(f"{mark} {entry['sql'][:200]}")
+                for line in entry["plan"]:
+                    print(f"      {line}")
+                if entry.get("error"):
+                    print(f"      lỗi: {entry['error']}")
+        allowed_count = sum(len(entry["allowed"]) for entry in report)
+        print(f"{len(report)} câu lệnh, {len(violations)} vi phạm, {allowed_count} dòng kế hoạch được chấp nhận theo ALLOWLIST")
+    sys.exit(1 if violations else 0)
+
+if __name__ == "__main__":
+    main_check()
@@ -0,0 +1,156 @@
+# So sánh số lượt ghi/giây trên SQLite: cấu hình cũ (rollback journal, mỗi request tự commit),
+# WAL + busy_timeout, và WAL + hàng đợi ghi một luồng gom commit (SQLITE_WRITE_QUEUE=1).
+#   python benchmarks/sqlite_writes.py [--processes 2] [--concurrency 16] [--requests 200] [--json]
+# Mỗi tiến trình con giả lập một worker uvicorn: gửi request cập nhật tồn kho
+# (POST /products/{id}/update) qua ASGI ngay trong tiến trình. Các tiến trình dùng chung một
+# file database trong thư mục tạm, mỗi chế độ chạy trên một bản sao riêng của database đã seed.
+import argparse
+import asyncio
+import csv
+import io
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PRODUCTS = 50
+MODES = {
+    "journal_delete": {"SQLITE_JOURNAL_MODE": "DELETE", "SQLITE_SYNCHRONOUS": "FULL", "SQLITE_WRITE_QUEUE": "0"},
+    "wal": {"SQLITE_JOURNAL_MODE": "WAL", "SQLITE_SYNCHRONOUS": "NORMAL", "SQLITE_WRITE_QUEUE": "0"},
+    "wal_write_queue": {"SQLITE_JOURNAL_MODE": "WAL", "SQLITE_SYNCHRONOUS": "NORMAL", "SQLITE_WRITE_QUEUE": "1"},
+}
+
+def import_main():
+    sys.path.insert(0, ROOT)
+    os.chdir(ROOT)
+    import main
+    return main
+
+def setup():
+    # Tạo database, nhập PRODUCTS sản phẩm và duyệt tất cả
+    main = import_main()
+    from fastapi.testclient import TestClient
+    client = TestClient(main.app, follow_redirects=False)
+    client.post("/login", data={"email": "admin@warehouse.com", "password": "admin123"})
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(["name", "category", "sku", "stock", "min_stock", "price"])
+    for i in range(PRODUCTS):
+        writer.writerow([f"Sản phẩm ghi {i}", "Điện tử", f"WRITE-{i:04d}", 1000, 5, 100000])
+    client.post("/products/import", files={"file": ("bench.csv", buffer.getvalue().encode("utf-8"), "text/csv")}).raise_for_status()
+    for product_id in range(1, PRODUCTS + 4):
+        client.post(f"/admin/products/{product_id}/approve")
+    if main.write_queue is not None:
+        main.write_queue.stop()
+
+async def drive(main, concurrency, requests):
+    import httpx
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        await client.post("/login", data={"email": "admin@warehouse.com", "password": "admin123"})
+        latencies = []
+        errors = 0
+
+        async def worker(index):
+            nonlocal errors
+            for n in range(requests):
+                product_id = (index * requests + n) % PRODUCTS + 1
+                started = time.perf_counter()
+                response = await client.post(f"/products/{product_id}/update",
+                                             data={"stock_change": 1, "type": "in", "notes": "benchmark"})
+                latencies.append((time.perf_counter() - started) * 1000)
+                if response.status_code != 302 or "error" in response.headers.get("location", ""):
+                    errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(index) for index in range(concurrency)))
+        return latencies, errors, time.perf_counter() - started
+
+def child(concurrency, requests):
+    # Chạy trong tiến trình con: in kết quả đo dạng JSON
+    main = import_main()
+    main.prepare_database()
+    latencies, errors, elapsed = asyncio.run(drive(main, concurrency, requests))
+    queue_metrics = main.write_queue.metrics() if main.write_queue is not None else None
+    if main.write_queue is not None:
+        main.write_queue.stop()
+    print(json.dumps({"latencies": latencies, "errors": errors, "elapsed": elapsed, "write_queue": queue_metrics}))
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def run_mode(env, processes, concurrency, requests):
+    command = [sys.executable, os.path.abspath(__file__), "--child",
+               "--concurrency", str(concurrency), "--requests", str(requests)]
+    started = time.perf_counter()
+    children = [subprocess.Popen(command, env=env, cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+                for _ in range(processes)]
+    outputs = [json.loads(child.communicate()[0].strip().splitlines()[-1]) for child in children]
+    elapsed = time.perf_counter() - started
+    latencies = [value for output in outputs for value in output["latencies"]]
+    writes = len(latencies) - sum(output["errors"] for output in outputs)
+    result = {
+        "writes": writes,
+        "errors": sum(output["errors"] for output in outputs),
+        "writes_per_sec": round(writes / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies), 2),
+        "p95_ms": round(percentile(latencies, 0.95), 2),
+        "p99_ms": round(percentile(latencies, 0.99), 2),
+    }
+    batches = [output["write_queue"] for output in outputs if output["write_queue"]]
+    if batches:
+        result["avg_batch"] = round(sum(m["writes"] for m in batches) / max(sum(m["batches"] for m in batches), 1), 2)
+        result["largest_batch"] = max(m["largest_batch"] for m in batches)
+    return result
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description="Benchmark ghi SQLite có / không có hàng đợi ghi")
+    parser.add_argument("--processes", type=int, default=2, help="Số tiến trình (worker) ghi song song")
+    parser.add_argument("--concurrency", type=int, default=16, help="Số request đồng thời mỗi tiến trình")
+    parser.add_argument("--requests", type=int, default=50, help="Số request tuần tự của mỗi luồng đồng thời")
+    parser.add_argument("--json", action="store_true", help="In kết quả dạng JSON")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--setup", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.setup:
+        setup()
+        return
+    if args.child:
+        child(args.concurrency, args.requests)
+        return
+
+    workdir = tempfile.mkdtemp(prefix="bench-sqlite-writes-")
+    base_env = dict(os.environ, VERCEL="1", SECRET_KEY="benchmark", MEDIA_DIR=os.path.join(workdir, "media"))
+    seed_dir = os.path.join(workdir, "seed")
+    os.makedirs(seed_dir)
+    subprocess.run([sys.executable, os.path.abspath(__file__), "--setup"], env=dict(base_env, TMPDIR=seed_dir),
+                   cwd=ROOT, check=True, capture_output=True)
+
+    results = {}
+    for mode, settings in MODES.items():
+        mode_dir = os.path.join(workdir, mode)
+        os.makedirs(mode_dir)
+        shutil.copyfile(os.path.join(seed_dir, "database.db"), os.path.join(mode_dir, "database.db"))
+        results[mode] = run_mode(dict(base_env, TMPDIR=mode_dir, **settings),
+                                 args.processes, args.concurrency, args.requests)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps({"processes": args.processes, "concurrency": args.concurrency,
+                          "requests": args.requests, "results": results}, indent=2))
+        return
+    total = args.processes * args.concurrency * args.requests
+    print(f"{args.processes} tiến trình x {args.concurrency} request đồng thời, tổng {total} lượt cập nhật tồn kho")
+    print(f"{'chế độ':<18} {'ghi/giây':>9} {'lỗi':>5} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'lô TB':>6}")
+    for mode, result in results.items():
+        print(f"{mode:<18} {result['writes_per_sec']:>9} {result['errors']:>5} {result['p50_ms']:>8} "
+              f"{result['p95_ms']:>8} {result['p99_ms']:>8} {result.get('avg_batch', '-'):>6}")
+
+if __name__ == "__main__":
+    main_benchmark()
@@ -1,20 +1,72 @@
-from fastapi import FastAPI, Request, Form, HTTPException, status
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
+from fastapi import FastAPI, Request, Form, File, UploadFile, HTTPException, status, Depends
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, StreamingResponse, Response
 from fastapi.templating import Jinja2Templates
+from jinja2 import ChoiceLoader, FileSystemLoader, ModuleLoader, TemplateNotFound
+import jinja2
 from fastapi.staticfiles import StaticFiles
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from contextlib import asynccontextmanager
 import sqlite3
+import codecs
+import csv
+import io
 import hashlib
-from datetime import datetime
+import hmac
+import base64
+import bisect
+import contextvars
+import gzip
+import json
+import mimetypes
+import queue
+import secrets
+import asyncio
+import math
+import re
+import unicodedata
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+from urllib.parse import urlencode
+import aiofiles
 from typing import Optional
 import os
+import shutil
+import stat
+import sys
 import tempfile
+import threading
+import time
+import weakref
+import zlib
 
 try:
     import psycopg2
-    from psycopg2.extras import DictCursor
+    from psycopg2.extras import DictCursor, execute_batch
 except ImportError:
     psycopg2 = None
 
+try:
+    import openpyxl  # Chỉ cần khi nhập sản phẩm từ file .xlsx
+except ImportError:
+    openpyxl = None
+
+try:
+    from PIL import Image, ImageOps  # Tạo ảnh thu nhỏ/WebP khi tải ảnh sản phẩm lên
+except ImportError:
+    Image = None
+
+try:
+    import brotli  # Nén .br (build-assets và nén response); không có thì chỉ dùng gzip/zstd
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard  # Nén response zstd cho trình duyệt hỗ trợ
+except ImportError:
+    zstandard = None
+
 app = FastAPI(
     title="Hệ thống quản lý kho thông minh",
     description="Hệ thống quản lý kho hàng với đầy đủ tính năng",
@@ -30,6 +82,645 @@ except OSError:
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
 
+# Ảnh sản phẩm tải lên (đặt tên theo sha256 nội dung), phục vụ tại /media
+MEDIA_DIR = os.environ.get("MEDIA_DIR") or (
+    os.path.join(tempfile.gettempdir(), 'media') if os.environ.get("VERCEL") else 'data/media')
+try:
+    os.makedirs(MEDIA_DIR, exist_ok=True)
+except OSError:
+    MEDIA_DIR = os.path.join(tempfile.gettempdir(), 'media')
+    os.makedirs(MEDIA_DIR, exist_ok=True)
+
+# ===== TÀI NGUYÊN TĨNH (FINGERPRINT, CACHE DÀI HẠN) =====
+# `python main.py build-assets` chép từng file trong static/ thành tên có hash nội dung
+# (static/dist/img/a.<hash>.png), nén sẵn .gz/.br cho file dạng text và ghi manifest.json.
+# Template lấy URL qua asset_url(): có manifest thì trỏ tới /assets/... (cache 1 năm,
+# immutable), chưa build thì dùng lại /static/... như cũ.
+STATIC_DIR = "static"
+STATIC_URL = "/static/"
+ASSETS_DIR = os.path.join(STATIC_DIR, "dist")
+ASSETS_URL = "/assets/"
+ASSET_MANIFEST_PATH = os.path.join(ASSETS_DIR, "manifest.json")
+ASSET_HASH_LENGTH = 12
+ASSET_COMPRESSIBLE = {".css", ".js", ".mjs", ".json", ".map", ".svg", ".txt", ".xml", ".html", ".ico", ".ttf", ".otf", ".wasm"}
+ASSET_MIN_COMPRESS_BYTES = 1024
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+FINGERPRINT_PATTERN = re.compile(r"[0-9a-f]{%d}" % ASSET_HASH_LENGTH)
+PRECOMPRESSED_ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+def load_asset_manifest():
+    try:
+        with open(ASSET_MANIFEST_PATH, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+ASSET_MANIFEST = load_asset_manifest()
+
+def asset_url(path):
+    # '/static/a/b.png' hoặc 'a/b.png' -> '/assets/a/b.<hash>.png'; URL ngoài static giữ nguyên
+    if not path:
+        return path
+    if path.startswith(STATIC_URL):
+        key = path[len(STATIC_URL):]
+    elif path.startswith("/") or "://" in path:
+        return path
+    else:
+        key = path
+    fingerprinted = ASSET_MANIFEST.get(key)
+    return ASSETS_URL + fingerprinted if fingerprinted else STATIC_URL + key
+
+def accepted_encodings(scope):
+    accepted = set()
+    for item in Headers(scope=scope).get("accept-encoding", "").split(","):
+        name, _, params = item.strip().partition(";")
+        if name and params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            accepted.add(name.lower())
+    return accepted
+
+class ImmutableStaticFiles(StaticFiles):
+    # Chỉ dùng cho file có tên chứa hash nội dung: trình duyệt/CDN giữ 1 năm, không cần hỏi lại.
+    # Gửi bản nén sẵn (.br/.gz) nếu client chấp nhận
+    async def get_response(self, path, scope):
+        response = None
+        compressible = os.path.splitext(path)[1].lower() in ASSET_COMPRESSIBLE
+        if compressible and scope["method"] in ("GET", "HEAD"):
+            accepted = accepted_encodings(scope)
+            for encoding, suffix in PRECOMPRESSED_ENCODINGS:
+                if encoding not in accepted:
+                    continue
+                full_path, stat_result = await run_in_threadpool(self.lookup_path, path + suffix)
+                if stat_result and stat.S_ISREG(stat_result.st_mode):
+                    response = self.file_response(full_path, stat_result, scope)
+                    response.headers["Content-Encoding"] = encoding
+                    response.headers["Content-Type"] = mimetypes.guess_type(path)[0] or "application/octet-stream"
+                    break
+        if response is None:
+            response = await super().get_response(path, scope)
+        if compressible:
+            response.headers["Vary"] = "Accept-Encoding"
+        # manifest.json và các file không mang hash vẫn phải hỏi lại như bình thường
+        if response.status_code in (200, 304) and FINGERPRINT_PATTERN.search(os.path.basename(path)):
+            response.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+        return response
+
+def _write_atomic(path, data):
+    tmp_path = f"{path}.{secrets.token_hex(4)}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def build_assets(source_dir=STATIC_DIR, output_dir=ASSETS_DIR):
+    # Trả về (manifest, số file nén sẵn). Không xóa bản build cũ: trang HTML cũ còn trong cache vẫn tải được
+    manifest = {}
+    compressed = 0
+    output_abs = os.path.abspath(output_dir)
+    for root, dirs, files in os.walk(source_dir):
+        dirs[:] = sorted(d for d in dirs if os.path.abspath(os.path.join(root, d)) != output_abs)
+        for name in sorted(files):
+            source = os.path.join(root, name)
+            rel = os.path.relpath(source, source_dir).replace(os.sep, "/")
+            with open(source, "rb") as f:
+                data = f.read()
+            stem, ext = os.path.splitext(rel)
+            fingerprinted = f"{stem}.{hashlib.sha256(data).hexdigest()[:ASSET_HASH_LENGTH]}{ext}"
+            target = os.path.join(output_dir, *fingerprinted.split("/"))
+            manifest[rel] = fingerprinted
+            if os.path.exists(target):
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            _write_atomic(target, data)
+            if ext.lower() not in ASSET_COMPRESSIBLE or len(data) < ASSET_MIN_COMPRESS_BYTES:
+                continue
+            # Chỉ giữ bản nén nếu thực sự nhỏ hơn; mtime=0 để build lại cho ra cùng nội dung
+            variants = [(".gz", gzip.compress(data, compresslevel=9, mtime=0))]
+            if brotli is not None:
+                variants.append((".br", brotli.compress(data, quality=11)))
+            for suffix, payload in variants:
+                if len(payload) < len(data) * 0.9:
+                    _write_atomic(target + suffix, payload)
+                    compressed += 1
+    
+    os.makedirs(output_dir, exist_ok=True)
+    _write_atomic(os.path.join(output_dir, "manifest.json"),
+                  json.dumps(manifest, ensure_ascii=False, indent=2, sort_keys=True).encode("utf-8"))
+    return manifest, compressed
+
+templates.env.globals["asset_url"] = asset_url
+app.mount(ASSETS_URL.rstrip("/"), ImmutableStaticFiles(directory=ASSETS_DIR, check_dir=False), name="assets")
+# Ảnh tải lên đặt tên theo sha256 nên cũng không bao giờ đổi nội dung
+app.mount("/media", ImmutableStaticFiles(directory=MEDIA_DIR), name="media")
+
+# ===== TEMPLATE BIÊN DỊCH SẴN =====
+# `python main.py precompile-templates` biên dịch templates/*.html thành module Python
+# (TEMPLATES_COMPILED_DIR) cùng manifest băm nội dung từng template. Khi khởi động, template
+# nào còn khớp hash (và cùng phiên bản Jinja2) được nạp từ module, bỏ qua bước parse/biên
+# dịch ở lần render đầu; template đã sửa sau khi build (lúc phát triển) thì biên dịch như cũ.
+TEMPLATES_DIR = "templates"
+TEMPLATES_COMPILED_DIR = os.environ.get("TEMPLATES_COMPILED_DIR", "templates_compiled")
+TEMPLATES_MANIFEST = "manifest.json"
+
+class PrecompiledTemplateLoader(ModuleLoader):
+    # Chỉ trả về template còn khớp với bản đã biên dịch; còn lại để FileSystemLoader xử lý
+    def __init__(self, path, fresh):
+        super().__init__(path)
+        self.fresh = fresh
+    
+    def load(self, environment, name, globals=None):
+        if name not in self.fresh:
+            raise TemplateNotFound(name)
+        return super().load(environment, name, globals)
+
+def _template_hashes(directory=TEMPLATES_DIR):
+    hashes = {}
+    for name in FileSystemLoader(directory).list_templates():
+        with open(os.path.join(directory, *name.split("/")), "rb") as f:
+            hashes[name] = hashlib.sha256(f.read()).hexdigest()
+    return hashes
+
+def fresh_precompiled_templates():
+    if os.environ.get("TEMPLATES_PRECOMPILED", "1") == "0":
+        return set()
+    try:
+        with open(os.path.join(TEMPLATES_COMPILED_DIR, TEMPLATES_MANIFEST), encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return set()
+    if manifest.get("jinja2") != jinja2.__version__:
+        return set()
+    compiled = manifest.get("templates", {})
+    return {name for name, digest in _template_hashes().items() if compiled.get(name) == digest}
+
+def precompile_templates():
+    # Ghi module vào thư mục tạm rồi đổi tên, tiến trình đang chạy không thấy thư mục dở dang
+    target = TEMPLATES_COMPILED_DIR.rstrip("/\\")
+    tmp_dir = f"{target}.{secrets.token_hex(4)}.tmp"
+    env = templates.env.overlay(loader=FileSystemLoader(TEMPLATES_DIR))
+    env.compile_templates(tmp_dir, zip=None, ignore_errors=False)
+    hashes = _template_hashes()
+    with open(os.path.join(tmp_dir, TEMPLATES_MANIFEST), "w", encoding="utf-8") as f:
+        json.dump({"jinja2": jinja2.__version__, "templates": hashes}, f, indent=2, sort_keys=True)
+    if os.path.isdir(target):
+        shutil.rmtree(target)
+    os.replace(tmp_dir, target)
+    return len(hashes)
+
+def use_precompiled_templates():
+    fresh = fresh_precompiled_templates()
+    if fresh:
+        templates.env.loader = ChoiceLoader([
+            PrecompiledTemplateLoader(TEMPLATES_COMPILED_DIR, fresh),
+            FileSystemLoader(TEMPLATES_DIR),
+        ])
+    return fresh
+
+PRECOMPILED_TEMPLATES = use_precompiled_templates()
+
+# ===== NÉN RESPONSE (zstd/brotli/gzip) =====
+# Middleware ASGI nén HTML/JSON/CSV... theo Accept-Encoding. Response nhỏ hơn ngưỡng đi
+# nguyên; response streaming (xuất file) được nén và đẩy ra theo từng khối. SSE, ảnh và
+# file đã nén sẵn (Content-Encoding có sẵn) không bị nén lại.
+COMPRESSION_MIN_SIZE = int(os.environ.get("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSION_LEVELS = {
+    "zstd": int(os.environ.get("ZSTD_LEVEL", "3")),
+    "br": int(os.environ.get("BROTLI_QUALITY", "4")),
+    "gzip": int(os.environ.get("GZIP_LEVEL", "6")),
+}
+COMPRESSIBLE_TYPES = {
+    "text/html", "text/plain", "text/css", "text/csv", "text/xml", "text/javascript",
+    "application/json", "application/javascript", "application/xml", "application/x-ndjson", "image/svg+xml",
+}
+# Khối lớn hơn ngưỡng này được nén trong threadpool để không chặn event loop
+COMPRESSION_THREADPOOL_SIZE = 64 * 1024
+
+class StreamCompressor:
+    # chunk(): nén và flush ngay để client nhận được dữ liệu; finish(): kết thúc stream
+    def __init__(self, encoding, level):
+        self.encoding = encoding
+        if encoding == "zstd":
+            self._obj = zstandard.ZstdCompressor(level=level).compressobj()
+        elif encoding == "br":
+            self._obj = brotli.Compressor(quality=level)
+        else:
+            self._obj = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    
+    def chunk(self, data):
+        if self.encoding == "zstd":
+            return self._obj.compress(data) + self._obj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        if self.encoding == "br":
+            return self._obj.process(data) + self._obj.flush()
+        return self._obj.compress(data) + self._obj.flush(zlib.Z_SYNC_FLUSH)
+    
+    def finish(self, data=b""):
+        if self.encoding == "zstd":
+            return self._obj.compress(data) + self._obj.flush()
+        if self.encoding == "br":
+            return self._obj.process(data) + self._obj.finish()
+        return self._obj.compress(data) + self._obj.flush()
+
+def available_encodings():
+    # Thứ tự ưu tiên khi client chấp nhận nhiều loại
+    return [encoding for encoding, module in (("zstd", zstandard), ("br", brotli), ("gzip", zlib)) if module is not None]
+
+def choose_encoding(scope):
+    accepted = accepted_encodings(scope)
+    for encoding in available_encodings():
+        if encoding in accepted:
+            return encoding
+    return None
+
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size=COMPRESSION_MIN_SIZE, levels=None):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.levels = levels or COMPRESSION_LEVELS
+    
+    async def __call__(self, scope, receive, send):
+        encoding = choose_encoding(scope) if scope["type"] == "http" and scope["method"] != "HEAD" else None
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await self.app(scope, receive, CompressedSend(send, encoding, self.levels[encoding], self.minimum_size))
+
+class CompressedSend:
+    # Bọc hàm send của một response: giữ lại http.response.start đến khi thấy khối body đầu tiên
+    def __init__(self, send, encoding, level, minimum_size):
+        self.send = send
+        self.encoding = encoding
+        self.level = level
+        self.minimum_size = minimum_size
+        self.start = None
+        self.compressor = None
+        self.passthrough = False
+    
+    def _should_compress(self, headers, body, more_body):
+        if self.start["status"] < 200 or self.start["status"] in (204, 206, 304):
+            return False
+        if "content-encoding" in headers or "no-transform" in headers.get("cache-control", ""):
+            return False
+        if headers.get("content-type", "").split(";")[0].strip().lower() not in COMPRESSIBLE_TYPES:
+            return False
+        return more_body or len(body) >= self.minimum_size
+    
+    async def _compress(self, body, final):
+        compress = self.compressor.finish if final else self.compressor.chunk
+        if len(body) >= COMPRESSION_THREADPOOL_SIZE:
+            return await run_in_threadpool(compress, body)
+        return compress(body)
+    
+    async def __call__(self, message):
+        if message["type"] == "http.response.start":
+            self.start = message
+            return
+        if message["type"] != "http.response.body" or self.passthrough:
+            if self.start is not None:
+                await self.send(self.start)
+                self.start = None
+            await self.send(message)
+            return
+        
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.compressor is None:
+            self.start["headers"] = list(self.start.get("headers", []))
+            headers = MutableHeaders(raw=self.start["headers"])
+            if not self._should_compress(headers, body, more_body):
+                self.passthrough = True
+                await self.send(self.start)
+                self.start = None
+                await self.send(message)
+                return
+            self.compressor = StreamCompressor(self.encoding, self.level)
+            headers["Content-Encoding"] = self.encoding
+            headers.add_vary_header("Accept-Encoding")
+            if "content-length" in headers:
+                del headers["content-length"]
+            # Nội dung byte đã khác bản gốc: ETag mạnh phải chuyển thành ETag yếu
+            etag = headers.get("etag")
+            if etag and not etag.startswith("W/"):
+                headers["ETag"] = "W/" + etag
+            await self.send(self.start)
+            self.start = None
+        
+        await self.send({"type": "http.response.body", "body": await self._compress(body, not more_body),
+                         "more_body": more_body})
+
+app.add_middleware(CompressionMiddleware)
+
+# ===== ĐO ĐẠC (PROMETHEUS /metrics) =====
+# Histogram/counter giữ trong bộ nhớ của tiến trình (mỗi worker một bộ số liệu riêng), xuất
+# theo định dạng text của Prometheus tại /metrics. Mỗi request chỉ tốn vài phép cộng dưới một
+# lock; số liệu pool, cache câu lệnh, SSE, hàng đợi ghi được đọc lúc scrape.
+# METRICS_ENABLED=0 để tắt; METRICS_TOKEN cho phép Prometheus scrape bằng "Authorization: Bearer <token>".
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") != "0"
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+METRICS_STATEMENT_LABEL_SIZE = 160
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+STATIC_PREFIXES = ("/static", "/assets", "/media")
+PROCESS_STARTED = time.time()
+
+class RequestDBStats:
+    __slots__ = ("scope", "queries", "seconds", "statements", "lock")
+
+    def __init__(self, scope):
+        self.scope = scope
+        # AsyncDBConnection.gather chạy truy vấn của cùng một request song song trên nhiều luồng
+        self.lock = threading.Lock()
+        self.queries = 0
+        self.seconds = 0.0
+        # stmt.name -> [stmt, số lần chạy, tổng thời gian], chỉ dùng khi bật QUERY_REPEAT_LIMIT
+        self.statements = {}
+
+# Số liệu SQL của request hiện tại; run_in_threadpool chép context nên lệnh SQL chạy trong
+# threadpool vẫn cộng vào đúng request
+_request_db_stats = contextvars.ContextVar("request_db_stats", default=None)
+
+def _label_text(names, values):
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in values)
+    return ",".join(f'{name}="{value}"' for name, value in zip(names, escaped))
+
+def _sample(name, labels, value):
+    return f"{name}{{{labels}}} {value}" if labels else f"{name} {value}"
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self, out):
+        with self._lock:
+            items = sorted(self._values.items())
+        out.append(f"# HELP {self.name} {self.help}")
+        out.append(f"# TYPE {self.name} {self.type}")
+        for labels, value in items:
+            out.append(_sample(self.name, _label_text(self.labelnames, labels), value))
+
+class Gauge(Counter):
+    type = "gauge"
+
+class Histogram:
+    def __init__(self, name, help, labelnames, buckets):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self, out):
+        with self._lock:
+            items = sorted((labels, list(counts), total) for labels, (counts, total) in self._series.items())
+        out.append(f"# HELP {self.name} {self.help}")
+        out.append(f"# TYPE {self.name} histogram")
+        for labels, counts, total in items:
+            base = _label_text(self.labelnames, labels)
+            prefix = base + "," if base else ""
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                out.append(f'{self.name}_bucket{{{prefix}le="{le}"}} {cumulative}')
+            out.append(_sample(f"{self.name}_sum", base, round(total, 6)))
+            out.append(_sample(f"{self.name}_count", base, cumulative))
+
+HTTP_REQUEST_SECONDS = Histogram("http_request_duration_seconds", "Thời gian xử lý request theo route",
+                                 ("method", "route", "status"), LATENCY_BUCKETS)
+HTTP_REQUESTS_IN_PROGRESS = Gauge("http_requests_in_progress", "Số request đang xử lý")
+DB_QUERY_SECONDS = Histogram("db_query_duration_seconds", "Thời gian chạy từng câu lệnh SQL (đã chuẩn hóa)",
+                             ("statement",), QUERY_BUCKETS)
+DB_QUERY_ERRORS = Counter("db_query_errors_total", "Số câu lệnh SQL lỗi", ("statement",))
+DB_QUERIES_PER_REQUEST = Histogram("db_queries_per_request", "Số câu lệnh SQL mỗi request", ("route",),
+                                   QUERY_COUNT_BUCKETS)
+DB_SECONDS_PER_REQUEST = Histogram("db_time_per_request_seconds", "Tổng thời gian SQL mỗi request", ("route",),
+                                   LATENCY_BUCKETS)
+TEMPLATE_RENDER_SECONDS = Histogram("template_render_duration_seconds", "Thời gian render template",
+                                    ("template",), LATENCY_BUCKETS)
+CACHE_LOOKUPS = Counter("cache_lookups_total", "Số lần tra cache theo kết quả", ("cache", "result"))
+
+def record_query(stmt, elapsed, failed=False):
+    if METRICS_ENABLED:
+        DB_QUERY_SECONDS.observe((stmt.label,), elapsed)
+        if failed:
+            DB_QUERY_ERRORS.inc((stmt.label,))
+    stats = _request_db_stats.get()
+    if stats is None:
+        return
+    with stats.lock:
+        stats.queries += 1
+        stats.seconds += elapsed
+        if QUERY_REPEAT_LIMIT:
+            seen = stats.statements.get(stmt.name)
+            if seen is None:
+                stats.statements[stmt.name] = [stmt, 1, elapsed]
+            else:
+                seen[1] += 1
+                seen[2] += elapsed
+
+def route_label(scope):
+    # Route template (/products/{product_id}/detail) thay vì đường dẫn thật để số nhãn có giới hạn
+    route = scope.get("route")
+    if route is not None:
+        return route.path
+    path = scope.get("path", "")
+    for prefix in STATIC_PREFIXES:
+        if path.startswith(prefix + "/"):
+            return prefix
+    return "unmatched"
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        stats = RequestDBStats(scope)
+        token = _request_db_stats.set(stats)
+        HTTP_REQUESTS_IN_PROGRESS.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            HTTP_REQUESTS_IN_PROGRESS.inc(amount=-1)
+            _request_db_stats.reset(token)
+            route = route_label(scope)
+            if METRICS_ENABLED:
+                HTTP_REQUEST_SECONDS.observe((scope["method"], route, str(status[0])), elapsed)
+                DB_QUERIES_PER_REQUEST.observe((route,), stats.queries)
+                DB_SECONDS_PER_REQUEST.observe((route,), stats.seconds)
+            if QUERY_REPEAT_LIMIT:
+                report_repeated_queries(stats, route)
+
+class TimedTemplate(jinja2.Template):
+    # Dùng cho cả template nạp từ file lẫn bản biên dịch sẵn (ModuleLoader)
+    def render(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            TEMPLATE_RENDER_SECONDS.observe((self.name,), time.perf_counter() - started)
+
+def _render_values(out, name, help, type, samples):
+    # samples: [(tên nhãn, giá trị nhãn, giá trị)]
+    out.append(f"# HELP {name} {help}")
+    out.append(f"# TYPE {name} {type}")
+    for labelnames, labels, value in samples:
+        out.append(_sample(name, _label_text(labelnames, labels), value))
+
+def render_metrics():
+    out = []
+    for metric in (HTTP_REQUEST_SECONDS, HTTP_REQUESTS_IN_PROGRESS, DB_QUERY_SECONDS, DB_QUERY_ERRORS,
+                   DB_QUERIES_PER_REQUEST, DB_SECONDS_PER_REQUEST, TEMPLATE_RENDER_SECONDS, CACHE_LOOKUPS):
+        metric.render(out)
+    
+    pool = db_pool.metrics()
+    _render_values(out, "db_pool_connections", "Kết nối trong pool theo trạng thái", "gauge",
+                   [(("state",), (state,), pool[state]) for state in ("open", "idle", "in_use")])
+    _render_values(out, "db_pool_max_size", "Số kết nối tối đa của pool", "gauge", [((), (), pool["max_size"])])
+    for key, help in (("checkouts", "Số lần mượn kết nối"), ("waits", "Số lần phải chờ kết nối"),
+                      ("timeouts", "Số lần chờ kết nối quá hạn")):
+        _render_values(out, f"db_pool_{key}_total", help, "counter", [((), (), pool[key])])
+    _render_values(out, "db_pool_wait_seconds_total", "Tổng thời gian chờ kết nối", "counter",
+                   [((), (), pool["wait_time_total_ms"] / 1000)])
+    
+    statements = statement_registry.metrics()
+    _render_values(out, "statement_cache_size", "Số câu lệnh trong bộ đệm", "gauge", [((), (), statements["size"])])
+    _render_values(out, "statement_cache_lookups_total", "Số lần tra bộ đệm câu lệnh", "counter",
+                   [(("result",), ("hit",), statements["hits"]), (("result",), ("miss",), statements["misses"])])
+    _render_values(out, "statement_cache_evictions_total", "Số câu lệnh bị loại khỏi bộ đệm", "counter",
+                   [((), (), statements["evictions"])])
+    _render_values(out, "statement_prepared_executions_total", "Số lần chạy câu lệnh đã PREPARE (Postgres)",
+                   "counter", [((), (), statements["prepared_executions"])])
+    
+    events = event_broker.metrics()
+    _render_values(out, "sse_subscribers", "Số kết nối SSE đang mở", "gauge", [((), (), events["subscribers"])])
+    for key in ("published", "delivered", "dropped"):
+        _render_values(out, f"sse_events_{key}_total", f"Số sự kiện SSE ({key})", "counter", [((), (), events[key])])
+    
+    if write_queue is not None:
+        queue_stats = write_queue.metrics()
+        _render_values(out, "write_queue_depth", "Số yêu cầu ghi đang chờ", "gauge", [((), (), queue_stats["queued"])])
+        for key in ("writes", "batches", "failed"):
+            _render_values(out, f"write_queue_{key}_total", f"Hàng đợi ghi ({key})", "counter",
+                           [((), (), queue_stats[key])])
+    
+    _render_values(out, "process_start_time_seconds", "Thời điểm tiến trình khởi động", "gauge",
+                   [((), (), round(PROCESS_STARTED, 3))])
+    return "\n".join(out) + "\n"
+
+# ===== NHẬT KÝ TRUY VẤN CHẬM & N+1 =====
+# Mỗi sự kiện là một dòng JSON (ghi vào QUERY_LOG_PATH, mặc định stderr) để gom lại và phân tích sau:
+# - slow_query: câu lệnh chạy lâu hơn SLOW_QUERY_MS, kèm kiểu tham số (không ghi giá trị),
+#   route và kế hoạch thực thi (EXPLAIN) khi SLOW_QUERY_EXPLAIN=1
+# - repeated_query: trong một request, cùng một câu lệnh chạy quá QUERY_REPEAT_LIMIT lần
+#   (dấu hiệu N+1: truy vấn trong vòng lặp thay vì một câu gom nhóm)
+# Đặt SLOW_QUERY_MS=0 hoặc QUERY_REPEAT_LIMIT=0 để tắt từng loại.
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", "500"))
+SLOW_QUERY_EXPLAIN = os.environ.get("SLOW_QUERY_EXPLAIN", "1") == "1"
+QUERY_REPEAT_LIMIT = int(os.environ.get("QUERY_REPEAT_LIMIT", "20"))
+QUERY_LOG_PATH = os.environ.get("QUERY_LOG_PATH")
+SLOW_QUERY_SECONDS = SLOW_QUERY_MS / 1000 if SLOW_QUERY_MS > 0 else None
+_query_log_lock = threading.Lock()
+
+def write_query_log(event, **fields):
+    record = {"time": datetime.now().isoformat(timespec="milliseconds"), "event": event}
+    record.update(fields)
+    line = json.dumps(record, ensure_ascii=False, default=str) + "\n"
+    with _query_log_lock:
+        try:
+            if QUERY_LOG_PATH:
+                with open(QUERY_LOG_PATH, "a", encoding="utf-8") as f:
+                    f.write(line)
+            else:
+                sys.stderr.write(line)
+                sys.stderr.flush()
+        except OSError as e:
+            print(f"⚠️ Không ghi được nhật ký truy vấn: {e}")
+
+def params_shape(params):
+    # Chỉ ghi kiểu của từng tham số: giá trị có thể là mật khẩu, email...
+    if isinstance(params, dict):
+        return {key: type(value).__name__ for key, value in params.items()}
+    return [type(value).__name__ for value in params]
+
+def request_context():
+    stats = _request_db_stats.get()
+    if stats is None:
+        return {"route": None, "method": None}
+    return {"route": route_label(stats.scope), "method": stats.scope.get("method")}
+
+def explain_statement(conn, stmt, params, is_postgres):
+    # Chỉ EXPLAIN câu đọc; cursor riêng để không làm mất kết quả đang chờ fetch của cursor gốc
+    if not stmt.text.lstrip().upper().startswith(("SELECT", "WITH")):
+        return None
+    cursor = conn.cursor()
+    if not is_postgres:
+        try:
+            cursor.execute("EXPLAIN QUERY PLAN " + stmt.text, params)
+            return [row[3] for row in cursor.fetchall()]
+        except sqlite3.Error as e:
+            return [f"EXPLAIN lỗi: {e}"]
+    # Postgres: lỗi trong transaction làm hỏng cả transaction của request, nên bọc bằng SAVEPOINT
+    cursor.execute("SAVEPOINT slow_query_explain")
+    try:
+        cursor.execute("EXPLAIN " + stmt.text, tuple(params))
+        plan = [row[0] for row in cursor.fetchall()]
+    except Exception as e:
+        cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+        plan = [f"EXPLAIN lỗi: {e}"]
+    cursor.execute("RELEASE SAVEPOINT slow_query_explain")
+    return plan
+
+def log_slow_query(conn, stmt, params, elapsed, is_postgres):
+    plan = explain_statement(conn, stmt, params, is_postgres) if SLOW_QUERY_EXPLAIN and conn is not None else None
+    write_query_log("slow_query", statement=" ".join(stmt.text.split()), statement_id=stmt.name,
+                    params=params_shape(params), duration_ms=round(elapsed * 1000, 2), plan=plan,
+                    **request_context())
+
+def report_repeated_queries(stats, route):
+    for stmt, count, seconds in stats.statements.values():
+        if count > QUERY_REPEAT_LIMIT:
+            write_query_log("repeated_query", statement=" ".join(stmt.text.split()), statement_id=stmt.name,
+                            count=count, total_ms=round(seconds * 1000, 2), request_queries=stats.queries,
+                            route=route, method=stats.scope.get("method"))
+
+QUERY_LOG_ENABLED = SLOW_QUERY_SECONDS is not None or QUERY_REPEAT_LIMIT > 0
+
+if METRICS_ENABLED:
+    templates.env.template_class = TimedTemplate
+if METRICS_ENABLED or QUERY_LOG_ENABLED:
+    # Thêm sau cùng nên bọc ngoài CompressionMiddleware: thời gian tính cả bước nén
+    app.add_middleware(MetricsMiddleware)
+
 # ===== DATABASE CONFIG =====
 DATABASE_URL = os.environ.get("DATABASE_URL")
 IS_POSTGRES = False
@@ -49,23 +740,195 @@ else:
         except OSError:
             DB_PATH = os.path.join(tempfile.gettempdir(), 'database.db')
 
+# ===== STATEMENT REGISTRY =====
+# Mỗi câu SQL chỉ được dịch sang cú pháp của backend một lần rồi lưu trong LRU.
+# Trên Postgres câu lệnh DML được PREPARE một lần cho mỗi kết nối và chạy lại bằng EXECUTE
+# để tái sử dụng kế hoạch thực thi; SQLite dùng bộ đệm câu lệnh sẵn có (cached_statements).
+STATEMENT_CACHE_SIZE = int(os.environ.get("STATEMENT_CACHE_SIZE", "256"))
+PREPARABLE_KEYWORDS = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "VALUES")
+
+class Statement:
+    def __init__(self, sql, is_postgres):
+        self.name = "stmt_" + hashlib.sha1(sql.encode()).hexdigest()[:16]
+        # Nhãn cho số liệu/log: câu SQL gốc gộp khoảng trắng
+        self.label = " ".join(sql.split())[:METRICS_STATEMENT_LABEL_SIZE]
+        self.text, self.param_count = translate_sql(sql, "%s" if is_postgres else None)
+        if is_postgres:
+            # Bản dùng cho PREPARE: placeholder đánh số $1, $2...
+            self.prepare_text = translate_sql(sql, "$")[0]
+            self.preparable = (self.param_count > 0
+                               and sql.lstrip().split(None, 1)[0].upper() in PREPARABLE_KEYWORDS)
+        else:
+            self.preparable = False
+
+def translate_sql(sql, placeholder):
+    # Đổi ? thành placeholder của Postgres nhưng bỏ qua ? nằm trong chuỗi '...', tên "..." và comment.
+    # Với %s, psycopg2 định dạng cả câu bằng %, nên mọi dấu % đều phải nhân đôi.
+    if placeholder is None:
+        return sql, sql.count("?")
+    percent = "%%" if placeholder == "%s" else "%"
+    out = []
+    count = 0
+    i, n = 0, len(sql)
+    while i < n:
+        ch = sql[i]
+        if ch in "'\"":
+            end = sql.find(ch, i + 1)
+            while end != -1 and sql[end + 1:end + 2] == ch:
+                end = sql.find(ch, end + 2)
+            end = n if end == -1 else end + 1
+            out.append(sql[i:end].replace("%", percent))
+            i = end
+        elif sql.startswith("--", i):
+            end = sql.find("\n", i)
+            end = n if end == -1 else end
+            out.append(sql[i:end].replace("%", percent))
+            i = end
+        elif ch == "?":
+            count += 1
+            out.append(f"${count}" if placeholder == "$" else placeholder)
+            i += 1
+        elif ch == "%":
+            out.append(percent)
+            i += 1
+        else:
+            out.append(ch)
+            i += 1
+    text = "".join(out).replace('INTEGER PRIMARY KEY AUTOINCREMENT', 'SERIAL PRIMARY KEY')
+    return text, count
+
+class StatementRegistry:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        # Tên các câu lệnh đã PREPARE trên từng kết nối Postgres (mất theo kết nối)
+        self._prepared = weakref.WeakKeyDictionary()
+        # Câu lệnh PREPARE thất bại một lần thì luôn chạy trực tiếp
+        self._failed = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.prepares = 0
+        self.prepare_failures = 0
+        self.prepared_executions = 0
+
+    def get(self, sql, is_postgres):
+        key = (sql, is_postgres)
+        with self._lock:
+            stmt = self._cache.get(key)
+            if stmt is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return stmt
+            self.misses += 1
+        stmt = Statement(sql, is_postgres)
+        with self._lock:
+            self._cache[key] = stmt
+            if len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+                self.evictions += 1
+        return stmt
+
+    def execute_prepared(self, conn, cursor, stmt, params):
+        # Trả về False nếu câu lệnh không PREPARE được, khi đó gọi bên ngoài chạy trực tiếp
+        with self._lock:
+            prepared = self._prepared.get(conn)
+            if prepared is None:
+                prepared = self._prepared[conn] = OrderedDict()
+        if stmt.name not in prepared:
+            if stmt.name in self._failed:
+                return False
+            # SAVEPOINT để PREPARE lỗi (vd. không suy ra được kiểu tham số) không hủy cả transaction
+            cursor.execute("SAVEPOINT stmt_prepare")
+            try:
+                cursor.execute(f"PREPARE {stmt.name} AS {stmt.prepare_text}")
+            except Exception:
+                cursor.execute("ROLLBACK TO SAVEPOINT stmt_prepare")
+                with self._lock:
+                    self.prepare_failures += 1
+                    self._failed.add(stmt.name)
+                return False
+            cursor.execute("RELEASE SAVEPOINT stmt_prepare")
+            prepared[stmt.name] = True
+            with self._lock:
+                self.prepares += 1
+            if len(prepared) > self.max_size:
+                old_name, _ = prepared.popitem(last=False)
+                cursor.execute(f"DEALLOCATE {old_name}")
+        else:
+            prepared.move_to_end(stmt.name)
+        cursor.execute(f"EXECUTE {stmt.name} ({', '.join(['%s'] * stmt.param_count)})", params)
+        with self._lock:
+            self.prepared_executions += 1
+        return True
+
+    def metrics(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._cache),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+                "evictions": self.evictions,
+                "prepares": self.prepares,
+                "prepare_failures": self.prepare_failures,
+                "prepared_executions": self.prepared_executions,
+            }
+
+statement_registry = StatementRegistry(STATEMENT_CACHE_SIZE)
+
 # ===== DB WRAPPER (Để tương thích giữa SQLite và Postgres) =====
+# observer(sql, params, số giây) được gọi sau mỗi lệnh execute (kể cả khi lỗi), dùng cho
+# benchmark/đo đạc; danh sách rỗng thì không tốn gì thêm
+statement_observers = []
+
 class DBCursorWrapper:
-    def __init__(self, cursor, is_postgres):
+    def __init__(self, cursor, is_postgres, conn=None, prepare=True):
         self.cursor = cursor
         self.is_postgres = is_postgres
+        self.conn = conn
+        # prepare=False: named cursor (DECLARE ... CURSOR) không chạy được qua PREPARE/EXECUTE
+        self.prepare = prepare
         self.lastrowid = None
 
     def execute(self, sql, params=()):
+        stmt = statement_registry.get(sql, self.is_postgres)
+        if not (METRICS_ENABLED or QUERY_LOG_ENABLED or statement_observers):
+            self._execute(stmt, params)
+            return
+        started = time.perf_counter()
+        failed = True
+        try:
+            self._execute(stmt, params)
+            failed = False
+        finally:
+            elapsed = time.perf_counter() - started
+            record_query(stmt, elapsed, failed)
+            for observer in statement_observers:
+                observer(sql, params, elapsed)
+        if SLOW_QUERY_SECONDS is not None and elapsed >= SLOW_QUERY_SECONDS:
+            log_slow_query(self.conn, stmt, params, elapsed, self.is_postgres)
+
+    def _execute(self, stmt, params):
         if self.is_postgres:
-            # Thay thế placeholder ? của SQLite thành %s của Postgres
-            sql = sql.replace('?', '%s')
-            # Thay thế cú pháp AUTOINCREMENT
-            sql = sql.replace('INTEGER PRIMARY KEY AUTOINCREMENT', 'SERIAL PRIMARY KEY')
-            self.cursor.execute(sql, params)
+            params = tuple(params)
+            if not (stmt.preparable and self.prepare and self.conn is not None and len(params) == stmt.param_count
+                    and statement_registry.execute_prepared(self.conn, self.cursor, stmt, params)):
+                self.cursor.execute(stmt.text, params)
         else:
-            self.cursor.execute(sql, params)
+            self.cursor.execute(stmt.text, params)
             self.lastrowid = self.cursor.lastrowid
+
+    def executemany(self, sql, seq_of_params):
+        stmt = statement_registry.get(sql, self.is_postgres)
+        if self.is_postgres:
+            # executemany của psycopg2 gửi từng câu một; execute_batch gộp nhiều câu mỗi lượt
+            execute_batch(self.cursor, stmt.text, seq_of_params, page_size=500)
+        else:
+            self.cursor.executemany(stmt.text, seq_of_params)
     
     def fetchone(self):
         return self.cursor.fetchone()
@@ -77,41 +940,818 @@ class DBCursorWrapper:
         return getattr(self.cursor, name)
 
 class DBConnectionWrapper:
-    def __init__(self, conn, is_postgres):
+    def __init__(self, conn, is_postgres, pool=None):
         self.conn = conn
         self.is_postgres = is_postgres
+        self.pool = pool
 
     def cursor(self):
-        return DBCursorWrapper(self.conn.cursor(), self.is_postgres)
+        return DBCursorWrapper(self.conn.cursor(), self.is_postgres, self.conn)
 
     def commit(self):
         self.conn.commit()
 
+    def rollback(self):
+        self.conn.rollback()
+
     def close(self):
-        self.conn.close()
+        # Kết nối lấy từ pool được trả lại pool thay vì đóng hẳn
+        if self.conn is None:
+            return
+        if self.pool:
+            self.pool.release(self.conn)
+        else:
+            self.conn.close()
+        self.conn = None
+
+# ===== CONNECTION POOL =====
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "10"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "30"))
+
+class PoolTimeoutError(Exception):
+    pass
+
+class DBPool:
+    # Pool kết nối có giới hạn, dùng chung cho SQLite và PostgreSQL.
+    # Mỗi request mượn một kết nối riêng (không chia sẻ giữa các request),
+    # khi trả lại kết nối được rollback và giữ lại để dùng tiếp.
+    def __init__(self, connect, max_size, timeout):
+        self._connect = connect
+        self._idle = deque()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self.max_size = max_size
+        self.timeout = timeout
+        self.opened = 0
+        self.in_use = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    def acquire(self, blocking=True):
+        start = time.perf_counter()
+        if not self._slots.acquire(blocking=False):
+            if not blocking:
+                return None
+            with self._lock:
+                self.waits += 1
+            if not self._slots.acquire(timeout=self.timeout):
+                with self._lock:
+                    self.timeouts += 1
+                raise PoolTimeoutError(f"Hết kết nối trong pool sau {self.timeout}s")
+        waited = time.perf_counter() - start
+
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+            self.checkouts += 1
+            self.in_use += 1
+            self.wait_time_total += waited
+            self.wait_time_max = max(self.wait_time_max, waited)
+
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._lock:
+                    self.in_use -= 1
+                self._slots.release()
+                raise
+            with self._lock:
+                self.opened += 1
+        return conn
+
+    def release(self, conn):
+        try:
+            # Hủy giao dịch dang dở (ví dụ handler return sớm) trước khi cho mượn lại
+            conn.rollback()
+            reusable = not getattr(conn, "closed", False)
+        except Exception:
+            reusable = False
+
+        with self._lock:
+            self.in_use -= 1
+            if reusable:
+                self._idle.append(conn)
+            else:
+                self.opened -= 1
+        if not reusable:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        self._slots.release()
+
+    def metrics(self):
+        with self._lock:
+            return {
+                "backend": "postgres" if IS_POSTGRES else "sqlite",
+                "max_size": self.max_size,
+                "open": self.opened,
+                "idle": len(self._idle),
+                "in_use": self.in_use,
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "timeouts": self.timeouts,
+                "wait_time_total_ms": round(self.wait_time_total * 1000, 3),
+                "wait_time_max_ms": round(self.wait_time_max * 1000, 3),
+            }
+
+def _connect_postgres():
+    return psycopg2.connect(DATABASE_URL, cursor_factory=DictCursor)
+
+# WAL: đọc không chặn ghi và ngược lại; synchronous=NORMAL chỉ fsync khi checkpoint (an toàn
+# với WAL khi tiến trình chết, chỉ có thể mất transaction cuối khi mất điện); busy_timeout để
+# nhiều worker uvicorn chờ khóa ghi thay vì lỗi "database is locked"
+SQLITE_JOURNAL_MODE = os.environ.get("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+
+def _connect_sqlite():
+    # check_same_thread=False: dependency mượn kết nối ở threadpool còn handler
+    # chạy trên event loop; pool đảm bảo mỗi lúc chỉ một request dùng kết nối
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE,
+                           timeout=SQLITE_BUSY_TIMEOUT_MS / 1000)
+    conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA journal_mode = {SQLITE_JOURNAL_MODE}")
+    conn.execute(f"PRAGMA synchronous = {SQLITE_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}")
+    return conn
+
+db_pool = DBPool(_connect_postgres if IS_POSTGRES else _connect_sqlite, DB_POOL_SIZE, DB_POOL_TIMEOUT)
 
 def get_db_connection():
-    if IS_POSTGRES:
-        conn = psycopg2.connect(DATABASE_URL, cursor_factory=DictCursor)
-        return DBConnectionWrapper(conn, True)
-    else:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        return DBConnectionWrapper(conn, False)
+    return DBConnectionWrapper(db_pool.acquire(), IS_POSTGRES, db_pool)
 
-# ===== DATABASE SETUP =====
-def init_db():
+# ===== GHI TUẦN TỰ (SQLite) =====
+# SQLITE_WRITE_QUEUE=1: mọi phần ghi của request (db.write) được chuyển cho một luồng ghi duy
+# nhất giữ kết nối riêng. Luồng này gom các yêu cầu đang chờ (tối đa WRITE_BATCH_MAX, chờ thêm
+# WRITE_BATCH_WAIT_MS) vào một transaction, mỗi yêu cầu nằm trong SAVEPOINT riêng nên lỗi của
+# một request chỉ hủy phần của nó, rồi commit (fsync) một lần cho cả lô.
+SQLITE_WRITE_QUEUE = os.environ.get("SQLITE_WRITE_QUEUE") == "1"
+WRITE_BATCH_MAX = int(os.environ.get("WRITE_BATCH_MAX", "64"))
+WRITE_BATCH_WAIT_MS = float(os.environ.get("WRITE_BATCH_WAIT_MS", "1"))
 
-    
+class WriteRollback(Exception):
+    # Ném từ hàm ghi để hủy phần ghi của mình nhưng vẫn trả kết quả cho người gọi
+    def __init__(self, result=None):
+        super().__init__("write rolled back")
+        self.result = result
+
+def run_write(conn, fn, args):
+    # Chạy fn(cursor, ...) trên kết nối conn rồi commit (không qua luồng ghi)
     try:
-        conn = get_db_connection()
-    except Exception as e:
-        print(f"❌ Lỗi kết nối database: {e}")
+        result = fn(conn.cursor(), *args)
+    except WriteRollback as e:
+        conn.rollback()
+        return e.result
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+    return result
+
+class WriteQueue:
+    def __init__(self, connect, max_batch, max_wait):
+        self._connect = connect
+        self._jobs = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.writes = 0
+        self.batches = 0
+        self.failed = 0
+        self.largest_batch = 0
+
+    def submit(self, fn, *args):
+        future = Future()
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="sqlite-writer", daemon=True)
+                    self._thread.start()
+        self._jobs.put((fn, args, future))
+        return future
+
+    def stop(self):
+        # Ghi nốt các yêu cầu đã nhận rồi dừng luồng ghi
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._jobs.put(None)
+            thread.join()
+
+    def _run(self):
+        conn = DBConnectionWrapper(self._connect(), False)
+        try:
+            while True:
+                job = self._jobs.get()
+                if job is None:
+                    return
+                batch = [job]
+                deadline = time.perf_counter() + self.max_wait
+                while len(batch) < self.max_batch:
+                    try:
+                        job = self._jobs.get(timeout=max(deadline - time.perf_counter(), 0))
+                    except queue.Empty:
+                        break
+                    if job is None:
+                        self._jobs.put(None)
+                        break
+                    batch.append(job)
+                self._write_batch(conn, batch)
+        finally:
+            conn.close()
+
+    def _write_batch(self, conn, batch):
+        cursor = conn.cursor()
+        outcomes = []
+        try:
+            # IMMEDIATE: giữ khóa ghi ngay từ đầu, chờ theo busy_timeout nếu worker khác đang ghi
+            cursor.execute("BEGIN IMMEDIATE")
+            for fn, args, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                cursor.execute("SAVEPOINT write_job")
+                try:
+                    outcomes.append((future, fn(conn.cursor(), *args), None))
+                except WriteRollback as e:
+                    cursor.execute("ROLLBACK TO SAVEPOINT write_job")
+                    outcomes.append((future, e.result, None))
+                except Exception as e:
+                    cursor.execute("ROLLBACK TO SAVEPOINT write_job")
+                    outcomes.append((future, None, e))
+                cursor.execute("RELEASE SAVEPOINT write_job")
+            conn.commit()
+        except Exception as e:
+            # Commit (hoặc BEGIN) lỗi: cả lô không được ghi, báo lỗi cho mọi người gọi
+            conn.rollback()
+            self.failed += len(batch)
+            for fn, args, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self.writes += len(outcomes)
+        self.batches += 1
+        self.largest_batch = max(self.largest_batch, len(outcomes))
+        for future, result, error in outcomes:
+            if error is not None:
+                self.failed += 1
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def metrics(self):
+        return {
+            "enabled": True,
+            "writes": self.writes,
+            "batches": self.batches,
+            "failed": self.failed,
+            "largest_batch": self.largest_batch,
+            "avg_batch": round(self.writes / self.batches, 2) if self.batches else 0,
+            "queued": self._jobs.qsize(),
+        }
+
+write_queue = (WriteQueue(_connect_sqlite, WRITE_BATCH_MAX, WRITE_BATCH_WAIT_MS / 1000)
+               if SQLITE_WRITE_QUEUE and not IS_POSTGRES else None)
+
+# ===== ASYNC DATA ACCESS =====
+# Handler đều là async def: mọi lệnh SQL (sqlite3/psycopg2 đều blocking) được
+# đẩy sang threadpool để một truy vấn chậm không làm đứng cả event loop.
+DB_GATHER_CONNECTIONS = int(os.environ.get("DB_GATHER_CONNECTIONS", "4"))
+
+class AsyncDBCursor:
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    async def execute(self, sql, params=()):
+        await run_in_threadpool(self.cursor.execute, sql, params)
+
+    async def fetchone(self):
+        return await run_in_threadpool(self.cursor.fetchone)
+
+    async def fetchall(self):
+        return await run_in_threadpool(self.cursor.fetchall)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+def _run_queries(conn, queries):
+    results = {}
+    cursor = conn.cursor()
+    for name, sql, params, mode in queries:
+        cursor.execute(sql, params)
+        if mode == "value":
+            row = cursor.fetchone()
+            results[name] = row[0] if row else None
+        elif mode == "one":
+            results[name] = cursor.fetchone()
+        else:
+            results[name] = cursor.fetchall()
+    return results
+
+class AsyncDBConnection:
+    def __init__(self, conn):
+        self.conn = conn
+        self.is_postgres = conn.is_postgres
+
+    def cursor(self):
+        return AsyncDBCursor(self.conn.cursor())
+
+    async def commit(self):
+        await run_in_threadpool(self.conn.commit)
+
+    async def rollback(self):
+        await run_in_threadpool(self.conn.rollback)
+
+    async def write(self, fn, *args):
+        # Phần ghi của request: fn(cursor, ...) chạy rồi commit, trả về kết quả của fn.
+        # Bật hàng đợi ghi thì fn chạy trên luồng ghi (không thấy thay đổi chưa commit của kết
+        # nối request), nên mọi bước đọc-rồi-ghi cần nhất quán phải nằm trong fn.
+        if write_queue is not None:
+            return await asyncio.wrap_future(write_queue.submit(fn, *args))
+        return await run_in_threadpool(run_write, self.conn, fn, args)
+
+    async def run(self, fn, *args):
+        # Chạy một hàm đồng bộ fn(cursor, ...) trên kết nối của request trong threadpool,
+        # dùng cho các bước ghi nhiều lệnh (thống kê, giao dịch) trong cùng transaction
+        return await run_in_threadpool(fn, self.conn.cursor(), *args)
+
+    async def gather(self, queries):
+        # Chạy song song các truy vấn đọc độc lập: {tên: (sql, params, 'value'|'one'|'all')}.
+        # Kết nối phụ chỉ được mượn khi pool còn chỗ trống (không chờ) để tránh
+        # deadlock khi pool cạn; phần còn lại chạy tuần tự trên kết nối của request.
+        items = [(name, sql, params, mode) for name, (sql, params, mode) in queries.items()]
+        extra = []
+        for _ in range(min(DB_GATHER_CONNECTIONS, len(items)) - 1):
+            raw = await run_in_threadpool(db_pool.acquire, False)
+            if raw is None:
+                break
+            extra.append(DBConnectionWrapper(raw, IS_POSTGRES, db_pool))
+
+        conns = [self.conn] + extra
+        buckets = [items[i::len(conns)] for i in range(len(conns))]
+        try:
+            parts = await asyncio.gather(*(
+                run_in_threadpool(_run_queries, conn, bucket)
+                for conn, bucket in zip(conns, buckets) if bucket
+            ))
+        finally:
+            for conn in extra:
+                await run_in_threadpool(conn.close)
+
+        results = {}
+        for part in parts:
+            results.update(part)
+        return results
+
+@asynccontextmanager
+async def db_session():
+    if not _database_ready:
+        await run_in_threadpool(prepare_database)
+    conn = await run_in_threadpool(get_db_connection)
+    try:
+        yield AsyncDBConnection(conn)
+    finally:
+        await run_in_threadpool(conn.close)
+
+async def get_db():
+    # Dependency: một kết nối cho toàn bộ request, trả về pool khi xong
+    if not _database_ready:
+        await run_in_threadpool(prepare_database)
+    try:
+        conn = await run_in_threadpool(get_db_connection)
+    except PoolTimeoutError:
+        raise HTTPException(status_code=503, detail="Hệ thống đang bận, vui lòng thử lại")
+    try:
+        yield AsyncDBConnection(conn)
+    finally:
+        await run_in_threadpool(conn.close)
+
+# ===== DASHBOARD STATS =====
+# Bảng dashboard_stats giữ sẵn các bộ đếm theo phạm vi (scope):
+#   'all'        : toàn hệ thống (Admin)
+#   'user:<id>'  : sản phẩm do nhân viên <id> thêm (Staff)
+# Metric: status:<trạng thái>, category:<danh mục> (đã duyệt), low_stock,
+# approved_value (giá trị tồn kho đã duyệt, làm tròn tới đồng cho từng sản phẩm: chỉ cộng/trừ số
+# nguyên nên không tích lũy sai số dấu phẩy động, chính xác tới 9e15 đồng),
+# tx:<ngày> (số giao dịch trong ngày), role:<vai trò> (chỉ 'all').
+# Mọi thao tác ghi cộng/trừ delta trong cùng transaction nên dashboard chỉ cần
+# một truy vấn theo khóa chính, bất kể số lượng sản phẩm.
+STATS_PRODUCT_COLUMNS = "status, stock, min_stock, price, category, added_by"
+
+def stats_scopes(added_by):
+    return ["all", f"user:{added_by}"] if added_by else ["all"]
+
+def _add_product_deltas(deltas, product, sign):
+    if product is None:
+        return
+    status, stock, min_stock, price, category, added_by = tuple(product)
+    for scope in stats_scopes(added_by):
+        deltas[(scope, f"status:{status}")] = deltas.get((scope, f"status:{status}"), 0) + sign
+        if stock is not None and min_stock is not None and stock <= min_stock:
+            deltas[(scope, "low_stock")] = deltas.get((scope, "low_stock"), 0) + sign
+        if status == "approved":
+            deltas[(scope, f"category:{category}")] = deltas.get((scope, f"category:{category}"), 0) + sign
+            value = round((stock or 0) * float(price or 0))
+            deltas[(scope, "approved_value")] = deltas.get((scope, "approved_value"), 0) + sign * value
+
+def apply_stat_deltas(cursor, deltas):
+    for (scope, metric), value in deltas.items():
+        if not value:
+            continue
+        cursor.execute('''
+            INSERT INTO dashboard_stats (scope, metric, value) VALUES (?, ?, ?)
+            ON CONFLICT (scope, metric) DO UPDATE SET value = dashboard_stats.value + excluded.value
+        ''', (scope, metric, value))
+
+def apply_product_stats(cursor, before, after):
+    # before/after: bộ (status, stock, min_stock, price, category, added_by) hoặc None
+    deltas = {}
+    _add_product_deltas(deltas, before, -1)
+    _add_product_deltas(deltas, after, 1)
+    apply_stat_deltas(cursor, deltas)
+
+def apply_transaction_stats(cursor, added_by, day, count=1):
+    # day: ngày của created_at theo giờ database (created_at[:10]), khớp với rebuild_dashboard_stats
+    for scope in stats_scopes(added_by):
+        # Chỉ giữ bộ đếm của ngày hiện tại
+        cursor.execute("DELETE FROM dashboard_stats WHERE scope = ? AND metric >= 'tx:' AND metric < ?", (scope, f"tx:{day}"))
+    apply_stat_deltas(cursor, {(scope, f"tx:{day}"): count for scope in stats_scopes(added_by)})
+
+def record_transaction(cursor, product_id, type, quantity, user_id, notes, added_by, category):
+    created_at = db_now(cursor)
+    cursor.execute('''
+        INSERT INTO transactions (product_id, type, quantity, user_id, notes, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (product_id, type, quantity, user_id, notes, created_at))
+    apply_transaction_stats(cursor, added_by, created_at[:10])
+    rollup = {}
+    add_rollup_delta(rollup, created_at[:10], product_id, category, user_id, type, quantity)
+    apply_rollup_deltas(cursor, rollup)
+
+def read_dashboard_stats(cursor, user_id=None):
+    scopes = stats_scopes(user_id)
+    cursor.execute(
+        f"SELECT scope, metric, value FROM dashboard_stats WHERE scope IN ({', '.join('?' for _ in scopes)})",
+        scopes
+    )
+    stats = {scope: {} for scope in scopes}
+    for scope, metric, value in cursor.fetchall():
+        stats[scope][metric] = value
+    return stats
+
+def dashboard_stats_drift(cursor):
+    # So bộ đếm hiện tại với kết quả tính lại từ đầu; trả về {(scope, metric): (hiện tại, tính lại)}.
+    # Ghi vào transaction của cursor, người gọi phải rollback
+    def snapshot():
+        cursor.execute("SELECT scope, metric, value FROM dashboard_stats")
+        return {(scope, metric): value for scope, metric, value in cursor.fetchall()}
+    live = snapshot()
+    rebuild_dashboard_stats(cursor)
+    rebuilt = snapshot()
+    # tx:<ngày cũ> chỉ bị xóa khi có giao dịch mới, không phải lệch
+    today_metric = f"tx:{db_today(cursor)}"
+    return {key: (live.get(key, 0), rebuilt.get(key, 0)) for key in set(live) | set(rebuilt)
+            if live.get(key, 0) != rebuilt.get(key, 0) and (not key[1].startswith("tx:") or key[1] == today_metric)}
+
+def read_dashboard_today(cursor, user_id=None):
+    # Bộ đếm kèm ngày hiện tại theo database để chọn đúng khóa tx:<ngày>
+    return read_dashboard_stats(cursor, user_id), db_today(cursor)
+
+def rebuild_dashboard_stats(cursor):
+    # Tính lại toàn bộ bộ đếm từ dữ liệu gốc (khởi tạo lần đầu hoặc khi nghi ngờ lệch)
+    cursor.execute("DELETE FROM dashboard_stats")
+    
+    deltas = {}
+    cursor.execute(f"SELECT {STATS_PRODUCT_COLUMNS} FROM products")
+    for product in cursor.fetchall():
+        _add_product_deltas(deltas, product, 1)
+    
+    cursor.execute("SELECT role, COUNT(*) FROM users GROUP BY role")
+    for role, count in cursor.fetchall():
+        deltas[("all", f"role:{role}")] = count
+    
+    today_str = db_today(cursor)
+    cursor.execute('''
+        SELECT p.added_by, COUNT(*) FROM transactions t
+        JOIN products p ON t.product_id = p.id
+        WHERE t.created_at >= ? AND t.created_at < ?
+        GROUP BY p.added_by
+    ''', day_range(today_str))
+    for added_by, count in cursor.fetchall():
+        for scope in stats_scopes(added_by):
+            deltas[(scope, f"tx:{today_str}")] = deltas.get((scope, f"tx:{today_str}"), 0) + count
+    
+    deltas[("meta", "built")] = 1
+    apply_stat_deltas(cursor, deltas)
+
+# ===== TỔNG HỢP GIAO DỊCH THEO NGÀY (transactions_daily) =====
+# Mỗi dòng: (ngày, sản phẩm, danh mục, người thực hiện) -> số giao dịch, tổng nhập, tổng xuất.
+# Được cộng dồn cùng transaction với mỗi lần ghi giao dịch nên báo cáo/biểu đồ chỉ đọc bảng nhỏ này.
+# Danh mục là danh mục hiện tại của sản phẩm (sửa danh mục thì tính lại các dòng của sản phẩm đó).
+# Ngày lấy theo giờ của database (giống DATE(created_at)), chuỗi 'YYYY-MM-DD' trên cả hai backend.
+DAILY_DAY_EXPR = "CAST(DATE(t.created_at) AS TEXT)"
+
+def db_now(cursor):
+    # Thời điểm hiện tại theo database, dùng làm created_at để ngày trong rollup khớp với giao dịch
+    # (SQLite: UTC như DEFAULT CURRENT_TIMESTAMP; Postgres: theo múi giờ của phiên)
+    cursor.execute("SELECT CURRENT_TIMESTAMP")
+    value = cursor.fetchone()[0]
+    return value if isinstance(value, str) else value.strftime('%Y-%m-%d %H:%M:%S.%f')
+
+def db_today(cursor):
+    # Ngày hiện tại theo database: cùng cách tính với ngày của created_at/transactions_daily
+    return db_now(cursor)[:10]
+
+def add_rollup_delta(rollup, day, product_id, category, user_id, type, quantity, sign=1):
+    key = (day, product_id, category or "", user_id or 0)
+    count, qty_in, qty_out = rollup.get(key, (0, 0, 0))
+    rollup[key] = (count + sign,
+                   qty_in + (sign * quantity if type == "in" else 0),
+                   qty_out + (sign * quantity if type == "out" else 0))
+
+def apply_rollup_deltas(cursor, rollup):
+    if not rollup:
         return
+    cursor.executemany('''
+        INSERT INTO transactions_daily (day, product_id, category, user_id, tx_count, in_qty, out_qty)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (day, product_id, category, user_id) DO UPDATE SET
+            tx_count = transactions_daily.tx_count + excluded.tx_count,
+            in_qty = transactions_daily.in_qty + excluded.in_qty,
+            out_qty = transactions_daily.out_qty + excluded.out_qty
+    ''', [key + value for key, value in rollup.items()])
+
+def rebuild_transactions_daily(cursor, day_from=None, day_to=None, product_id=None):
+    # Tính lại rollup từ bảng transactions cho khoảng ngày [day_from, day_to] và/hoặc một sản phẩm
+    rollup_where, where, params = [], [], []
+    if day_from:
+        rollup_where.append("day >= ?")
+        where.append("t.created_at >= ?")
+        params.append(day_from)
+    if day_to:
+        rollup_where.append("day <= ?")
+        where.append("t.created_at < ?")
+        params.append(day_to)
+    if product_id is not None:
+        rollup_where.append("product_id = ?")
+        where.append("t.product_id = ?")
+        params.append(product_id)
+    
+    cursor.execute(f"DELETE FROM transactions_daily WHERE {' AND '.join(rollup_where) or '1=1'}", params)
+    if day_to:
+        params[1 if day_from else 0] = (datetime.strptime(day_to, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+    cursor.execute(f'''
+        INSERT INTO transactions_daily (day, product_id, category, user_id, tx_count, in_qty, out_qty)
+        SELECT {DAILY_DAY_EXPR}, COALESCE(t.product_id, 0), COALESCE(p.category, ''), COALESCE(t.user_id, 0),
+               COUNT(*),
+               SUM(CASE WHEN t.type = 'in' THEN t.quantity ELSE 0 END),
+               SUM(CASE WHEN t.type = 'out' THEN t.quantity ELSE 0 END)
+        FROM transactions t
+        LEFT JOIN products p ON p.id = t.product_id
+        WHERE {' AND '.join(where) or '1=1'}
+        GROUP BY {DAILY_DAY_EXPR}, COALESCE(t.product_id, 0), COALESCE(p.category, ''), COALESCE(t.user_id, 0)
+    ''', params)
 
+def backfill_transactions_daily(conn, day_from=None, day_to=None, window_days=31):
+    # Dựng lại rollup theo từng khoảng window_days ngày, commit sau mỗi khoảng để transaction không quá lớn
     cursor = conn.cursor()
-    # Users table
+    cursor.execute(f"SELECT MIN({DAILY_DAY_EXPR}), MAX({DAILY_DAY_EXPR}) FROM transactions t")
+    first, last = cursor.fetchone()
+    if first is None:
+        return 0
+    start = datetime.strptime(max(day_from or first, first), '%Y-%m-%d')
+    end = datetime.strptime(min(day_to or last, last), '%Y-%m-%d')
+    windows = 0
+    while start <= end:
+        stop = min(start + timedelta(days=window_days - 1), end)
+        rebuild_transactions_daily(cursor, start.strftime('%Y-%m-%d'), stop.strftime('%Y-%m-%d'))
+        bump_data_versions(cursor, "transactions")
+        conn.commit()
+        windows += 1
+        start = stop + timedelta(days=1)
+    return windows
+
+def _create_transactions_daily(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS transactions_daily (
+            day TEXT NOT NULL,
+            product_id INTEGER NOT NULL,
+            category TEXT NOT NULL DEFAULT '',
+            user_id INTEGER NOT NULL DEFAULT 0,
+            tx_count INTEGER NOT NULL DEFAULT 0,
+            in_qty INTEGER NOT NULL DEFAULT 0,
+            out_qty INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, product_id, category, user_id)
+        )
+    ''')
+    # Báo cáo theo ngày dùng khóa chính (day, ...); lọc theo danh mục/sản phẩm dùng hai index này
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_daily_category ON transactions_daily (category, day)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_daily_product ON transactions_daily (product_id, day)")
+    rebuild_transactions_daily(cursor)
+
+# ===== PHIÊN BẢN DỮ LIỆU (ETag / CONDITIONAL GET) =====
+# Bảng data_versions giữ một bộ đếm cho mỗi bảng dữ liệu và một bộ đếm chung 'all'.
+# Mọi thao tác ghi tăng bộ đếm trong cùng transaction; trang/API chỉ đọc tạo ETag từ
+# các bộ đếm nó phụ thuộc, nên request lặp lại với If-None-Match nhận 304 mà không
+# cần chạy truy vấn dữ liệu.
+DATA_VERSION_TABLES = ("products", "transactions", "users")
+
+def _etag_salt():
+    # Đổi giao diện (main.py, templates, manifest tài nguyên tĩnh) khi triển khai thì ETag cũ cũng mất hiệu lực
+    paths = [__file__, ASSET_MANIFEST_PATH] + [os.path.join("templates", name) for name in sorted(os.listdir("templates"))]
+    stamp = "|".join(f"{path}:{os.path.getmtime(path)}" for path in paths if os.path.isfile(path))
+    return hashlib.sha256(stamp.encode()).hexdigest()[:16]
+
+ETAG_SALT = os.environ.get("APP_VERSION") or _etag_salt()
+
+def _create_data_versions(cursor):
     cursor.execute('''
+        CREATE TABLE IF NOT EXISTS data_versions (
+            name TEXT PRIMARY KEY,
+            version BIGINT NOT NULL DEFAULT 0
+        )
+    ''')
+    # Bắt đầu từ thời điểm tạo: database dựng lại từ đầu không trùng ETag với database cũ
+    start = int(time.time())
+    for name in ("all",) + DATA_VERSION_TABLES:
+        cursor.execute("INSERT INTO data_versions (name, version) VALUES (?, ?) ON CONFLICT (name) DO NOTHING", (name, start))
+
+def bump_data_versions(cursor, *tables):
+    names = ("all",) + tables
+    cursor.execute(
+        f"UPDATE data_versions SET version = version + 1 WHERE name IN ({', '.join('?' for _ in names)})",
+        names
+    )
+
+def read_data_versions(cursor):
+    cursor.execute("SELECT name, version FROM data_versions")
+    return {name: version for name, version in cursor.fetchall()}
+
+def etag_headers(etag):
+    # private: nội dung phụ thuộc người dùng; no-cache: trình duyệt luôn hỏi lại bằng If-None-Match
+    return {"ETag": etag, "Cache-Control": "private, no-cache"}
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    # So sánh yếu: bỏ tiền tố W/
+    tags = [tag.strip()[2:] if tag.strip().startswith("W/") else tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or (etag[2:] if etag.startswith("W/") else etag) in tags
+
+async def check_etag(request: Request, db: "AsyncDBConnection", tables, user=None, *extra):
+    # Trả về (etag, response 304 hoặc None). Gọi trước khi chạy truy vấn dữ liệu của trang
+    versions = await db.run(read_data_versions)
+    parts = [ETAG_SALT, [versions.get(table, 0) for table in tables], list(extra)]
+    if user:
+        parts.append([user.get(key) for key in SESSION_FIELDS] + [user.get("session_epoch")])
+    etag = 'W/"' + hashlib.sha256(json.dumps(parts, default=str).encode()).hexdigest()[:32] + '"'
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        CACHE_LOOKUPS.inc(("etag", "hit"))
+        return etag, Response(status_code=304, headers=etag_headers(etag))
+    CACHE_LOOKUPS.inc(("etag", "miss"))
+    return etag, None
+
+# ===== TÌM KIẾM SẢN PHẨM (FULL-TEXT) =====
+# SQLite dùng bảng ảo FTS5 products_fts (rowid = products.id), Postgres dùng cột
+# products.search_vector (tsvector) + GIN index. Văn bản được bỏ dấu trước khi đưa
+# vào index để "dien tu" khớp với "Điện tử" (đ không tách dấu theo Unicode nên
+# không dựa vào tokenizer của database được).
+SEARCH_COLUMNS = ("name", "sku", "description", "supplier", "category")
+# Trọng số theo thứ tự SEARCH_COLUMNS: tsvector (A cao nhất) và bm25 của FTS5
+SEARCH_WEIGHTS = ("A", "A", "C", "B", "B")
+SEARCH_BM25_WEIGHTS = (10.0, 8.0, 1.0, 2.0, 4.0)
+SEARCH_VECTOR_SQL = " || ".join(f"setweight(to_tsvector('simple', ?), '{weight}')" for weight in SEARCH_WEIGHTS)
+SEARCH_FTS_INSERT = (f"INSERT INTO products_fts (rowid, {', '.join(SEARCH_COLUMNS)}) "
+                     f"VALUES (?, {', '.join('?' for _ in SEARCH_COLUMNS)})")
+SEARCH_BACKEND = "like"  # 'fts5' | 'tsvector' | 'like', xác định sau khi migrate
+
+def fold_text(text):
+    text = (text or "").lower().replace("đ", "d")
+    return "".join(ch for ch in unicodedata.normalize("NFD", text) if not unicodedata.combining(ch))
+
+def search_terms(search):
+    return re.findall(r"[a-z0-9]+", fold_text(search))
+
+def sync_product_search(cursor, product_id):
+    # Gọi sau khi thêm/sửa sản phẩm, trong cùng transaction
+    if SEARCH_BACKEND == "like":
+        return
+    cursor.execute(f"SELECT {', '.join(SEARCH_COLUMNS)} FROM products WHERE id = ?", (product_id,))
+    row = cursor.fetchone()
+    if row is None:
+        delete_product_search(cursor, product_id)
+        return
+    folded = [fold_text(value) for value in row]
+    if SEARCH_BACKEND == "fts5":
+        cursor.execute("DELETE FROM products_fts WHERE rowid = ?", (product_id,))
+        cursor.execute(SEARCH_FTS_INSERT, (product_id, *folded))
+    else:
+        # Trọng số: tên (A), SKU (A), nhà cung cấp và danh mục (B), mô tả (C)
+        cursor.execute(f"UPDATE products SET search_vector = {SEARCH_VECTOR_SQL} WHERE id = ?", (*folded, product_id))
+
+def bulk_sync_product_search(cursor, rows):
+    # rows: (id, *SEARCH_COLUMNS) của các sản phẩm vừa thêm
+    if SEARCH_BACKEND == "like" or not rows:
+        return
+    folded = [(product_id, *[fold_text(value) for value in values]) for product_id, *values in rows]
+    if SEARCH_BACKEND == "fts5":
+        cursor.executemany(SEARCH_FTS_INSERT, folded)
+    else:
+        cursor.executemany(f"UPDATE products SET search_vector = {SEARCH_VECTOR_SQL} WHERE id = ?",
+                           [(*values, product_id) for product_id, *values in folded])
+
+def delete_product_search(cursor, product_id):
+    # Postgres: search_vector nằm trên chính dòng products nên tự mất khi xóa
+    if SEARCH_BACKEND == "fts5":
+        cursor.execute("DELETE FROM products_fts WHERE rowid = ?", (product_id,))
+
+def product_search_sql(search):
+    # Trả về (join, join_params, where, where_params, sort_key, descending) cho truy vấn trên products p.
+    # sort_key kết hợp với p.id làm khóa phân trang keyset
+    terms = search_terms(search)
+    if SEARCH_BACKEND == "fts5" and terms:
+        # Mỗi từ khớp tiền tố, tất cả các từ đều phải có (AND); bm25 càng nhỏ càng liên quan
+        match = " ".join(f'"{term}"*' for term in terms)
+        join = f'''
+            JOIN (SELECT rowid AS match_id, bm25(products_fts, {', '.join(map(str, SEARCH_BM25_WEIGHTS))}) AS rank
+                  FROM products_fts WHERE products_fts MATCH ?) fts ON fts.match_id = p.id
+        '''
+        return join, [match], None, [], "fts.rank", False
+    if SEARCH_BACKEND == "tsvector" and terms:
+        join = "CROSS JOIN to_tsquery('simple', ?) AS search_query"
+        return (join, [" & ".join(f"{term}:*" for term in terms)],
+                "p.search_vector @@ search_query", [],
+                "ts_rank(p.search_vector, search_query)::float8", True)
+    like = f"%{search}%"
+    return ("", [], f"({' OR '.join(f'p.{column} LIKE ?' for column in SEARCH_COLUMNS)})",
+            [like] * len(SEARCH_COLUMNS), "p.last_updated", True)
+
+def _create_search_index(cursor):
+    if IS_POSTGRES:
+        cursor.execute("ALTER TABLE products ADD COLUMN IF NOT EXISTS search_vector tsvector")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_products_search ON products USING GIN (search_vector)")
+    else:
+        try:
+            cursor.execute(f'''
+                CREATE VIRTUAL TABLE IF NOT EXISTS products_fts
+                USING fts5({', '.join(SEARCH_COLUMNS)}, tokenize = 'unicode61 remove_diacritics 2')
+            ''')
+        except sqlite3.OperationalError as e:
+            print(f"⚠️ SQLite không hỗ trợ FTS5, tìm kiếm dùng LIKE: {e}")
+            return
+    
+    global SEARCH_BACKEND
+    SEARCH_BACKEND = detect_search_backend(cursor)
+    rebuild_product_search(cursor)
+
+def _add_category_to_search_index(cursor):
+    # products_fts tạo trước khi có cột category: FTS5 không thêm cột được nên tạo lại bảng
+    if not IS_POSTGRES:
+        cursor.execute("DROP TABLE IF EXISTS products_fts")
+    _create_search_index(cursor)
+
+def rebuild_product_search(cursor):
+    cursor.execute("SELECT id FROM products")
+    for (product_id,) in cursor.fetchall():
+        sync_product_search(cursor, product_id)
+
+def detect_search_backend(cursor):
+    if IS_POSTGRES:
+        cursor.execute("SELECT 1 FROM information_schema.columns WHERE table_name = 'products' AND column_name = 'search_vector'")
+        return "tsvector" if cursor.fetchone() else "like"
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'products_fts'")
+    return "fts5" if cursor.fetchone() else "like"
+
+# ===== DATABASE SETUP =====
+def _add_session_epoch(cursor):
+    # Database cũ chưa có cột session_epoch (dùng để thu hồi phiên đăng nhập)
+    if IS_POSTGRES:
+        cursor.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS session_epoch INTEGER DEFAULT 0")
+    else:
+        cursor.execute("PRAGMA table_info(users)")
+        if "session_epoch" not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute("ALTER TABLE users ADD COLUMN session_epoch INTEGER DEFAULT 0")
+
+def _reset_dashboard_stats(cursor):
+    # Bỏ dấu "đã dựng" để create_initial_data tính lại toàn bộ bộ đếm theo định dạng mới
+    cursor.execute("DELETE FROM dashboard_stats WHERE scope = 'meta'")
+
+def _update_sample_avatars(cursor):
+    # Trước đây chạy mỗi lần khởi động; database mới đã có avatar khi tạo tài khoản mẫu
+    cursor.execute("UPDATE users SET avatar = ? WHERE email = ?", ("/static/image/phuong.jpg", "admin@warehouse.com"))
+    cursor.execute("UPDATE users SET avatar = ? WHERE email = ?", ("/static/image/Thanh.jpg", "staff@warehouse.com"))
+
+# Mỗi migration: (phiên bản, mô tả, danh sách lệnh SQL hoặc hàm nhận cursor).
+# Chỉ thêm migration mới vào cuối, không sửa migration đã phát hành.
+MIGRATIONS = [
+    (1, "Tạo bảng users, products, transactions", [
+        '''
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             email TEXT UNIQUE NOT NULL,
@@ -124,10 +1764,9 @@ def init_db():
             status TEXT DEFAULT 'active',
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
-    ''')
-    
-    # Products table - ĐẦY ĐỦ CÁC CỘT
-    cursor.execute('''
+        ''',
+        # Products table - ĐẦY ĐỦ CÁC CỘT
+        '''
         CREATE TABLE IF NOT EXISTS products (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT NOT NULL,
@@ -150,9 +1789,8 @@ def init_db():
             FOREIGN KEY (added_by) REFERENCES users (id),
             FOREIGN KEY (approved_by) REFERENCES users (id)
         )
-    ''')
-    
-    cursor.execute('''
+        ''',
+        '''
         CREATE TABLE IF NOT EXISTS transactions (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             product_id INTEGER,
@@ -164,67 +1802,282 @@ def init_db():
             FOREIGN KEY (product_id) REFERENCES products (id),
             FOREIGN KEY (user_id) REFERENCES users (id)
         )
+        ''',
+    ]),
+    (2, "Thêm users.session_epoch", _add_session_epoch),
+    (3, "Bảng bộ đếm dashboard_stats", [
+        # Bộ đếm cho dashboard, cập nhật cùng transaction với các thao tác ghi
+        '''
+        CREATE TABLE IF NOT EXISTS dashboard_stats (
+            scope TEXT NOT NULL,
+            metric TEXT NOT NULL,
+            value DOUBLE PRECISION NOT NULL DEFAULT 0,
+            PRIMARY KEY (scope, metric)
+        )
+        ''',
+    ]),
+    (4, "Index cho các truy vấn thường dùng", [
+        # Danh sách duyệt sản phẩm: WHERE status = ? ORDER BY last_updated
+        "CREATE INDEX IF NOT EXISTS idx_products_status_updated ON products (status, last_updated)",
+        # Sản phẩm của nhân viên: WHERE added_by = ? AND status = ?
+        "CREATE INDEX IF NOT EXISTS idx_products_added_by_status ON products (added_by, status)",
+        "CREATE INDEX IF NOT EXISTS idx_products_category ON products (category)",
+        # Danh sách sản phẩm sắp xếp theo (last_updated, id)
+        "CREATE INDEX IF NOT EXISTS idx_products_updated ON products (last_updated, id)",
+        # Partial index cho sản phẩm sắp hết (stock <= min_stock không dùng được index thường)
+        "CREATE INDEX IF NOT EXISTS idx_products_low_stock ON products (status, stock) WHERE stock <= min_stock",
+        # Lịch sử giao dịch theo sản phẩm, theo người thực hiện và theo thời gian
+        "CREATE INDEX IF NOT EXISTS idx_transactions_product_created ON transactions (product_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_transactions_user ON transactions (user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_transactions_created ON transactions (created_at)",
+    ]),
+    (5, "Index tìm kiếm toàn văn cho sản phẩm", _create_search_index),
+    (6, "Bảng idempotency_keys cho API nhập/xuất kho hàng loạt", [
+        # Lưu kết quả theo khóa do máy quét gửi lên để lần gửi lại không bị áp dụng hai lần
+        '''
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            user_id INTEGER NOT NULL,
+            idem_key TEXT NOT NULL,
+            response TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, idem_key)
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created ON idempotency_keys (created_at)",
+    ]),
+    (7, "Bảng tổng hợp giao dịch theo ngày transactions_daily", _create_transactions_daily),
+    (8, "Bảng data_versions cho ETag", _create_data_versions),
+    (9, "Ảnh đại diện của tài khoản mẫu", _update_sample_avatars),
+    (10, "Giá trị tồn kho trong dashboard_stats làm tròn tới đồng", _reset_dashboard_stats),
+    (11, "Thêm danh mục vào index tìm kiếm", _add_category_to_search_index),
+]
+
+def get_schema_version(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
     ''')
-    
-    conn.commit()
-    conn.close()
-    print("✅ Đã tạo database mới với đầy đủ cột")
+    cursor.execute("SELECT MAX(version) FROM schema_version")
+    return cursor.fetchone()[0] or 0
 
-init_db()
+def run_migrations(conn):
+    cursor = conn.cursor()
+    current = get_schema_version(cursor)
+    conn.commit()
+    
+    applied = []
+    for version, description, steps in MIGRATIONS:
+        if version <= current:
+            continue
+        try:
+            if callable(steps):
+                steps(cursor)
+            else:
+                for sql in steps:
+                    cursor.execute(sql)
+            cursor.execute("INSERT INTO schema_version (version, description) VALUES (?, ?)", (version, description))
+            conn.commit()
+        except Exception:
+            # Một tiến trình khác có thể vừa chạy migration này
+            conn.rollback()
+            if get_schema_version(cursor) >= version:
+                continue
+            raise
+        applied.append(version)
+    return applied
 
 # ===== HELPER FUNCTIONS =====
+# Khoảng thời gian [ngày, ngày kế tiếp) để so sánh trực tiếp với created_at, dùng được index
+# (date(created_at) = ? buộc phải quét toàn bảng)
+def day_range(day_str):
+    start = datetime.strptime(day_str, '%Y-%m-%d')
+    return start.strftime('%Y-%m-%d'), (start + timedelta(days=1)).strftime('%Y-%m-%d')
+
+def parse_date_range(request: Request):
+    # Tham số from/to dạng YYYY-MM-DD (tính cả hai đầu); ném ValueError nếu sai định dạng
+    day_from = request.query_params.get("from") or None
+    day_to = request.query_params.get("to") or None
+    return (day_range(day_from)[0] if day_from else None,
+            day_range(day_to)[0] if day_to else None)
+
+# ===== PHÂN TRANG KEYSET =====
+# Phân trang theo con trỏ (giá trị khóa sắp xếp của dòng cuối) thay vì OFFSET:
+# mỗi trang chỉ đọc page_size + 1 dòng qua index, không phụ thuộc trang thứ mấy
+DEFAULT_PAGE_SIZE = int(os.environ.get("PAGE_SIZE", "50"))
+MAX_PAGE_SIZE = 200
+
+def get_page_size(request: Request, default: int = DEFAULT_PAGE_SIZE) -> int:
+    try:
+        size = int(request.query_params.get("page_size", default))
+    except ValueError:
+        size = default
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+def encode_cursor(values) -> str:
+    data = json.dumps(list(values), default=str, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+def decode_cursor(token: Optional[str]):
+    # Con trỏ hỏng/bị sửa thì coi như không có (quay về trang đầu)
+    if not token:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+    except (ValueError, TypeError):
+        return None
+    return values if isinstance(values, list) else None
+
+def keyset_query(keys, descending, after=None, before=None):
+    # keys: các biểu thức sắp xếp, cột cuối phải là khóa duy nhất (id).
+    # Trả về (điều kiện, tham số, ORDER BY, backwards); đi lùi thì đảo chiều sắp xếp
+    # rồi đảo lại kết quả trong build_page
+    backwards = bool(decode_cursor(before))
+    values = decode_cursor(before) if backwards else decode_cursor(after)
+    if values is not None and len(values) != len(keys):
+        values = None
+    desc = descending != backwards
+    direction = "DESC" if desc else "ASC"
+    order_by = ", ".join(f"{key} {direction}" for key in keys)
+    if values is None:
+        return None, [], order_by, False
+    condition = f"({', '.join(keys)}) {'<' if desc else '>'} ({', '.join('?' for _ in keys)})"
+    return condition, values, order_by, backwards
+
+def build_page(rows, page_size, key_of, has_cursor, backwards):
+    # rows được lấy với LIMIT page_size + 1 để biết còn trang kế hay không
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if backwards:
+        rows.reverse()
+    has_next = has_more or backwards
+    has_prev = has_more if backwards else has_cursor
+    return {
+        "items": rows,
+        "next_cursor": encode_cursor(key_of(rows[-1])) if rows and has_next else None,
+        "prev_cursor": encode_cursor(key_of(rows[0])) if rows and has_prev else None,
+    }
+
+def page_url(request: Request, **cursor) -> str:
+    # Giữ nguyên bộ lọc hiện tại, chỉ thay con trỏ
+    params = {k: v for k, v in request.query_params.items() if k not in ("after", "before")}
+    params.update({k: v for k, v in cursor.items() if v})
+    return f"{request.url.path}?{urlencode(params)}" if params else request.url.path
+
 def hash_password(password: str) -> str:
     return hashlib.sha256(password.encode()).hexdigest()
 
-def verify_user(email: str, password: str):
-    conn = get_db_connection()
-    cursor = conn.cursor()
+async def verify_user(email: str, password: str, db: "AsyncDBConnection"):
+    cursor = db.cursor()
     hashed_pw = hash_password(password)
     
-    cursor.execute('''
-        SELECT id, email, full_name, role, avatar, phone, address, status 
+    await cursor.execute(f'''
+        SELECT {SESSION_USER_COLUMNS}
         FROM users 
         WHERE email = ? AND password = ? AND status = 'active'
     ''', (email, hashed_pw))
     
-    user = cursor.fetchone()
-    conn.close()
+    user = await cursor.fetchone()
     
     if user:
-        return {
-            "id": user[0],
-            "email": user[1],
-            "full_name": user[2],
-            "role": user[3],
-            "avatar": user[4],
-            "phone": user[5],
-            "address": user[6],
-            "status": user[7]
-        }
+        return user_from_row(user)
     return None
 
-def get_current_user(request: Request):
-    user_id = request.cookies.get("user_id")
-    if not user_id:
+SESSION_USER_COLUMNS = "id, email, full_name, role, avatar, phone, address, status, session_epoch, created_at"
+
+def user_from_row(user):
+    return {
+        "id": user[0],
+        "email": user[1],
+        "full_name": user[2],
+        "role": user[3],
+        "avatar": user[4],
+        "phone": user[5],
+        "address": user[6],
+        "status": user[7],
+        "session_epoch": user[8] or 0,
+        "created_at": str(user[9]) if user[9] else None
+    }
+
+# ===== SESSION (cookie ký HMAC chỉ chứa id/epoch/hạn; thông tin user đọc theo khóa chính mỗi request) =====
+SESSION_COOKIE = "session"
+SECRET_KEY = os.environ.get("SECRET_KEY")
+if not SECRET_KEY:
+    # Khóa ngẫu nhiên: phiên đăng nhập sẽ mất khi khởi động lại, nên đặt SECRET_KEY khi triển khai
+    SECRET_KEY = secrets.token_hex(32)
+    print("⚠️ Chưa đặt SECRET_KEY, dùng khóa tạm thời cho phiên đăng nhập")
+
+# Thông tin user hiển thị trên trang, dùng khi tính ETag theo user
+SESSION_FIELDS = ("id", "email", "full_name", "role", "avatar", "phone", "address", "status", "created_at")
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+def _sign(payload: str) -> str:
+    return _b64encode(hmac.new(SECRET_KEY.encode(), payload.encode(), hashlib.sha256).digest())
+
+def create_session_token(user: dict, max_age: int) -> str:
+    # Cookie đọc được bằng base64 nên không chứa email/điện thoại/địa chỉ
+    data = {"id": user["id"], "epoch": user.get("session_epoch") or 0, "exp": int(time.time()) + max_age}
+    payload = _b64encode(json.dumps(data, ensure_ascii=False, separators=(",", ":"), default=str).encode())
+    return f"{payload}.{_sign(payload)}"
+
+def read_session_token(token: str):
+    try:
+        payload, signature = token.split(".", 1)
+        if not hmac.compare_digest(signature, _sign(payload)):
+            return None
+        data = json.loads(_b64decode(payload))
+    except (ValueError, TypeError):
+        return None
+    if data.get("exp", 0) < time.time():
+        return None
+    return data
+
+def set_session_cookie(response, user: dict, max_age: int):
+    response.set_cookie(
+        key=SESSION_COOKIE,
+        value=create_session_token(user, max_age),
+        max_age=max_age,
+        httponly=True,
+        secure=False
+    )
+
+async def get_current_user(request: Request, db: "AsyncDBConnection"):
+    token = request.cookies.get(SESSION_COOKIE)
+    if not token:
         return None
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM users WHERE id = ?', (user_id,))
-    user = cursor.fetchone()
-    conn.close()
+    data = read_session_token(token)
+    if not data:
+        return None
     
-    if user:
-        return dict(user)
-    return None
-
-# ===== INITIAL DATA =====
-def create_initial_data():
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    # Một lần đọc theo khóa chính lấy cả thông tin hiển thị lẫn epoch/trạng thái, không cache: đăng xuất
+    # mọi nơi, đổi mật khẩu, khóa tài khoản hay đổi vai trò có hiệu lực ngay trên mọi worker
+    cursor = db.cursor()
+    await cursor.execute(f'SELECT {SESSION_USER_COLUMNS} FROM users WHERE id = ?', (data["id"],))
+    row = await cursor.fetchone()
+    if row is None:
+        return None
+    user = user_from_row(row)
+    if user["session_epoch"] != data["epoch"] or user["status"] != "active":
+        return None
     
+    user["session_expires"] = data["exp"]
+    return user
+
+# ===== INITIAL DATA =====
+def create_initial_data(cursor):
+    # Chỉ ghi khi database còn trống hoặc chưa có bộ đếm dashboard; người gọi commit
+    seeded = False
     cursor.execute("SELECT COUNT(*) FROM users")
     if cursor.fetchone()[0] == 0:
+        seeded = True
         cursor.execute('''
             INSERT INTO users (email, password, full_name, role, avatar, phone, address)
             VALUES (?, ?, ?, ?, ?, ?, ?)
@@ -251,13 +2104,10 @@ def create_initial_data():
             "TP.HCM, Việt Nam"
         ))
         print("✅ Đã tạo tài khoản mẫu")
-    else:
-        # Cập nhật avatar admin nếu tài khoản đã tồn tại
-        cursor.execute("UPDATE users SET avatar = ? WHERE email = ?", ("/static/image/phuong.jpg", "admin@warehouse.com"))
-        cursor.execute("UPDATE users SET avatar = ? WHERE email = ?", ("/static/image/Thanh.jpg", "staff@warehouse.com"))
     
     cursor.execute("SELECT COUNT(*) FROM products")
     if cursor.fetchone()[0] == 0:
+        seeded = True
         sample_products = [
             ("Laptop Dell XPS 13", "Điện tử", "SKU-001", 15, 5, 25000000, "Dell Việt Nam", "USA", "Dell Inc.", "Công ty TNHH Dell VN", "Kệ A1", "Laptop cao cấp", "/static/img/products/laptop.png", "approved", 1, 1),
             ("Chuột không dây Logitech", "Phụ kiện", "SKU-002", 45, 20, 850000, "Logitech", "Switzerland", "Logitech International", "Công ty Logitech", "Kệ B2", "Chuột không dây", "/static/img/products/mouse.png", "approved", 2, 1),
@@ -270,134 +2120,957 @@ def create_initial_data():
                                      manufacturer, distributor, location, description, image_url, status, added_by, approved_by)
                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             ''', product)
+        rebuild_product_search(cursor)
         print("✅ Đã tạo sản phẩm mẫu")
     
-    conn.commit()
-    conn.close()
+    # Dựng bộ đếm dashboard lần đầu (database cũ) hoặc sau khi vừa thêm dữ liệu mẫu
+    cursor.execute("SELECT COUNT(*) FROM dashboard_stats WHERE scope = 'meta'")
+    if seeded or cursor.fetchone()[0] == 0:
+        rebuild_dashboard_stats(cursor)
+        print("✅ Đã dựng bộ đếm dashboard")
+    if seeded:
+        bump_data_versions(cursor, *DATA_VERSION_TABLES)
 
-create_initial_data()
+# ===== KHỞI ĐỘNG =====
+# Chạy một lần mỗi tiến trình (lifespan, hoặc request đầu tiên nếu môi trường không gửi
+# sự kiện lifespan). Database đã ở phiên bản mới nhất thì chỉ tốn một truy vấn đọc, không
+# ghi/commit gì. SEED_DB_SNAPSHOT (SQLite): file database dựng sẵn bằng
+# `python main.py seed-snapshot <file>`, được chép vào DB_PATH khi DB_PATH chưa tồn tại
+# (ví dụ /tmp trên Vercel) thay vì tạo bảng và dữ liệu mẫu từ đầu.
+SEED_DB_SNAPSHOT = os.environ.get("SEED_DB_SNAPSHOT")
+LATEST_SCHEMA_VERSION = MIGRATIONS[-1][0]
 
-# ===== ROUTES =====
-@app.get("/", response_class=HTMLResponse)
-async def home(request: Request):
-    user = get_current_user(request)
-    if user:
-        return RedirectResponse("/dashboard", status_code=302)
-    return RedirectResponse("/login", status_code=302)
+_database_ready = False
+_database_lock = threading.Lock()
 
-@app.get("/dashboard", response_class=HTMLResponse)
-async def dashboard(request: Request):
-    user = get_current_user(request)
-    if not user:
-        return RedirectResponse("/login", status_code=302)
-    
-    conn = get_db_connection()
-    cursor = conn.cursor()
+def restore_seed_snapshot():
+    if IS_POSTGRES or not SEED_DB_SNAPSHOT or os.path.exists(DB_PATH):
+        return False
+    if not os.path.isfile(SEED_DB_SNAPSHOT):
+        print(f"⚠️ Không tìm thấy SEED_DB_SNAPSHOT: {SEED_DB_SNAPSHOT}")
+        return False
+    tmp_path = f"{DB_PATH}.{secrets.token_hex(4)}.tmp"
+    shutil.copyfile(SEED_DB_SNAPSHOT, tmp_path)
+    try:
+        # link() không ghi đè: tiến trình khác đã tạo database trước thì giữ bản của nó
+        os.link(tmp_path, DB_PATH)
+    except FileExistsError:
+        return False
+    except OSError:
+        if os.path.exists(DB_PATH):
+            return False
+        os.replace(tmp_path, DB_PATH)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    print(f"✅ Đã chép database dựng sẵn từ {SEED_DB_SNAPSHOT}")
+    return True
+
+def database_is_current(cursor):
+    try:
+        cursor.execute('''
+            SELECT (SELECT MAX(version) FROM schema_version),
+                   (SELECT COUNT(*) FROM dashboard_stats WHERE scope = 'meta')
+        ''')
+    except Exception:
+        # Database mới chưa có bảng
+        return False
+    version, built = cursor.fetchone()
+    return version == LATEST_SCHEMA_VERSION and built > 0
+
+def prepare_database():
+    global _database_ready, SEARCH_BACKEND
+    if _database_ready:
+        return
+    with _database_lock:
+        if _database_ready:
+            return
+        restore_seed_snapshot()
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            if not database_is_current(cursor):
+                conn.rollback()
+                applied = run_migrations(conn)
+                if applied:
+                    print(f"✅ Đã cập nhật cấu trúc database lên phiên bản {applied[-1]}")
+                create_initial_data(cursor)
+                conn.commit()
+            SEARCH_BACKEND = detect_search_backend(cursor)
+        finally:
+            conn.close()
+        _database_ready = True
+
+@asynccontextmanager
+async def lifespan(app):
+    try:
+        await run_in_threadpool(prepare_database)
+    except Exception as e:
+        # Vẫn khởi động; request đầu tiên sẽ thử lại
+        print(f"❌ Lỗi kết nối database: {e}")
+    yield
+    if write_queue is not None:
+        await run_in_threadpool(write_queue.stop)
+
+app.router.lifespan_context = lifespan
+
+# ===== NHẬP SẢN PHẨM HÀNG LOẠT (CSV/XLSX) =====
+# File được đọc tuần tự theo từng khối IMPORT_CHUNK_SIZE dòng; mỗi khối kiểm tra SKU
+# bằng một truy vấn, ghi bằng executemany (SQLite) hoặc COPY (Postgres) rồi commit.
+# Khối <= 500 để số tham số của "sku IN (...)" nằm trong giới hạn 999 của SQLite cũ.
+IMPORT_CHUNK_SIZE = min(int(os.environ.get("IMPORT_CHUNK_SIZE", "500")), 500)
+IMPORT_MAX_ERRORS = 1000
+IMPORT_COLUMNS = ("name", "category", "sku", "stock", "min_stock", "price", "supplier",
+                  "supplier_country", "manufacturer", "distributor", "location",
+                  "description", "image_url")
+# Tiêu đề cột tiếng Việt (đã bỏ dấu) được chấp nhận thay cho tên cột gốc
+IMPORT_HEADER_ALIASES = {
+    "ten san pham": "name", "ten": "name", "danh muc": "category", "ma sku": "sku",
+    "ton kho": "stock", "so luong": "stock", "ton kho toi thieu": "min_stock",
+    "ton toi thieu": "min_stock", "gia": "price", "don gia": "price",
+    "nha cung cap": "supplier", "quoc gia": "supplier_country", "nha san xuat": "manufacturer",
+    "nha phan phoi": "distributor", "vi tri": "location", "vi tri kho": "location",
+    "mo ta": "description", "hinh anh": "image_url",
+}
+SKU_PATTERN = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._/-]{0,63}$")
+
+def _import_header(value):
+    key = " ".join(fold_text(str(value or "")).replace("_", " ").split())
+    column = key.replace(" ", "_")
+    return column if column in IMPORT_COLUMNS else IMPORT_HEADER_ALIASES.get(key)
+
+def iter_import_rows(file, filename):
+    # Sinh (số dòng, {cột: giá trị}) từ file tải lên mà không nạp cả file vào bộ nhớ
+    if filename.lower().endswith(".xlsx"):
+        if openpyxl is None:
+            raise ValueError("Máy chủ chưa cài openpyxl, vui lòng dùng file CSV")
+        workbook = openpyxl.load_workbook(file, read_only=True, data_only=True)
+        rows = workbook.active.iter_rows(values_only=True)
+    else:
+        workbook = None
+        rows = csv.reader(codecs.iterdecode(file, "utf-8-sig"))
+    try:
+        header = next(rows, None)
+        if not header:
+            raise ValueError("File không có dữ liệu")
+        columns = [_import_header(value) for value in header]
+        missing = {"name", "category", "sku"} - set(columns)
+        if missing:
+            raise ValueError(f"Thiếu cột bắt buộc: {', '.join(sorted(missing))}")
+        for line, values in enumerate(rows, start=2):
+            if all(value is None or str(value).strip() == "" for value in values):
+                continue
+            yield line, {col: value for col, value in zip(columns, values) if col}
+    finally:
+        if workbook is not None:
+            workbook.close()
+
+def _import_number(value, label, cast, default=None):
+    if value is None or str(value).strip() == "":
+        return default
+    try:
+        number = float(str(value).strip().replace(",", ""))
+    except ValueError:
+        raise ValueError(f"{label} không phải là số: {value}")
+    if number < 0:
+        raise ValueError(f"{label} không được âm")
+    if cast is int:
+        if not number.is_integer():
+            raise ValueError(f"{label} phải là số nguyên: {value}")
+        return int(number)
+    return number
+
+def parse_import_row(values):
+    # Trả về bộ giá trị theo IMPORT_COLUMNS hoặc ném ValueError kèm lý do
+    row = {}
+    for col in IMPORT_COLUMNS:
+        value = values.get(col)
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)  # Excel lưu số nguyên (vd. SKU 1001) dưới dạng 1001.0
+        row[col] = str(value).strip() if value is not None and str(value).strip() else None
+    for col, label in (("name", "Tên sản phẩm"), ("category", "Danh mục"), ("sku", "SKU")):
+        if not row[col]:
+            raise ValueError(f"Thiếu {label}")
+    if not SKU_PATTERN.match(row["sku"]):
+        raise ValueError("SKU chỉ gồm chữ, số và . _ / - (tối đa 64 ký tự)")
+    row["stock"] = _import_number(row["stock"], "Tồn kho", int, 0)
+    row["min_stock"] = _import_number(row["min_stock"], "Tồn kho tối thiểu", int, 5)
+    row["price"] = _import_number(row["price"], "Giá", float)
+    return tuple(row[col] for col in IMPORT_COLUMNS)
+
+def read_import_chunk(rows, report, seen_skus):
+    # Đọc tiếp tối đa IMPORT_CHUNK_SIZE dòng hợp lệ; dòng lỗi ghi thẳng vào báo cáo
+    chunk = []
+    for line, values in rows:
+        report["total_rows"] += 1
+        try:
+            row = parse_import_row(values)
+            if row[2] in seen_skus:
+                raise ValueError("SKU bị trùng với dòng khác trong file")
+        except ValueError as e:
+            add_import_error(report, line, values.get("sku"), str(e))
+            continue
+        seen_skus.add(row[2])
+        chunk.append((line, row))
+        if len(chunk) >= IMPORT_CHUNK_SIZE:
+            break
+    return chunk
+
+def add_import_error(report, line, sku, error):
+    report["error_count"] += 1
+    if len(report["errors"]) < IMPORT_MAX_ERRORS:
+        report["errors"].append({"row": line, "sku": None if sku is None else str(sku), "error": error})
+
+def import_product_chunk(cursor, chunk, user_id):
+    # Ghi một khối sản phẩm (trạng thái chờ duyệt) cùng giao dịch nhập kho ban đầu.
+    # Trả về (số sản phẩm đã thêm, danh sách (dòng, sku) bị trùng với database)
+    skus = [row[2] for _, row in chunk]
+    placeholders = ", ".join("?" for _ in skus)
+    cursor.execute(f"SELECT sku FROM products WHERE sku IN ({placeholders})", skus)
+    existing = {row[0] for row in cursor.fetchall()}
+    rows = [row + (user_id,) for _, row in chunk if row[2] not in existing]
+    duplicates = [(line, row[2]) for line, row in chunk if row[2] in existing]
+    if not rows:
+        return 0, duplicates
+    
+    columns = ", ".join(IMPORT_COLUMNS + ("added_by",))
+    if IS_POSTGRES:
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        buffer.seek(0)
+        # Ô rỗng không có nháy trong COPY CSV là NULL
+        cursor.copy_expert(f"COPY products ({columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+    else:
+        cursor.executemany(
+            f"INSERT INTO products ({columns}) VALUES ({', '.join('?' for _ in IMPORT_COLUMNS)}, ?)",
+            rows
+        )
     
-    # Thống kê khác nhau cho Admin và Staff
-    if user["role"] == "admin":
-        # Admin: sản phẩm chờ duyệt, đã duyệt
-        cursor.execute("SELECT COUNT(*) FROM products WHERE status = 'pending'")
-        pending_products = cursor.fetchone()[0]
+    skus = [row[2] for row in rows]
+    placeholders = ", ".join("?" for _ in skus)
+    cursor.execute(f"SELECT id, {', '.join(SEARCH_COLUMNS)} FROM products WHERE sku IN ({placeholders})", skus)
+    inserted = [tuple(row) for row in cursor.fetchall()]
+    bulk_sync_product_search(cursor, inserted)
+    
+    # Giao dịch nhập kho ban đầu cho cả khối bằng một câu INSERT ... SELECT
+    created_at = db_now(cursor)
+    cursor.execute(f'''
+        INSERT INTO transactions (product_id, type, quantity, user_id, notes, created_at)
+        SELECT id, 'in', stock, ?, 'Nhập hàng loạt: ' || name, ?
+        FROM products WHERE sku IN ({placeholders}) AND stock > 0
+    ''', [user_id, created_at] + skus)
+    
+    deltas = {}
+    rollup = {}
+    product_ids = {values[SEARCH_COLUMNS.index("sku")]: product_id for product_id, *values in inserted}
+    for row in rows:
+        _add_product_deltas(deltas, ("pending", row[3], row[4], row[5], row[1], user_id), 1)
+        if row[3] > 0:
+            add_rollup_delta(rollup, created_at[:10], product_ids[row[2]], row[1], user_id, "in", row[3])
+    apply_stat_deltas(cursor, deltas)
+    apply_rollup_deltas(cursor, rollup)
+    opening = sum(1 for row in rows if row[3] > 0)
+    if opening:
+        apply_transaction_stats(cursor, user_id, created_at[:10], count=opening)
+    bump_data_versions(cursor, "products", "transactions")
+    return len(rows), duplicates
+
+# ===== NHẬP/XUẤT KHO HÀNG LOẠT (API cho máy quét, tích hợp) =====
+# Mỗi dòng là một câu UPDATE có điều kiện (stock >= ? khi xuất) nên không cần đọc trước
+# và không bị tranh chấp khi nhiều request cùng xuất một sản phẩm. Cả lô nằm trong một transaction.
+STOCK_MOVEMENT_MAX_LINES = int(os.environ.get("STOCK_MOVEMENT_MAX_LINES", "1000"))
+IDEMPOTENCY_TTL_DAYS = int(os.environ.get("IDEMPOTENCY_TTL_DAYS", "7"))
+SUPPORTS_RETURNING = IS_POSTGRES or sqlite3.sqlite_version_info >= (3, 35, 0)
+
+def parse_stock_movement(line):
+    # Trả về (cột định danh, giá trị, loại, số lượng, ghi chú) hoặc ném ValueError
+    if not isinstance(line, dict):
+        raise ValueError("Dòng không hợp lệ")
+    if line.get("product_id") is not None:
+        try:
+            column, ident = "id", int(line["product_id"])
+        except (TypeError, ValueError):
+            raise ValueError("product_id không hợp lệ")
+    elif line.get("sku"):
+        column, ident = "sku", str(line["sku"]).strip()
+    else:
+        raise ValueError("Thiếu product_id hoặc sku")
+    type = line.get("type")
+    if type not in ("in", "out"):
+        raise ValueError("type phải là 'in' hoặc 'out'")
+    quantity = line.get("quantity")
+    if isinstance(quantity, bool) or not isinstance(quantity, int) or quantity <= 0:
+        raise ValueError("quantity phải là số nguyên dương")
+    notes = str(line.get("notes") or "Cập nhật hàng loạt qua API")
+    return column, ident, type, quantity, notes
+
+def stock_movement_error(cursor, column, ident, quantity, user):
+    # Chỉ đọc lại khi UPDATE không khớp dòng nào, để báo lý do
+    cursor.execute(f"SELECT stock, status, added_by FROM products WHERE {column} = ?", (ident,))
+    row = cursor.fetchone()
+    if row is None:
+        return "Không tìm thấy sản phẩm"
+    if user["role"] == "staff" and row[2] != user["id"]:
+        return "Không có quyền cập nhật sản phẩm này"
+    if row[1] != "approved":
+        return "Chỉ được cập nhật tồn kho sản phẩm đã duyệt"
+    return f"Không thể xuất {quantity} khi chỉ còn {row[0]}"
+
+def apply_stock_movements(cursor, movements, user):
+    # Trả về (kết quả từng dòng, các thay đổi tồn kho để thông báo); dòng lỗi không làm thay đổi dữ liệu
+    results = []
+    deltas = {}
+    rollup = {}
+    transactions = []
+    changes = []
+    tx_counts = {}
+    created_at = db_now(cursor)
+    for index, line in enumerate(movements):
+        try:
+            column, ident, type, quantity, notes = parse_stock_movement(line)
+        except ValueError as e:
+            results.append({"line": index, "status": "error", "error": str(e)})
+            continue
         
-        cursor.execute("SELECT COUNT(*) FROM products WHERE status = 'approved'")
-        approved_products = cursor.fetchone()[0]
+        change = quantity if type == "in" else -quantity
+        where = [f"{column} = ?", "status = 'approved'"]
+        params = [change, ident]
+        if type == "out":
+            where.append("stock >= ?")
+            params.append(quantity)
+        if user["role"] == "staff":
+            where.append("added_by = ?")
+            params.append(user["id"])
+        sql = f"UPDATE products SET stock = stock + ?, last_updated = CURRENT_TIMESTAMP WHERE {' AND '.join(where)}"
+        if SUPPORTS_RETURNING:
+            cursor.execute(f"{sql} RETURNING id, {STATS_PRODUCT_COLUMNS}", params)
+            row = cursor.fetchone()
+        else:
+            cursor.execute(sql, params)
+            row = None
+            if cursor.rowcount:
+                cursor.execute(f"SELECT id, {STATS_PRODUCT_COLUMNS} FROM products WHERE {column} = ?", (ident,))
+                row = cursor.fetchone()
         
-        cursor.execute("SELECT COUNT(*) FROM users WHERE role = 'staff'")
-        total_staff = cursor.fetchone()[0]
+        if row is None:
+            results.append({"line": index, "status": "error",
+                            "error": stock_movement_error(cursor, column, ident, quantity, user)})
+            continue
         
-        my_products = 0
-        my_pending = 0
+        product_id, status, stock, min_stock, price, category, added_by = tuple(row)
+        _add_product_deltas(deltas, (status, stock - change, min_stock, price, category, added_by), -1)
+        _add_product_deltas(deltas, (status, stock, min_stock, price, category, added_by), 1)
+        transactions.append((product_id, type, quantity, user["id"], notes, created_at))
+        add_rollup_delta(rollup, created_at[:10], product_id, category, user["id"], type, quantity)
+        tx_counts[added_by] = tx_counts.get(added_by, 0) + 1
+        results.append({"line": index, "status": "applied", "product_id": product_id, "stock": stock})
+        changes.append({"product_id": product_id, "type": type, "quantity": quantity, "stock": stock, "added_by": added_by})
+    
+    if transactions:
+        cursor.executemany('''
+            INSERT INTO transactions (product_id, type, quantity, user_id, notes, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', transactions)
+        apply_stat_deltas(cursor, deltas)
+        apply_rollup_deltas(cursor, rollup)
+        for added_by, count in tx_counts.items():
+            apply_transaction_stats(cursor, added_by, created_at[:10], count=count)
+    return results, changes
+
+def process_stock_movements(cursor, user, idem_key, movements, atomic):
+    # Trả về (body, replayed, commit, thay đổi tồn kho)
+    if idem_key:
+        # Mốc hết hạn theo giờ database, cùng nguồn với created_at (CURRENT_TIMESTAMP)
+        now = datetime.strptime(db_now(cursor)[:19], '%Y-%m-%d %H:%M:%S')
+        cutoff = (now - timedelta(days=IDEMPOTENCY_TTL_DAYS)).strftime('%Y-%m-%d %H:%M:%S')
+        cursor.execute("DELETE FROM idempotency_keys WHERE created_at < ?", (cutoff,))
+        # Giữ khóa ngay đầu transaction: request trùng khóa chạy song song sẽ chờ ở đây
+        cursor.execute(
+            "INSERT INTO idempotency_keys (user_id, idem_key) VALUES (?, ?) ON CONFLICT DO NOTHING",
+            (user["id"], idem_key)
+        )
+        if cursor.rowcount == 0:
+            cursor.execute("SELECT response FROM idempotency_keys WHERE user_id = ? AND idem_key = ?",
+                           (user["id"], idem_key))
+            stored = cursor.fetchone()
+            if stored is None or stored[0] is None:
+                return {"error": "Yêu cầu với khóa này đang được xử lý"}, True, False, []
+            return json.loads(stored[0]), True, False, []
+    
+    results, changes = apply_stock_movements(cursor, movements, user)
+    failed = sum(1 for result in results if result["status"] == "error")
+    if atomic and failed:
+        # Chế độ atomic: một dòng lỗi thì hủy cả lô (kể cả khóa idempotency)
+        for result in results:
+            if result["status"] == "applied":
+                result.update(status="rolled_back")
+                result.pop("stock")
+        return {"applied": 0, "failed": failed, "rolled_back": True, "results": results}, False, False, []
+    
+    body = {"applied": len(results) - failed, "failed": failed, "results": results}
+    if changes:
+        bump_data_versions(cursor, "products", "transactions")
+    if idem_key:
+        cursor.execute("UPDATE idempotency_keys SET response = ? WHERE user_id = ? AND idem_key = ?",
+                       (json.dumps(body), user["id"], idem_key))
+    return body, False, True, changes
+
+def write_stock_movements(cursor, user, idem_key, movements, atomic):
+    # Dùng với db.write: bỏ phần ghi (kể cả khóa idempotency) khi process_stock_movements không commit
+    body, replayed, commit, changes = process_stock_movements(cursor, user, idem_key, movements, atomic)
+    if not commit:
+        raise WriteRollback((body, replayed, changes))
+    return body, replayed, changes
+
+# ===== XUẤT DỮ LIỆU (STREAMING CSV/JSONL) =====
+# Dữ liệu được đọc từng lô từ cursor phía server (named cursor trên Postgres; SQLite vốn đọc
+# dần từng dòng) và ghi ra ngay, nên bộ nhớ không phụ thuộc số dòng và byte đầu tiên được gửi sớm.
+EXPORT_FETCH_SIZE = int(os.environ.get("EXPORT_FETCH_SIZE", "2000"))
+EXPORT_FLUSH_BYTES = 64 * 1024
+EXPORT_FORMATS = {
+    "csv": "text/csv; charset=utf-8",
+    "jsonl": "application/x-ndjson; charset=utf-8",
+}
+
+def stream_query(sql, params):
+    # Generator: dòng đầu là danh sách cột, sau đó là từng dòng dữ liệu.
+    # Dùng kết nối riêng từ pool (kết nối của request đã được trả lại trước khi stream chạy)
+    # Cursor đi qua DBCursorWrapper để câu lệnh xuất hiện trong /metrics, nhật ký truy vấn chậm
+    # và statement_observers như mọi truy vấn khác
+    conn = get_db_connection()
+    try:
+        if conn.is_postgres:
+            named = conn.conn.cursor(name=f"export_{secrets.token_hex(8)}")
+            named.itersize = EXPORT_FETCH_SIZE
+            cursor = DBCursorWrapper(named, True, conn.conn, prepare=False)
+        else:
+            cursor = conn.cursor()
+        cursor.execute(sql, params)
+        rows = cursor.fetchmany(EXPORT_FETCH_SIZE)
+        yield [column[0] for column in cursor.description]
+        while rows:
+            yield from rows
+            rows = cursor.fetchmany(EXPORT_FETCH_SIZE)
+    finally:
+        conn.close()
+
+def csv_chunks(rows):
+    # BOM để Excel nhận đúng tiếng Việt
+    buffer = io.StringIO()
+    buffer.write("\ufeff")
+    writer = csv.writer(buffer)
+    for index, row in enumerate(rows):
+        writer.writerow(row)
+        if index == 0 or buffer.tell() >= EXPORT_FLUSH_BYTES:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def jsonl_chunks(rows):
+    columns = None
+    lines = []
+    size = 0
+    for row in rows:
+        if columns is None:
+            columns = row
+            continue
+        line = json.dumps(dict(zip(columns, row)), ensure_ascii=False, default=str)
+        lines.append(line)
+        size += len(line) + 1
+        if size >= EXPORT_FLUSH_BYTES:
+            yield "\n".join(lines) + "\n"
+            lines, size = [], 0
+    if lines:
+        yield "\n".join(lines) + "\n"
+
+def export_response(sql, params, filename, fmt):
+    encode = csv_chunks if fmt == "csv" else jsonl_chunks
+    return StreamingResponse(
+        encode(stream_query(sql, params)),
+        media_type=EXPORT_FORMATS[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{filename}.{fmt}"'}
+    )
+
+# ===== ẢNH SẢN PHẨM (UPLOAD, ẢNH THU NHỎ, WEBP) =====
+# Ảnh tải lên được ghi theo từng khối vào MEDIA_DIR/<2 ký tự đầu>/<sha256>.<đuôi>:
+# cùng nội dung chỉ lưu một lần. Ảnh thu nhỏ (cùng định dạng và WebP) được tạo một lần
+# lúc tải lên; file <sha256>.json ghi lại kích thước/các bản đã tạo và được ghi sau cùng.
+IMAGE_MAX_BYTES = int(os.environ.get("IMAGE_MAX_BYTES", str(10 * 1024 * 1024)))
+IMAGE_CHUNK_SIZE = 64 * 1024
+IMAGE_WIDTHS = (160, 320, 640, 1280)
+IMAGE_WEBP_QUALITY = 80
+IMAGE_JPEG_QUALITY = 82
+MEDIA_URL = "/media"
+MEDIA_URL_PATTERN = re.compile(r"^/media/([0-9a-f]{2})/([0-9a-f]{64})\.(png|jpg|gif|webp)$")
+
+# Định dạng xác định theo byte đầu file, không tin Content-Type/đuôi file do client gửi.
+# Ảnh thu nhỏ dạng dự phòng (cho trình duyệt không hỗ trợ WebP) giữ định dạng gốc, GIF -> PNG
+IMAGE_FALLBACK_FORMATS = {"png": "png", "jpg": "jpg", "gif": "png", "webp": None}
+PIL_FORMATS = {"png": "PNG", "jpg": "JPEG", "webp": "WEBP"}
+
+# sha256 -> thông tin ảnh (đọc từ file .json), tránh đọc đĩa mỗi lần render
+_media_info_cache = {}
+
+class ImageTooLargeError(ValueError):
+    pass
+
+def detect_image_type(head):
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpg"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+def media_path(digest, name):
+    return os.path.join(MEDIA_DIR, digest[:2], name)
+
+def media_url(digest, name):
+    return f"{MEDIA_URL}/{digest[:2]}/{name}"
+
+def load_media_info(digest):
+    info = _media_info_cache.get(digest)
+    if info is None:
+        try:
+            with open(media_path(digest, f"{digest}.json"), encoding="utf-8") as f:
+                info = json.load(f)
+        except (OSError, ValueError):
+            return None
+        _media_info_cache[digest] = info
+    return info
+
+def _save_image(image, path, fmt):
+    # Ghi ra file tạm rồi đổi tên: request khác không bao giờ đọc được file ghi dở
+    tmp_path = f"{path}.{secrets.token_hex(4)}.tmp"
+    if fmt == "jpg":
+        image.convert("RGB").save(tmp_path, "JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True, progressive=True)
+    elif fmt == "webp":
+        image.save(tmp_path, "WEBP", quality=IMAGE_WEBP_QUALITY, method=4)
     else:
-        # Staff: sản phẩm của mình
-        cursor.execute("SELECT COUNT(*) FROM products WHERE added_by = ?", (user["id"],))
-        my_products = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM products WHERE added_by = ? AND status = 'pending'", (user["id"],))
-        my_pending = cursor.fetchone()[0]
+        image.save(tmp_path, PIL_FORMATS[fmt], optimize=True)
+    os.replace(tmp_path, path)
+
+def generate_image_variants(path, digest, ext):
+    # Trả về thông tin ảnh; không có Pillow thì chỉ dùng ảnh gốc
+    info = {"ext": ext, "width": None, "height": None, "widths": [], "fallback": None}
+    if Image is None:
+        return info
+    try:
+        with Image.open(path) as opened:
+            opened.load()
+            image = ImageOps.exif_transpose(opened)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        raise ValueError("File ảnh bị hỏng hoặc kích thước quá lớn")
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if "transparency" in image.info or image.mode in ("LA", "P") else "RGB")
+    
+    width, height = image.size
+    fallback = IMAGE_FALLBACK_FORMATS[ext]
+    info.update(width=width, height=height, fallback=fallback)
+    for target in sorted({min(w, width) for w in IMAGE_WIDTHS}):
+        resized = image if target == width else image.resize(
+            (target, max(1, round(height * target / width))), Image.LANCZOS)
+        _save_image(resized, media_path(digest, f"{digest}-{target}.webp"), "webp")
+        # Bản cùng kích thước ảnh gốc thì dùng luôn ảnh gốc
+        if fallback and target < width:
+            _save_image(resized, media_path(digest, f"{digest}-{target}.{fallback}"), fallback)
+        info["widths"].append(target)
+    return info
+
+def ingest_image_file(tmp_path, digest, ext):
+    # Đưa file (đã ghi xong ở tmp_path) vào kho ảnh. Trả về (thông tin, có trùng với ảnh đã lưu)
+    info = load_media_info(digest)
+    if info is not None:
+        return info, True
+    
+    path = media_path(digest, f"{digest}.{ext}")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(tmp_path, path)
+    try:
+        info = generate_image_variants(path, digest, ext)
+    except ValueError:
+        os.remove(path)
+        raise
+    info_path = media_path(digest, f"{digest}.json")
+    with open(f"{info_path}.tmp", "w", encoding="utf-8") as f:
+        json.dump(info, f)
+    os.replace(f"{info_path}.tmp", info_path)
+    _media_info_cache[digest] = info
+    return info, False
+
+async def store_uploaded_image(file: UploadFile):
+    # Ghi file tải lên theo từng khối (không giữ cả file trong RAM), băm sha256 trong lúc ghi
+    tmp_path = os.path.join(MEDIA_DIR, f".upload-{secrets.token_hex(8)}")
+    digest = hashlib.sha256()
+    size = 0
+    head = b""
+    try:
+        async with aiofiles.open(tmp_path, "wb") as out:
+            while True:
+                chunk = await file.read(IMAGE_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > IMAGE_MAX_BYTES:
+                    raise ImageTooLargeError(f"Ảnh vượt quá {IMAGE_MAX_BYTES // (1024 * 1024)} MB")
+                if len(head) < 16:
+                    head += chunk[:16 - len(head)]
+                digest.update(chunk)
+                await out.write(chunk)
         
-        pending_products = 0
-        approved_products = 0
-        total_staff = 0
+        ext = detect_image_type(head)
+        if ext is None:
+            raise ValueError("Chỉ hỗ trợ ảnh PNG, JPEG, GIF hoặc WebP")
+        digest = digest.hexdigest()
+        info, deduplicated = await run_in_threadpool(ingest_image_file, tmp_path, digest, ext)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
     
-    # Lấy số giao dịch hôm nay
-    today_str = datetime.now().strftime('%Y-%m-%d')
-    if user["role"] == "admin":
-        cursor.execute("SELECT COUNT(*) FROM transactions WHERE date(created_at) = ?", (today_str,))
-    else:
-        cursor.execute('''
-            SELECT COUNT(*) FROM transactions t 
-            JOIN products p ON t.product_id = p.id 
-            WHERE date(t.created_at) = ? AND p.added_by = ?
-        ''', (today_str, user["id"]))
-    transactions_today = cursor.fetchone()[0]
+    return {
+        "url": media_url(digest, f"{digest}.{ext}"),
+        "width": info["width"],
+        "height": info["height"],
+        "srcset": image_srcset(media_url(digest, f"{digest}.{ext}"), "webp"),
+        "deduplicated": deduplicated,
+    }
 
-    cursor.execute("SELECT COUNT(*) FROM products WHERE stock <= min_stock")
-    low_stock = cursor.fetchone()[0]
-    
-    cursor.execute("SELECT SUM(stock * COALESCE(price, 0)) FROM products WHERE status = 'approved'")
-    total_value = cursor.fetchone()[0] or 0
-    
-    # Lấy tổng số sản phẩm
-    if user["role"] == "admin":
-        cursor.execute("SELECT COUNT(*) FROM products WHERE status = 'approved'")
-        total_products = cursor.fetchone()[0]
-    else:
-        cursor.execute("SELECT COUNT(*) FROM products WHERE added_by = ? AND status = 'approved'", (user["id"],))
-        total_products = cursor.fetchone()[0]
-    
-    # Lấy danh sách categories cho biểu đồ
-    if user["role"] == "admin":
-        cursor.execute("SELECT category, COUNT(*) as count FROM products WHERE status = 'approved' GROUP BY category")
+def _media_variants(url):
+    # url ảnh trong kho -> (sha256, thông tin); None với ảnh ngoài kho (URL tự nhập, /static/...)
+    match = MEDIA_URL_PATTERN.match(url or "")
+    if not match:
+        return None, None
+    digest = match.group(2)
+    return digest, load_media_info(digest)
+
+def ingest_local_image(source):
+    # Đưa một file ảnh có sẵn trên đĩa vào kho ảnh, trả về URL mới
+    digest = hashlib.sha256()
+    with open(source, "rb") as f:
+        head = f.read(16)
+        f.seek(0)
+        for chunk in iter(lambda: f.read(IMAGE_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    ext = detect_image_type(head)
+    if ext is None:
+        raise ValueError("Chỉ hỗ trợ ảnh PNG, JPEG, GIF hoặc WebP")
+    digest = digest.hexdigest()
+    tmp_path = os.path.join(MEDIA_DIR, f".upload-{secrets.token_hex(8)}")
+    shutil.copyfile(source, tmp_path)
+    try:
+        ingest_image_file(tmp_path, digest, ext)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return media_url(digest, f"{digest}.{ext}")
+
+def image_srcset(url, fmt=None):
+    # Dùng trong template: srcset WebP (fmt="webp") hoặc theo định dạng gốc; rỗng nếu không có ảnh thu nhỏ
+    digest, info = _media_variants(url)
+    if not info or not info["widths"]:
+        return ""
+    entries = []
+    for width in info["widths"]:
+        if fmt == "webp":
+            entries.append(f"{media_url(digest, f'{digest}-{width}.webp')} {width}w")
+        elif info["fallback"]:
+            name = f"{digest}.{info['ext']}" if width == info["width"] else f"{digest}-{width}.{info['fallback']}"
+            entries.append(f"{media_url(digest, name)} {width}w")
+    return ", ".join(entries)
+
+def image_src(url, width):
+    # Ảnh thu nhỏ nhỏ nhất có chiều rộng >= width (định dạng gốc) làm src mặc định cho <img>
+    digest, info = _media_variants(url)
+    if not info or not info["fallback"]:
+        return asset_url(url)
+    for candidate in info["widths"]:
+        if candidate >= width and candidate < info["width"]:
+            return media_url(digest, f"{digest}-{candidate}.{info['fallback']}")
+    return url
+
+templates.env.globals.update(image_srcset=image_srcset, image_src=image_src)
+
+# ===== THỐNG KÊ THEO THỜI GIAN (biểu đồ) =====
+# Nhóm theo ngày/tuần/tháng đọc từ transactions_daily rồi gom nhóm bằng Python, nên kết quả
+# giống hệt nhau trên SQLite và Postgres. Nhóm theo giờ đọc thẳng transactions (dùng index
+# created_at) và chỉ cho phép khoảng ngắn. Chuỗi được lấp đủ các mốc rỗng rồi gộp bớt để không
+# vượt quá max_points điểm.
+STATS_BUCKETS = ("hour", "day", "week", "month")
+STATS_DEFAULT_DAYS = {"hour": 2, "day": 30, "week": 182, "month": 365}
+STATS_HOUR_MAX_DAYS = 31
+STATS_DEFAULT_POINTS = 120
+STATS_MAX_POINTS = 1000
+STATS_SERIES = ("transactions", "in_qty", "out_qty")
+HOUR_BUCKET_EXPR = ("to_char(t.created_at, 'YYYY-MM-DD HH24')" if IS_POSTGRES
+                    else "substr(t.created_at, 1, 13)")
+
+def bucket_label(value, bucket):
+    # value: 'YYYY-MM-DD' hoặc 'YYYY-MM-DD HH'
+    if bucket == "hour":
+        return f"{value[:13]}:00"
+    if bucket == "month":
+        return value[:7]
+    if bucket == "week":
+        day = datetime.strptime(value[:10], '%Y-%m-%d')
+        return (day - timedelta(days=day.weekday())).strftime('%Y-%m-%d')
+    return value[:10]
+
+def bucket_labels(day_from, day_to, bucket):
+    # Toàn bộ các mốc trong khoảng [day_from, day_to], kể cả mốc không có giao dịch
+    current = datetime.strptime(day_from, '%Y-%m-%d')
+    end = datetime.strptime(day_to, '%Y-%m-%d') + timedelta(days=1)
+    if bucket == "week":
+        current -= timedelta(days=current.weekday())
+    step = {"hour": timedelta(hours=1), "day": timedelta(days=1), "week": timedelta(days=7)}.get(bucket)
+    labels = []
+    while current < end:
+        labels.append(bucket_label(current.strftime('%Y-%m-%d %H'), bucket))
+        if step:
+            current += step
+        else:
+            current = current.replace(year=current.year + current.month // 12, month=current.month % 12 + 1, day=1)
+    return labels
+
+def downsample_series(labels, series, max_points):
+    # Gộp các mốc liền kề (cộng dồn) cho đến khi số điểm <= max_points; nhãn là mốc đầu của nhóm
+    factor = math.ceil(len(labels) / max_points) if labels else 1
+    if factor <= 1:
+        return labels, series, 1
+    return (labels[::factor],
+            {name: [sum(values[i:i + factor]) for i in range(0, len(values), factor)]
+             for name, values in series.items()},
+            factor)
+
+def load_time_series(cursor, bucket, day_from, day_to, category=None, product_id=None):
+    # Trả về {nhãn: [số giao dịch, nhập, xuất]}
+    totals = {}
+    if bucket == "hour":
+        where = ["t.created_at >= ?", "t.created_at < ?"]
+        params = [day_from, (datetime.strptime(day_to, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')]
+        join = ""
+        if category:
+            join = "JOIN products p ON p.id = t.product_id"
+            where.append("p.category = ?")
+            params.append(category)
+        if product_id:
+            where.append("t.product_id = ?")
+            params.append(product_id)
+        cursor.execute(f'''
+            SELECT {HOUR_BUCKET_EXPR} AS bucket, COUNT(*),
+                   SUM(CASE WHEN t.type = 'in' THEN t.quantity ELSE 0 END),
+                   SUM(CASE WHEN t.type = 'out' THEN t.quantity ELSE 0 END)
+            FROM transactions t {join}
+            WHERE {" AND ".join(where)}
+            GROUP BY {HOUR_BUCKET_EXPR}
+        ''', params)
     else:
-        cursor.execute("SELECT category, COUNT(*) as count FROM products WHERE added_by = ? AND status = 'approved' GROUP BY category", (user["id"],))
+        where = ["day >= ?", "day <= ?"]
+        params = [day_from, day_to]
+        if category:
+            where.append("category = ?")
+            params.append(category)
+        if product_id:
+            where.append("product_id = ?")
+            params.append(product_id)
+        cursor.execute(f'''
+            SELECT day, SUM(tx_count), SUM(in_qty), SUM(out_qty)
+            FROM transactions_daily
+            WHERE {" AND ".join(where)}
+            GROUP BY day
+        ''', params)
+    for value, count, qty_in, qty_out in cursor.fetchall():
+        bucket_totals = totals.setdefault(bucket_label(value, bucket), [0, 0, 0])
+        bucket_totals[0] += int(count or 0)
+        bucket_totals[1] += int(qty_in or 0)
+        bucket_totals[2] += int(qty_out or 0)
+    return totals
+
+def build_time_series(cursor, bucket, day_from, day_to, category=None, product_id=None, max_points=STATS_DEFAULT_POINTS):
+    totals = load_time_series(cursor, bucket, day_from, day_to, category, product_id)
+    labels = bucket_labels(day_from, day_to, bucket)
+    series = {name: [totals.get(label, (0, 0, 0))[i] for label in labels] for i, name in enumerate(STATS_SERIES)}
+    labels, series, factor = downsample_series(labels, series, max_points)
+    return {"bucket": bucket, "from": day_from, "to": day_to, "downsample_factor": factor,
+            "labels": labels, **series}
+
+# ===== THÔNG BÁO THỜI GIAN THỰC (SSE) =====
+# Pub/sub trong tiến trình: mỗi tab mở một kết nối /api/events, máy chủ chỉ đẩy sự kiện khi dữ
+# liệu thực sự thay đổi (thêm/duyệt/từ chối sản phẩm, nhập/xuất kho) thay vì để mọi tab hỏi
+# /api/pending-count mỗi 30 giây. Mỗi kết nối có hàng đợi giới hạn EVENT_QUEUE_SIZE sự kiện;
+# khi đầy, sự kiện mới bị bỏ và client nhận "resync" để tự tải lại số liệu.
+# Chạy nhiều worker thì mỗi worker có broker riêng; client vẫn đồng bộ lại khi kết nối lại.
+EVENT_QUEUE_SIZE = int(os.environ.get("EVENT_QUEUE_SIZE", "100"))
+EVENT_MAX_SUBSCRIBERS = int(os.environ.get("EVENT_MAX_SUBSCRIBERS", "1000"))
+EVENT_HEARTBEAT_SECONDS = float(os.environ.get("EVENT_HEARTBEAT_SECONDS", "15"))
+# Đóng kết nối định kỳ để client kết nối lại và phiên đăng nhập được kiểm tra lại
+EVENT_MAX_AGE_SECONDS = float(os.environ.get("EVENT_MAX_AGE_SECONDS", "600"))
+
+class EventSubscription:
+    def __init__(self, user, queue_size):
+        self.user_id = user["id"]
+        self.role = user["role"]
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.dropped = 0
+
+class EventBroker:
+    def __init__(self, queue_size, max_subscribers):
+        self.queue_size = queue_size
+        self.max_subscribers = max_subscribers
+        self._subscribers = set()
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+
+    def subscribe(self, user):
+        if len(self._subscribers) >= self.max_subscribers:
+            return None
+        subscription = EventSubscription(user, self.queue_size)
+        self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self._subscribers.discard(subscription)
+
+    def has_subscribers(self):
+        return bool(self._subscribers)
+
+    def publish(self, event, data, roles=(), user_ids=(), exclude_roles=()):
+        # Gọi trên event loop (sau commit). roles/user_ids: người nhận; cả hai rỗng = tất cả
+        self.published += 1
+        message = (event, json.dumps(data, ensure_ascii=False, default=str))
+        for subscription in list(self._subscribers):
+            if subscription.role in exclude_roles:
+                continue
+            if (roles or user_ids) and subscription.role not in roles and subscription.user_id not in user_ids:
+                continue
+            try:
+                subscription.queue.put_nowait(message)
+                self.delivered += 1
+            except asyncio.QueueFull:
+                subscription.dropped += 1
+                self.dropped += 1
+
+    def metrics(self):
+        return {"subscribers": len(self._subscribers), "published": self.published,
+                "delivered": self.delivered, "dropped": self.dropped}
+
+event_broker = EventBroker(EVENT_QUEUE_SIZE, EVENT_MAX_SUBSCRIBERS)
+
+async def event_stream(request: Request, subscription):
+    started = time.monotonic()
+    try:
+        yield "retry: 5000\n\n"
+        while time.monotonic() - started < EVENT_MAX_AGE_SECONDS:
+            try:
+                event, data = await asyncio.wait_for(subscription.queue.get(), EVENT_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                if await request.is_disconnected():
+                    break
+                yield ": ping\n\n"
+                continue
+            if subscription.dropped:
+                subscription.dropped = 0
+                yield "event: resync\ndata: {}\n\n"
+            yield f"event: {event}\ndata: {data}\n\n"
+    finally:
+        event_broker.unsubscribe(subscription)
+
+async def notify_product_event(db: "AsyncDBConnection", action, product_id, added_by, **extra):
+    # Gửi sự kiện sản phẩm và số sản phẩm chờ duyệt mới cho Admin và người thêm sản phẩm
+    if not event_broker.has_subscribers():
+        return
+    recipients = (added_by,) if added_by else ()
+    event_broker.publish("product", {"action": action, "product_id": product_id, **extra},
+                         roles=("admin",), user_ids=recipients)
+    stats = await db.run(read_dashboard_stats, added_by)
+    event_broker.publish("pending", {"admin_pending": int(stats["all"].get("status:pending", 0))}, roles=("admin",))
+    if added_by:
+        event_broker.publish("pending", {"staff_pending": int(stats[f"user:{added_by}"].get("status:pending", 0))},
+                             user_ids=recipients, exclude_roles=("admin",))
+
+def notify_stock_event(changes):
+    # changes: [{"product_id", "type", "quantity", "stock", "added_by"}]
+    if not changes or not event_broker.has_subscribers():
+        return
+    by_owner = {}
+    for change in changes:
+        by_owner.setdefault(change.pop("added_by"), []).append(change)
+    event_broker.publish("stock", {"changes": changes}, roles=("admin",))
+    for added_by, owned in by_owner.items():
+        if added_by:
+            event_broker.publish("stock", {"changes": owned}, user_ids=(added_by,), exclude_roles=("admin",))
+
+# ===== ROUTES =====
+@app.get("/", response_class=HTMLResponse)
+async def home(request: Request, db: AsyncDBConnection = Depends(get_db)):
+    user = await get_current_user(request, db)
+    if user:
+        return RedirectResponse("/dashboard", status_code=302)
+    return RedirectResponse("/login", status_code=302)
+
+@app.get("/dashboard", response_class=HTMLResponse)
+async def dashboard(request: Request, db: AsyncDBConnection = Depends(get_db)):
+    user = await get_current_user(request, db)
+    if not user:
+        return RedirectResponse("/login", status_code=302)
     
-    categories = [dict(row) for row in cursor.fetchall()]
+    # Bộ đếm đọc từ dashboard_stats (một truy vấn theo khóa chính); hai danh sách
+    # còn lại độc lập nên được chạy song song
+    is_admin = user["role"] == "admin"
+    added_by_filter = "" if is_admin else "WHERE p.added_by = ?"
+    params = () if is_admin else (user["id"],)
     
-    # Lấy giao dịch gần đây
-    if user["role"] == "admin":
-        cursor.execute('''
+    results = await db.gather({
+        "recent_transactions": (f'''
             SELECT t.*, p.name as product_name, u.full_name 
             FROM transactions t 
             LEFT JOIN products p ON t.product_id = p.id 
             LEFT JOIN users u ON t.user_id = u.id 
+            {added_by_filter}
             ORDER BY t.created_at DESC 
             LIMIT 10
-        ''')
-    else:
-        cursor.execute('''
-            SELECT t.*, p.name as product_name, u.full_name 
-            FROM transactions t 
-            LEFT JOIN products p ON t.product_id = p.id 
-            LEFT JOIN users u ON t.user_id = u.id 
-            WHERE p.added_by = ? 
-            ORDER BY t.created_at DESC 
-            LIMIT 10
-        ''', (user["id"],))
-    
-    recent_transactions = [dict(row) for row in cursor.fetchall()]
-    
-    # Lấy sản phẩm sắp hết
-    if user["role"] == "admin":
-        cursor.execute('''
-            SELECT name, stock, min_stock, supplier 
-            FROM products 
-            WHERE stock <= min_stock AND status = 'approved'
-            ORDER BY stock ASC 
-            LIMIT 10
-        ''')
-    else:
-        cursor.execute('''
+        ''', params, "all"),
+        "low_stock_items": (f'''
             SELECT name, stock, min_stock, supplier 
             FROM products 
-            WHERE stock <= min_stock AND status = 'approved' AND added_by = ?
+            WHERE stock <= min_stock AND status = 'approved' {"" if is_admin else "AND added_by = ?"}
             ORDER BY stock ASC 
             LIMIT 10
-        ''', (user["id"],))
+        ''', params, "all"),
+    })
+    stats, today_str = await db.run(read_dashboard_today, None if is_admin else user["id"])
+    
+    all_stats = stats["all"]
+    scope_stats = all_stats if is_admin else stats[f"user:{user['id']}"]
     
-    low_stock_items = [dict(row) for row in cursor.fetchall()]
+    # Thống kê khác nhau cho Admin và Staff
+    if is_admin:
+        pending_products = int(all_stats.get("status:pending", 0))
+        approved_products = int(all_stats.get("status:approved", 0))
+        total_staff = int(all_stats.get("role:staff", 0))
+        my_products = 0
+        my_pending = 0
+    else:
+        my_products = int(sum(v for k, v in scope_stats.items() if k.startswith("status:")))
+        my_pending = int(scope_stats.get("status:pending", 0))
+        pending_products = 0
+        approved_products = 0
+        total_staff = 0
     
-    conn.close()
+    total_products = int(scope_stats.get("status:approved", 0))
+    transactions_today = int(scope_stats.get(f"tx:{today_str}", 0))
+    low_stock = int(all_stats.get("low_stock", 0))
+    total_value = int(all_stats.get("approved_value", 0))
+    categories = [
+        {"category": k[len("category:"):], "count": int(v)}
+        for k, v in sorted(scope_stats.items()) if k.startswith("category:") and v > 0
+    ]
+    recent_transactions = [dict(row) for row in results["recent_transactions"]]
+    low_stock_items = [dict(row) for row in results["low_stock_items"]]
     
     return templates.TemplateResponse(
         "dashboard.html",
@@ -436,9 +3109,10 @@ async def login(
     request: Request,
     email: str = Form(...),
     password: str = Form(...),
-    remember: Optional[str] = Form(None)
+    remember: Optional[str] = Form(None),
+    db: AsyncDBConnection = Depends(get_db)
 ):
-    user = verify_user(email, password)
+    user = await verify_user(email, password, db)
     
     if not user:
         return templates.TemplateResponse(
@@ -451,74 +3125,86 @@ async def login(
         )
     
     response = RedirectResponse("/dashboard", status_code=302)
-    response.set_cookie(
-        key="user_id",
-        value=str(user["id"]),
-        max_age=86400 if remember else 3600,
-        httponly=True,
-        secure=False
-    )
+    set_session_cookie(response, user, 86400 if remember else 3600)
     
     return response
 
 # ===== NHÂN VIÊN: QUẢN LÝ SẢN PHẨM =====
+# Chỉ lấy các cột bảng sản phẩm cần hiển thị (không lấy search_vector, thông tin duyệt...)
+PRODUCT_LIST_COLUMNS = ", ".join(f"p.{col}" for col in (
+    "id", "name", "category", "sku", "stock", "min_stock", "price",
+    "location", "supplier", "description", "image_url", "status", "last_updated"))
+
 @app.get("/products", response_class=HTMLResponse)
-async def products_page(request: Request):
-    user = get_current_user(request)
+async def products_page(request: Request, db: AsyncDBConnection = Depends(get_db)):
+    user = await get_current_user(request, db)
     if not user:
         return RedirectResponse("/login", status_code=302)
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    etag, not_modified = await check_etag(request, db, ("products",), user)
+    if not_modified:
+        return not_modified
+    
+    cursor = db.cursor()
     
     search = request.query_params.get('search', '')
     category = request.query_params.get('category', '')
     min_stock_filter = request.query_params.get('min_stock', '')
     
+    where = []
+    params = []
+    join = ""
+    sort_key, descending = "p.last_updated", True
+    
     if user["role"] == "staff":
         # Nhân viên thấy: Sản phẩm đã duyệt (toàn bộ) HOẶC Sản phẩm do mình thêm (kể cả chưa duyệt)
-        query = '''
-            SELECT p.*, u.full_name as added_by_name, u2.full_name as approved_by_name 
-            FROM products p 
-            LEFT JOIN users u ON p.added_by = u.id 
-            LEFT JOIN users u2 ON p.approved_by = u2.id
-            WHERE (p.status = 'approved' OR p.added_by = ?)
-        '''
-        params = [user["id"]]
-    else:
-        # Admin thấy tất cả sản phẩm
-        query = '''
-            SELECT p.*, u.full_name as added_by_name, u2.full_name as approved_by_name 
-            FROM products p 
-            LEFT JOIN users u ON p.added_by = u.id 
-            LEFT JOIN users u2 ON p.approved_by = u2.id 
-            WHERE 1=1
-        '''
-        params = []
+        where.append("(p.status = 'approved' OR p.added_by = ?)")
+        params.append(user["id"])
+    # Admin thấy tất cả sản phẩm
     
     if search:
-        query += " AND (p.name LIKE ? OR p.sku LIKE ? OR p.description LIKE ? OR p.supplier LIKE ?)"
-        params.extend([f"%{search}%", f"%{search}%", f"%{search}%", f"%{search}%"])
+        # Tìm kiếm toàn văn, không phân biệt dấu, khớp tiền tố, sắp xếp theo độ liên quan
+        join, join_params, search_where, search_params, sort_key, descending = product_search_sql(search)
+        params = join_params + params
+        if search_where:
+            where.append(search_where)
+            params.extend(search_params)
     
     if category:
-        query += " AND p.category = ?"
+        where.append("p.category = ?")
         params.append(category)
     
     if min_stock_filter:
         if min_stock_filter == '5':
-            query += " AND p.stock <= 5"
+            where.append("p.stock <= 5")
         elif min_stock_filter == '10':
-            query += " AND p.stock <= 10"
-    
-    query += " ORDER BY p.last_updated DESC"
-    
-    cursor.execute(query, params)
-    products = [dict(row) for row in cursor.fetchall()]
+            where.append("p.stock <= 10")
+    
+    page_size = get_page_size(request)
+    after = request.query_params.get('after')
+    before = request.query_params.get('before')
+    keyset, keyset_params, order_by, backwards = keyset_query(
+        [sort_key, "p.id"], descending, after, before)
+    if keyset:
+        where.append(keyset)
+        params.extend(keyset_params)
+    
+    query = f'''
+        SELECT {PRODUCT_LIST_COLUMNS}, {sort_key} AS sort_key
+        FROM products p 
+        {join}
+        WHERE {" AND ".join(where) or "1=1"}
+        ORDER BY {order_by}
+        LIMIT ?
+    '''
     
-    cursor.execute("SELECT DISTINCT category FROM products ORDER BY category")
-    categories = [{"category": row[0]} for row in cursor.fetchall()]
+    await cursor.execute(query, params + [page_size + 1])
+    page = build_page([dict(row) for row in await cursor.fetchall()], page_size,
+                      lambda row: (row["sort_key"], row["id"]), bool(keyset), backwards)
+    products = page["items"]
     
-    conn.close()
+    await cursor.execute("SELECT DISTINCT category FROM products ORDER BY category")
+    categories = [{"category": row[0]} for row in await cursor.fetchall()]
     
     return templates.TemplateResponse(
         "products.html",
@@ -530,10 +3216,43 @@ async def products_page(request: Request):
             "categories": categories,
             "search": search,
             "selected_category": category,
-            "min_stock": min_stock_filter
-        }
+            "min_stock": min_stock_filter,
+            "page_size": page_size,
+            "next_url": page_url(request, after=page["next_cursor"]) if page["next_cursor"] else None,
+            "prev_url": page_url(request, before=page["prev_cursor"]) if page["prev_cursor"] else None
+        },
+        headers=etag_headers(etag)
     )
 
+def insert_product(cursor, values, user_id):
+    # values: (name, category, sku, stock, min_stock, price, supplier, supplier_country,
+    #          manufacturer, distributor, location, description, image_url)
+    name, category, sku, stock, min_stock, price = values[:6]
+    if IS_POSTGRES:
+        # Postgres cần RETURNING id để lấy ID vừa tạo
+        cursor.execute('''
+            INSERT INTO products 
+            (name, category, sku, stock, min_stock, price, supplier, supplier_country, 
+             manufacturer, distributor, location, description, image_url, added_by, status)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'pending')
+            RETURNING id
+        ''', values + (user_id,))
+        product_id = cursor.fetchone()[0]
+    else:
+        cursor.execute('''
+            INSERT INTO products 
+            (name, category, sku, stock, min_stock, price, supplier, supplier_country, 
+             manufacturer, distributor, location, description, image_url, added_by, status)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'pending')
+        ''', values + (user_id,))
+        product_id = cursor.lastrowid
+    
+    apply_product_stats(cursor, None, ("pending", stock, min_stock, price, category, user_id))
+    sync_product_search(cursor, product_id)
+    record_transaction(cursor, product_id, 'in', stock, user_id, f"Thêm sản phẩm mới: {name}", user_id, category)
+    bump_data_versions(cursor, "products", "transactions")
+    return product_id
+
 @app.post("/products/add")
 async def add_product(
     request: Request,
@@ -549,43 +3268,17 @@ async def add_product(
     distributor: str = Form(None),
     location: str = Form(None),
     description: str = Form(None),
-    image_url: str = Form(None)
+    image_url: str = Form(None),
+    db: AsyncDBConnection = Depends(get_db)
 ):
-    user = get_current_user(request)
+    user = await get_current_user(request, db)
     if not user:
         return RedirectResponse("/login", status_code=302)
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
     try:
-        if IS_POSTGRES:
-            # Postgres cần RETURNING id để lấy ID vừa tạo
-            cursor.execute('''
-                INSERT INTO products 
-                (name, category, sku, stock, min_stock, price, supplier, supplier_country, 
-                 manufacturer, distributor, location, description, image_url, added_by, status)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'pending')
-                RETURNING id
-            ''', (name, category, sku, stock, min_stock, price, supplier, supplier_country, 
-                  manufacturer, distributor, location, description, image_url, user["id"]))
-            product_id = cursor.fetchone()[0]
-        else:
-            cursor.execute('''
-                INSERT INTO products 
-                (name, category, sku, stock, min_stock, price, supplier, supplier_country, 
-                 manufacturer, distributor, location, description, image_url, added_by, status)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'pending')
-            ''', (name, category, sku, stock, min_stock, price, supplier, supplier_country, 
-                  manufacturer, distributor, location, description, image_url, user["id"]))
-            product_id = cursor.lastrowid
-            
-        cursor.execute('''
-            INSERT INTO transactions (product_id, type, quantity, user_id, notes)
-            VALUES (?, 'in', ?, ?, ?)
-        ''', (product_id, stock, user["id"], f"Thêm sản phẩm mới: {name}"))
-        
-        conn.commit()
+        product_id = await db.write(insert_product, (name, category, sku, stock, min_stock, price, supplier,
+                                                     supplier_country, manufacturer, distributor, location,
+                                                     description, image_url), user["id"])
     except Exception as e:
         print(f"Error adding product: {e}")
         return JSONResponse(status_code=400, content={"error": str(e)})
@@ -594,73 +3287,116 @@ async def add_product(
             status_code=400,
             content={"error": "SKU đã tồn tại!"}
         )
-    finally:
-        conn.close()
+    
+    await notify_product_event(db, "added", product_id, user["id"], name=name)
     
     return RedirectResponse("/products", status_code=302)
 
+@app.post("/products/import")
+async def import_products(request: Request, file: UploadFile = File(...), db: AsyncDBConnection = Depends(get_db)):
+    user = await get_current_user(request, db)
+    if not user:
+        return JSONResponse(status_code=401, content={"error": "Vui lòng đăng nhập"})
+    
+    report = {"total_rows": 0, "imported": 0, "error_count": 0, "errors": []}
+    seen_skus = set()
+    rows = iter_import_rows(file.file, file.filename or "")
+    try:
+        while True:
+            # Đọc/kiểm tra file trong threadpool, không chặn event loop
+            chunk = await run_in_threadpool(read_import_chunk, rows, report, seen_skus)
+            if not chunk:
+                break
+            try:
+                imported, duplicates = await db.write(import_product_chunk, chunk, user["id"])
+                report["imported"] += imported
+                for line, sku in duplicates:
+                    add_import_error(report, line, sku, "SKU đã tồn tại")
+            except Exception as e:
+                print(f"Error importing products: {e}")
+                for line, row in chunk:
+                    add_import_error(report, line, row[2], f"Lỗi ghi dữ liệu: {e}")
+    except ValueError as e:
+        # File sai định dạng/thiếu cột: các khối trước đó (nếu có) đã được lưu
+        report["error"] = str(e)
+    
+    if report["imported"]:
+        await notify_product_event(db, "imported", None, user["id"], count=report["imported"])
+    
+    report["errors"].sort(key=lambda error: error["row"])
+    return JSONResponse(status_code=400 if "error" in report else 200, content=report)
+
+@app.post("/products/images")
+async def upload_product_image(request: Request, file: UploadFile = File(...), db: AsyncDBConnection = Depends(get_db)):
+    # Trả về URL ảnh để điền vào image_url của sản phẩm
+    user = await get_current_user(request, db)
+    if not user:
+        return JSONResponse(status_code=401, content={"error": "Vui lòng đăng nhập"})
+    
+    try:
+        return await store_uploaded_image(file)
+    except ImageTooLargeError as e:
+        return JSONResponse(status_code=413, content={"error": str(e)})
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+
+def change_product_stock(cursor, user, product_id, type, quantity, notes):
+    # Cùng đường ghi với API nhập/xuất hàng loạt: UPDATE có điều kiện (stock >= ? khi xuất) nên hai
+    # request xuất đồng thời không thể làm tồn kho âm. Trả về (kết quả của dòng, thay đổi tồn kho)
+    movement = {"product_id": product_id, "type": type, "quantity": quantity, "notes": notes}
+    results, changes = apply_stock_movements(cursor, [movement], user)
+    if changes:
+        bump_data_versions(cursor, "products", "transactions")
+    return results[0], changes
+
 @app.post("/products/{product_id}/update")
 async def update_product(
     request: Request,
     product_id: int,
     stock_change: int = Form(...),
     type: str = Form(...),
-    notes: str = Form(...)
+    notes: str = Form(...),
+    db: AsyncDBConnection = Depends(get_db)
 ):
-    user = get_current_user(request)
+    user = await get_current_user(request, db)
     if not user:
         return RedirectResponse("/login", status_code=302)
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    # Quyền (nhân viên chỉ cập nhật sản phẩm của mình), trạng thái đã duyệt và đủ hàng đều được
+    # kiểm tra ngay trong câu UPDATE
+    result, changes = await db.write(change_product_stock, user, product_id, type, stock_change, notes)
+    if result["status"] == "error":
+        if result["error"] == "Không tìm thấy sản phẩm":
+            return RedirectResponse("/products", status_code=302)
+        return RedirectResponse(f"/products?error={result['error']}", status_code=302)
+    notify_stock_event(changes)
     
-    # Kiểm tra quyền: chỉ cập nhật sản phẩm đã approved hoặc của chính mình
-    cursor.execute("SELECT added_by, status FROM products WHERE id = ?", (product_id,))
+    return RedirectResponse("/products", status_code=302)
+
+def update_product_info(cursor, product_id, values):
+    # values: (name, category, price, image_url, description, supplier, location)
+    cursor.execute(f"SELECT {STATS_PRODUCT_COLUMNS} FROM products WHERE id = ?", (product_id,))
     product = cursor.fetchone()
-    
-    if not product:
-        conn.close()
-        return RedirectResponse("/products", status_code=302)
-    
-    # Nếu là nhân viên, chỉ được cập nhật sản phẩm của mình và đã approved
-    if user["role"] == "staff" and product[0] != user["id"]:
-        conn.close()
-        return RedirectResponse("/products?error=Không có quyền cập nhật sản phẩm này", status_code=302)
-    
-    # Chỉ cập nhật tồn kho cho sản phẩm đã approved
-    if product[1] != "approved":
-        conn.close()
-        return RedirectResponse("/products?error=Chỉ được cập nhật tồn kho sản phẩm đã duyệt", status_code=302)
-    
-    if type == 'in':
-        cursor.execute('''
-            UPDATE products 
-            SET stock = stock + ?, last_updated = CURRENT_TIMESTAMP
-            WHERE id = ?
-        ''', (stock_change, product_id))
-    else:
-        # Kiểm tra không xuất quá số lượng tồn
-        cursor.execute("SELECT stock FROM products WHERE id = ?", (product_id,))
-        current_stock = cursor.fetchone()[0]
-        if stock_change > current_stock:
-            conn.close()
-            return RedirectResponse(f"/products?error=Không thể xuất {stock_change} khi chỉ còn {current_stock}", status_code=302)
-        
-        cursor.execute('''
-            UPDATE products 
-            SET stock = stock - ?, last_updated = CURRENT_TIMESTAMP
-            WHERE id = ?
-        ''', (stock_change, product_id))
+    if product is None:
+        return None
     
     cursor.execute('''
-        INSERT INTO transactions (product_id, type, quantity, user_id, notes)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (product_id, type, stock_change, user["id"], notes))
-    
-    conn.commit()
-    conn.close()
-    
-    return RedirectResponse("/products", status_code=302)
+        UPDATE products 
+        SET name = ?, category = ?, price = ?, image_url = ?, description = ?, supplier = ?, location = ?, last_updated = CURRENT_TIMESTAMP
+        WHERE id = ?
+    ''', values + (product_id,))
+    
+    category, price = values[1], values[2]
+    after = (product["status"], product["stock"], product["min_stock"], price, category, product["added_by"])
+    apply_product_stats(cursor, product, after)
+    sync_product_search(cursor, product_id)
+    if category != product["category"]:
+        # Rollup theo ngày giữ danh mục hiện tại của sản phẩm
+        rebuild_transactions_daily(cursor, None, None, product_id)
+        bump_data_versions(cursor, "products", "transactions")
+    else:
+        bump_data_versions(cursor, "products")
+    return product
 
 @app.post("/products/{product_id}/edit")
 async def edit_product_info(
@@ -672,79 +3408,88 @@ async def edit_product_info(
     image_url: str = Form(None),
     description: str = Form(None),
     supplier: str = Form(None),
-    location: str = Form(None)
+    location: str = Form(None),
+    db: AsyncDBConnection = Depends(get_db)
 ):
-    user = get_current_user(request)
+    user = await get_current_user(request, db)
     if not user:
         return RedirectResponse("/login", status_code=302)
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    cursor = db.cursor()
     
-    cursor.execute("SELECT added_by, status FROM products WHERE id = ?", (product_id,))
-    product = cursor.fetchone()
+    await cursor.execute(f"SELECT {STATS_PRODUCT_COLUMNS} FROM products WHERE id = ?", (product_id,))
+    product = await cursor.fetchone()
     
     if not product:
-        conn.close()
         return RedirectResponse("/products", status_code=302)
     
     # Kiểm tra quyền: Admin hoặc người tạo ra sản phẩm mới được sửa
-    if user["role"] != "admin" and product[0] != user["id"]:
-        conn.close()
+    if user["role"] != "admin" and product["added_by"] != user["id"]:
         return RedirectResponse("/products?error=Không có quyền sửa sản phẩm này", status_code=302)
 
-    cursor.execute('''
-        UPDATE products 
-        SET name = ?, category = ?, price = ?, image_url = ?, description = ?, supplier = ?, location = ?, last_updated = CURRENT_TIMESTAMP
-        WHERE id = ?
-    ''', (name, category, price, image_url, description, supplier, location, product_id))
-    
-    conn.commit()
-    conn.close()
+    await db.write(update_product_info, product_id, (name, category, price, image_url, description, supplier, location))
     
     return RedirectResponse("/products", status_code=302)
 
+def remove_product(cursor, product_id):
+    cursor.execute(f"SELECT {STATS_PRODUCT_COLUMNS} FROM products WHERE id = ?", (product_id,))
+    product = cursor.fetchone()
+    if product is None:
+        return None
+    
+    # Giao dịch hôm nay của sản phẩm bị xóa cũng phải trừ khỏi bộ đếm
+    today_str = db_today(cursor)
+    cursor.execute(
+        "SELECT COUNT(*) FROM transactions WHERE product_id = ? AND created_at >= ? AND created_at < ?",
+        (product_id, *day_range(today_str))
+    )
+    transactions_today = cursor.fetchone()[0]
+    
+    cursor.execute("DELETE FROM products WHERE id = ?", (product_id,))
+    cursor.execute("DELETE FROM transactions WHERE product_id = ?", (product_id,))
+    cursor.execute("DELETE FROM transactions_daily WHERE product_id = ?", (product_id,))
+    
+    apply_product_stats(cursor, product, None)
+    delete_product_search(cursor, product_id)
+    if transactions_today:
+        apply_transaction_stats(cursor, product["added_by"], today_str, -transactions_today)
+    bump_data_versions(cursor, "products", "transactions")
+    return product
+
 @app.get("/products/{product_id}/delete")
-async def delete_product(request: Request, product_id: int):
-    user = get_current_user(request)
+async def delete_product(request: Request, product_id: int, db: AsyncDBConnection = Depends(get_db)):
+    user = await get_current_user(request, db)
     if not user:
         return RedirectResponse("/login", status_code=302)
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    cursor = db.cursor()
     
-    cursor.execute("SELECT added_by, status FROM products WHERE id = ?", (product_id,))
-    product = cursor.fetchone()
+    await cursor.execute(f"SELECT {STATS_PRODUCT_COLUMNS} FROM products WHERE id = ?", (product_id,))
+    product = await cursor.fetchone()
     
     if not product:
-        conn.close()
         return RedirectResponse("/products", status_code=302)
     
     # Nhân viên chỉ xóa được sản phẩm của mình và ở trạng thái pending
     if user["role"] == "staff":
-        if product[0] != user["id"] or product[1] != "pending":
-            conn.close()
+        if product["added_by"] != user["id"] or product["status"] != "pending":
             return RedirectResponse("/products?error=Không có quyền xóa sản phẩm này", status_code=302)
     
-    cursor.execute("DELETE FROM products WHERE id = ?", (product_id,))
-    cursor.execute("DELETE FROM transactions WHERE product_id = ?", (product_id,))
-    
-    conn.commit()
-    conn.close()
+    await db.write(remove_product, product_id)
+    await notify_product_event(db, "deleted", product_id, product["added_by"])
     
     return RedirectResponse("/products", status_code=302)
 
 # ===== THÔNG TIN CHI TIẾT SẢN PHẨM =====
 @app.get("/products/{product_id}/detail")
-async def product_detail(request: Request, product_id: int):
-    user = get_current_user(request)
+async def product_detail(request: Request, product_id: int, db: AsyncDBConnection = Depends(get_db)):
+    user = await get_current_user(request, db)
     if not user:
         return RedirectResponse("/login", status_code=302)
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    cursor = db.cursor()
     
-    cursor.execute('''
+    await cursor.execute('''
         SELECT p.*, u.full_name as added_by_name, u2.full_name as approved_by_name 
         FROM products p 
         LEFT JOIN users u ON p.added_by = u.id 
@@ -752,25 +3497,28 @@ async def product_detail(request: Request, product_id: int):
         WHERE p.id = ?
     ''', (product_id,))
     
-    product = cursor.fetchone()
+    product = await cursor.fetchone()
     
     if not product:
-        conn.close()
         return RedirectResponse("/products", status_code=302)
         
-    # Lấy lịch sử giao dịch
-    cursor.execute('''
-        SELECT t.*, u.full_name as user_name 
+    # Lịch sử giao dịch phân trang keyset theo (created_at, id), đi theo index (product_id, created_at)
+    page_size = get_page_size(request, 20)
+    keyset, keyset_params, order_by, backwards = keyset_query(
+        ["t.created_at", "t.id"], True,
+        request.query_params.get('after'), request.query_params.get('before'))
+    
+    await cursor.execute(f'''
+        SELECT t.id, t.type, t.quantity, t.notes, t.created_at, u.full_name as user_name 
         FROM transactions t 
         LEFT JOIN users u ON t.user_id = u.id 
-        WHERE t.product_id = ? 
-        ORDER BY t.created_at DESC 
-        LIMIT 20
-    ''', (product_id,))
-    
-    transactions = [dict(row) for row in cursor.fetchall()]
+        WHERE t.product_id = ? {"AND " + keyset if keyset else ""}
+        ORDER BY {order_by} 
+        LIMIT ?
+    ''', [product_id] + keyset_params + [page_size + 1])
     
-    conn.close()
+    page = build_page([dict(row) for row in await cursor.fetchall()], page_size,
+                      lambda row: (row["created_at"], row["id"]), bool(keyset), backwards)
     
     return templates.TemplateResponse(
         "product_detail.html",
@@ -779,30 +3527,34 @@ async def product_detail(request: Request, product_id: int):
             "title": f"Chi tiết: {product['name']}",
             "user": user,
             "product": dict(product),
-            "transactions": transactions
+            "transactions": page["items"],
+            "page_size": page_size,
+            "next_url": page_url(request, after=page["next_cursor"]) if page["next_cursor"] else None,
+            "prev_url": page_url(request, before=page["prev_cursor"]) if page["prev_cursor"] else None
         }
     )
 
 # ===== ADMIN: DUYỆT SẢN PHẨM =====
 @app.get("/admin/approve-products", response_class=HTMLResponse)
-async def admin_approve_products(request: Request):
-    user = get_current_user(request)
+async def admin_approve_products(request: Request, db: AsyncDBConnection = Depends(get_db)):
+    user = await get_current_user(request, db)
     if not user or user["role"] != "admin":
         return RedirectResponse("/login", status_code=302)
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    etag, not_modified = await check_etag(request, db, ("products", "users"), user)
+    if not_modified:
+        return not_modified
     
-    cursor.execute('''
+    cursor = db.cursor()
+    
+    await cursor.execute('''
         SELECT p.*, u.full_name as added_by_name, u.phone, u.email
         FROM products p 
         LEFT JOIN users u ON p.added_by = u.id
         WHERE p.status = 'pending'
         ORDER BY p.last_updated DESC
     ''')
-    pending_products = [dict(row) for row in cursor.fetchall()]
-    
-    conn.close()
+    pending_products = [dict(row) for row in await cursor.fetchall()]
     
     return templates.TemplateResponse(
         "admin_approve.html",
@@ -811,63 +3563,66 @@ async def admin_approve_products(request: Request):
             "title": "Duyệt sản phẩm",
             "user": user,
             "pending_products": pending_products
-        }
+        },
+        headers=etag_headers(etag)
     )
 
-@app.post("/admin/products/{product_id}/approve")
-async def approve_product(request: Request, product_id: int):
-    user = get_current_user(request)
-    if not user or user["role"] != "admin":
-        return RedirectResponse("/login", status_code=302)
-    
-    conn = get_db_connection()
-    cursor = conn.cursor()
+def set_product_status(cursor, product_id, status, admin_id):
+    # Duyệt/từ chối sản phẩm, trả về sản phẩm trước khi đổi (None nếu không tồn tại)
+    cursor.execute(f"SELECT {STATS_PRODUCT_COLUMNS} FROM products WHERE id = ?", (product_id,))
+    product = cursor.fetchone()
+    if product is None:
+        return None
     
     cursor.execute('''
         UPDATE products 
-        SET status = 'approved', approved_by = ?, last_updated = CURRENT_TIMESTAMP
+        SET status = ?, approved_by = ?, last_updated = CURRENT_TIMESTAMP
         WHERE id = ?
-    ''', (user["id"], product_id))
+    ''', (status, admin_id, product_id))
     
-    conn.commit()
-    conn.close()
+    apply_product_stats(cursor, product, (status,) + tuple(product)[1:])
+    bump_data_versions(cursor, "products")
+    return product
+
+@app.post("/admin/products/{product_id}/approve")
+async def approve_product(request: Request, product_id: int, db: AsyncDBConnection = Depends(get_db)):
+    user = await get_current_user(request, db)
+    if not user or user["role"] != "admin":
+        return RedirectResponse("/login", status_code=302)
+    
+    product = await db.write(set_product_status, product_id, "approved", user["id"])
+    if product:
+        await notify_product_event(db, "approved", product_id, product["added_by"])
     
     return RedirectResponse("/admin/approve-products", status_code=302)
 
 @app.post("/admin/products/{product_id}/reject")
-async def reject_product(request: Request, product_id: int):
-    user = get_current_user(request)
+async def reject_product(request: Request, product_id: int, db: AsyncDBConnection = Depends(get_db)):
+    user = await get_current_user(request, db)
     if not user or user["role"] != "admin":
         return RedirectResponse("/login", status_code=302)
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        UPDATE products 
-        SET status = 'rejected', approved_by = ?, last_updated = CURRENT_TIMESTAMP
-        WHERE id = ?
-    ''', (user["id"], product_id))
-    
-    conn.commit()
-    conn.close()
+    product = await db.write(set_product_status, product_id, "rejected", user["id"])
+    if product:
+        await notify_product_event(db, "rejected", product_id, product["added_by"])
     
     return RedirectResponse("/admin/approve-products", status_code=302)
 
 # ===== ADMIN: QUẢN LÝ NGƯỜI DÙNG =====
 @app.get("/admin/users", response_class=HTMLResponse)
-async def admin_users(request: Request):
-    user = get_current_user(request)
+async def admin_users(request: Request, db: AsyncDBConnection = Depends(get_db)):
+    user = await get_current_user(request, db)
     if not user or user["role"] != "admin":
         return RedirectResponse("/login", status_code=302)
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    etag, not_modified = await check_etag(request, db, ("users",), user)
+    if not_modified:
+        return not_modified
     
-    cursor.execute("SELECT * FROM users ORDER BY created_at DESC")
-    users = [dict(row) for row in cursor.fetchall()]
+    cursor = db.cursor()
     
-    conn.close()
+    await cursor.execute("SELECT * FROM users ORDER BY created_at DESC")
+    users = [dict(row) for row in await cursor.fetchall()]
     
     return templates.TemplateResponse(
         "admin_users.html",
@@ -876,9 +3631,19 @@ async def admin_users(request: Request):
             "title": "Quản lý người dùng",
             "user": user,
             "users": users
-        }
+        },
+        headers=etag_headers(etag)
     )
 
+def insert_user(cursor, values):
+    # values: (email, password đã băm, full_name, phone, address, role)
+    cursor.execute('''
+        INSERT INTO users (email, password, full_name, phone, address, role)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', values)
+    apply_stat_deltas(cursor, {("all", f"role:{values[5]}"): 1})
+    bump_data_versions(cursor, "users")
+
 @app.post("/admin/users/add")
 async def admin_add_user(
     request: Request,
@@ -887,35 +3652,37 @@ async def admin_add_user(
     full_name: str = Form(...),
     phone: Optional[str] = Form(None),
     address: Optional[str] = Form(None),
-    role: str = Form(...)
+    role: str = Form(...),
+    db: AsyncDBConnection = Depends(get_db)
 ):
-    user = get_current_user(request)
+    user = await get_current_user(request, db)
     if not user or user["role"] != "admin":
         return RedirectResponse("/login", status_code=302)
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
     try:
-        cursor.execute('''
-            INSERT INTO users (email, password, full_name, phone, address, role)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (email, hash_password(password), full_name, phone, address, role))
-        
-        conn.commit()
+        await db.write(insert_user, (email, hash_password(password), full_name, phone, address, role))
     except sqlite3.IntegrityError:
         return JSONResponse(
             status_code=400,
             content={"error": "Email đã tồn tại!"}
         )
-    finally:
-        conn.close()
     
     return RedirectResponse("/admin/users", status_code=302)
 
+def toggle_user_status(cursor, user_id):
+    cursor.execute("SELECT status FROM users WHERE id = ?", (user_id,))
+    current_status = cursor.fetchone()[0]
+    
+    new_status = "inactive" if current_status == "active" else "active"
+    
+    # Tăng session_epoch để các phiên đang mở của user bị thu hồi ngay
+    cursor.execute("UPDATE users SET status = ?, session_epoch = session_epoch + 1 WHERE id = ?", (new_status, user_id))
+    bump_data_versions(cursor, "users")
+    return new_status
+
 @app.get("/admin/users/{user_id}/toggle-status")
-async def admin_toggle_user_status(request: Request, user_id: int):
-    user = get_current_user(request)
+async def admin_toggle_user_status(request: Request, user_id: int, db: AsyncDBConnection = Depends(get_db)):
+    user = await get_current_user(request, db)
     if not user or user["role"] != "admin":
         return RedirectResponse("/login", status_code=302)
     
@@ -923,24 +3690,42 @@ async def admin_toggle_user_status(request: Request, user_id: int):
     if str(user["id"]) == str(user_id):
         return RedirectResponse("/admin/users?error=Không thể khóa tài khoản của chính mình", status_code=302)
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT status FROM users WHERE id = ?", (user_id,))
-    current_status = cursor.fetchone()[0]
+    await db.write(toggle_user_status, user_id)
     
-    new_status = "inactive" if current_status == "active" else "active"
+    return RedirectResponse("/admin/users", status_code=302)
+
+def remove_user(cursor, user_id):
+    cursor.execute("SELECT role FROM users WHERE id = ?", (user_id,))
+    deleted = cursor.fetchone()
     
-    cursor.execute("UPDATE users SET status = ? WHERE id = ?", (new_status, user_id))
+    # Cập nhật các bản ghi liên quan thành NULL trước khi xóa user để tránh lỗi và giữ lịch sử
+    cursor.execute("UPDATE products SET added_by = NULL WHERE added_by = ?", (user_id,))
+    cursor.execute("UPDATE products SET approved_by = NULL WHERE approved_by = ?", (user_id,))
+    cursor.execute("UPDATE transactions SET user_id = NULL WHERE user_id = ?", (user_id,))
+    # Rollup theo ngày: gộp các dòng của user vào khóa user_id = 0 (giao dịch không còn người thực
+    # hiện) giống như rebuild_transactions_daily tính lại từ bảng transactions
+    cursor.execute('''
+        INSERT INTO transactions_daily (day, product_id, category, user_id, tx_count, in_qty, out_qty)
+        SELECT day, product_id, category, 0, tx_count, in_qty, out_qty
+        FROM transactions_daily WHERE user_id = ?
+        ON CONFLICT (day, product_id, category, user_id) DO UPDATE SET
+            tx_count = transactions_daily.tx_count + excluded.tx_count,
+            in_qty = transactions_daily.in_qty + excluded.in_qty,
+            out_qty = transactions_daily.out_qty + excluded.out_qty
+    ''', (user_id,))
+    cursor.execute("DELETE FROM transactions_daily WHERE user_id = ?", (user_id,))
     
-    conn.commit()
-    conn.close()
+    cursor.execute("DELETE FROM users WHERE id = ?", (user_id,))
     
-    return RedirectResponse("/admin/users", status_code=302)
+    # Sản phẩm của user không còn người thêm: bỏ bộ đếm theo user, giữ nguyên bộ đếm toàn hệ thống
+    cursor.execute("DELETE FROM dashboard_stats WHERE scope = ?", (f"user:{user_id}",))
+    if deleted:
+        apply_stat_deltas(cursor, {("all", f"role:{deleted['role']}"): -1})
+    bump_data_versions(cursor, "users", "products", "transactions")
 
 @app.get("/admin/users/{user_id}/delete")
-async def admin_delete_user(request: Request, user_id: int):
-    user = get_current_user(request)
+async def admin_delete_user(request: Request, user_id: int, db: AsyncDBConnection = Depends(get_db)):
+    user = await get_current_user(request, db)
     if not user or user["role"] != "admin":
         return RedirectResponse("/login", status_code=302)
     
@@ -948,44 +3733,26 @@ async def admin_delete_user(request: Request, user_id: int):
     if str(user["id"]) == str(user_id):
         return RedirectResponse("/admin/users?error=Không thể xóa tài khoản của chính mình", status_code=302)
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Cập nhật các bản ghi liên quan thành NULL trước khi xóa user để tránh lỗi và giữ lịch sử
-    cursor.execute("UPDATE products SET added_by = NULL WHERE added_by = ?", (user_id,))
-    cursor.execute("UPDATE products SET approved_by = NULL WHERE approved_by = ?", (user_id,))
-    cursor.execute("UPDATE transactions SET user_id = NULL WHERE user_id = ?", (user_id,))
-    
-    cursor.execute("DELETE FROM users WHERE id = ?", (user_id,))
-    
-    conn.commit()
-    conn.close()
+    await db.write(remove_user, user_id)
     
     return RedirectResponse("/admin/users?success=Đã xóa tài khoản thành công", status_code=302)
 
 # ===== THÔNG TIN CÁ NHÂN =====
 @app.get("/profile", response_class=HTMLResponse)
-async def profile_page(request: Request):
-    user = get_current_user(request)
+async def profile_page(request: Request, db: AsyncDBConnection = Depends(get_db)):
+    user = await get_current_user(request, db)
     if not user:
         return RedirectResponse("/login", status_code=302)
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT COUNT(*) FROM users")
-    total_users = cursor.fetchone()[0]
-    
-    cursor.execute("SELECT COUNT(*) FROM users WHERE role = 'admin'")
-    admin_count = cursor.fetchone()[0]
-    
-    cursor.execute("SELECT COUNT(*) FROM users WHERE role = 'staff'")
-    staff_count = cursor.fetchone()[0]
-    
-    cursor.execute("SELECT COUNT(*) FROM products WHERE status = 'pending'")
-    pending_products = cursor.fetchone()[0]
-    
-    conn.close()
+    all_stats = (await db.run(read_dashboard_stats))["all"]
+    admin_count = int(all_stats.get("role:admin", 0))
+    staff_count = int(all_stats.get("role:staff", 0))
+    counts = {
+        "total_users": int(sum(v for k, v in all_stats.items() if k.startswith("role:"))),
+        "admin_count": admin_count,
+        "staff_count": staff_count,
+        "pending_products": int(all_stats.get("status:pending", 0)),
+    }
     
     return templates.TemplateResponse(
         "profile.html",
@@ -993,83 +3760,90 @@ async def profile_page(request: Request):
             "request": request,
             "title": "Thông tin cá nhân",
             "user": user,
-            "stats": {
-                "total_users": total_users,
-                "admin_count": admin_count,
-                "staff_count": staff_count,
-                "pending_products": pending_products
-            }
+            "stats": counts
         }
     )
 
-@app.post("/profile/update")
-async def update_profile(
-    request: Request,
-    full_name: str = Form(...),
-    phone: str = Form(...),
-    address: str = Form(...),
-    current_password: str = Form(None),
-    new_password: str = Form(None)
-):
-    user = get_current_user(request)
-    if not user:
-        return RedirectResponse("/login", status_code=302)
-    
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
+def update_user_profile(cursor, user_id, values, current_password, new_password):
+    # values: (full_name, phone, address). Trả về False (không ghi gì) nếu mật khẩu hiện tại sai,
+    # True nếu đã đổi mật khẩu (các phiên khác bị thu hồi), None nếu chỉ sửa thông tin
     # Cập nhật thông tin cơ bản
     cursor.execute('''
         UPDATE users 
         SET full_name = ?, phone = ?, address = ?
         WHERE id = ?
-    ''', (full_name, phone, address, user["id"]))
+    ''', values + (user_id,))
     
     # Cập nhật mật khẩu nếu có
     if new_password and current_password:
-        cursor.execute('SELECT password FROM users WHERE id = ?', (user["id"],))
+        cursor.execute('SELECT password FROM users WHERE id = ?', (user_id,))
         db_password = cursor.fetchone()[0]
         
-        if hash_password(current_password) == db_password:
-            cursor.execute('''
-                UPDATE users 
-                SET password = ?
-                WHERE id = ?
-            ''', (hash_password(new_password), user["id"]))
-        else:
-            conn.close()
-            return RedirectResponse("/profile?error=Mật khẩu hiện tại không đúng", status_code=302)
-    
-    conn.commit()
-    conn.close()
+        if hash_password(current_password) != db_password:
+            raise WriteRollback(False)
+        cursor.execute('''
+            UPDATE users 
+            SET password = ?, session_epoch = session_epoch + 1
+            WHERE id = ?
+        ''', (hash_password(new_password), user_id))
+        bump_data_versions(cursor, "users")
+        return True
     
-    return RedirectResponse("/profile?success=1", status_code=302)
+    bump_data_versions(cursor, "users")
+    return None
 
-# ===== BÁO CÁO =====
-@app.get("/reports", response_class=HTMLResponse)
-async def reports_page(request: Request):
-    user = get_current_user(request)
+@app.post("/profile/update")
+async def update_profile(
+    request: Request,
+    full_name: str = Form(...),
+    phone: str = Form(...),
+    address: str = Form(...),
+    current_password: str = Form(None),
+    new_password: str = Form(None),
+    db: AsyncDBConnection = Depends(get_db)
+):
+    user = await get_current_user(request, db)
     if not user:
         return RedirectResponse("/login", status_code=302)
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    report_type = request.query_params.get('type', 'daily')
+    password_changed = await db.write(update_user_profile, user["id"], (full_name, phone, address),
+                                      current_password, new_password)
+    if password_changed is False:
+        return RedirectResponse("/profile?error=Mật khẩu hiện tại không đúng", status_code=302)
     
+    response = RedirectResponse("/profile?success=1", status_code=302)
+    if password_changed:
+        # Đổi mật khẩu thu hồi các phiên khác theo epoch; cấp lại cookie cho phiên hiện tại
+        user["session_epoch"] += 1
+        set_session_cookie(response, user, max(user["session_expires"] - int(time.time()), 60))
+    return response
+
+# ===== BÁO CÁO =====
+def report_query(report_type, user, day_from=None, day_to=None, category=None):
+    # Trả về (sql, params) của từng loại báo cáo; dùng chung cho trang báo cáo và xuất file.
+    # Báo cáo theo ngày đọc từ transactions_daily; day_from/day_to (YYYY-MM-DD, tính cả hai đầu),
+    # mặc định 30 ngày gần nhất
     if report_type == 'daily':
-        cursor.execute('''
-            SELECT DATE(created_at) as date, 
-                   COUNT(*) as transactions,
-                   SUM(CASE WHEN type='in' THEN quantity ELSE 0 END) as stock_in,
-                   SUM(CASE WHEN type='out' THEN quantity ELSE 0 END) as stock_out
-            FROM transactions
-            WHERE DATE(created_at) >= DATE('now', '-30 days')
-            GROUP BY DATE(created_at)
-            ORDER BY date DESC
-        ''')
+        where = ["day >= ?"]
+        params = [day_from or (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')]
+        if day_to:
+            where.append("day <= ?")
+            params.append(day_to)
+        if category:
+            where.append("category = ?")
+            params.append(category)
+        return (f'''
+            SELECT day as date, 
+                   SUM(tx_count) as transactions,
+                   SUM(in_qty) as stock_in,
+                   SUM(out_qty) as stock_out
+            FROM transactions_daily
+            WHERE {" AND ".join(where)}
+            GROUP BY day
+            ORDER BY day DESC
+        ''', params)
     elif report_type == 'products':
-        cursor.execute('''
+        return ('''
             SELECT p.category, 
                    COUNT(*) as product_count,
                    SUM(p.stock) as total_stock,
@@ -1078,9 +3852,9 @@ async def reports_page(request: Request):
             WHERE p.status = 'approved'
             GROUP BY p.category
             ORDER BY total_value DESC
-        ''')
+        ''', ())
     elif report_type == 'suppliers':
-        cursor.execute('''
+        return ('''
             SELECT supplier, supplier_country,
                    COUNT(*) as product_count,
                    SUM(stock) as total_stock,
@@ -1089,9 +3863,9 @@ async def reports_page(request: Request):
             WHERE status = 'approved'
             GROUP BY supplier, supplier_country
             ORDER BY product_count DESC
-        ''')
+        ''', ())
     elif report_type == 'staff' and user["role"] == "admin":
-        cursor.execute('''
+        return ('''
             SELECT u.full_name, u.email,
                    COUNT(p.id) as product_count,
                    SUM(CASE WHEN p.status='approved' THEN 1 ELSE 0 END) as approved_count,
@@ -1101,18 +3875,37 @@ async def reports_page(request: Request):
             WHERE u.role = 'staff'
             GROUP BY u.id
             ORDER BY product_count DESC
-        ''')
+        ''', ())
     else:
-        cursor.execute('''
-            SELECT DATE(created_at) as date, 
-                   COUNT(*) as transactions
-            FROM transactions
-            GROUP BY DATE(created_at)
-            ORDER BY date DESC
+        return ('''
+            SELECT day as date, 
+                   SUM(tx_count) as transactions
+            FROM transactions_daily
+            GROUP BY day
+            ORDER BY day DESC
             LIMIT 10
-        ''')
+        ''', ())
+
+@app.get("/reports", response_class=HTMLResponse)
+async def reports_page(request: Request, db: AsyncDBConnection = Depends(get_db)):
+    user = await get_current_user(request, db)
+    if not user:
+        return RedirectResponse("/login", status_code=302)
+    
+    cursor = db.cursor()
+    
+    report_type = request.query_params.get('type', 'daily')
+    try:
+        day_from, day_to = parse_date_range(request)
+    except ValueError:
+        day_from = day_to = None
+    category = request.query_params.get('category', '')
+    await cursor.execute(*report_query(report_type, user, day_from, day_to, category))
+    
+    report_data = [dict(row) for row in await cursor.fetchall()]
     
-    report_data = [dict(row) for row in cursor.fetchall()]
+    await cursor.execute("SELECT DISTINCT category FROM products ORDER BY category")
+    categories = [row[0] for row in await cursor.fetchall()]
     
     # Tính tỷ lệ tăng trưởng (cho báo cáo ngày: so sánh nửa đầu vs nửa sau kỳ báo cáo)
     growth_rate = 0
@@ -1129,8 +3922,6 @@ async def reports_page(request: Request):
         elif recent_sum > 0:
             growth_rate = 100.0
     
-    conn.close()
-    
     return templates.TemplateResponse(
         "reports.html",
         {
@@ -1140,68 +3931,374 @@ async def reports_page(request: Request):
             "report_type": report_type,
             "report_data": report_data,
             "growth_rate": growth_rate,
+            "day_from": day_from or "",
+            "day_to": day_to or "",
+            "selected_category": category,
+            "categories": categories,
+            "export_query": urlencode({k: v for k, v in (("from", day_from), ("to", day_to), ("category", category)) if v}),
             "now": datetime.now
         }
     )
 
-# ===== API ENDPOINTS =====
-@app.get("/api/stats")
-async def get_stats():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT strftime('%Y-%m', created_at) as month,
-               SUM(CASE WHEN type='in' THEN quantity ELSE 0 END) as in_qty,
-               SUM(CASE WHEN type='out' THEN quantity ELSE 0 END) as out_qty
-        FROM transactions
-        WHERE created_at >= DATE('now', '-6 months')
-        GROUP BY strftime('%Y-%m', created_at)
-        ORDER BY month
-    ''')
+# ===== XUẤT FILE =====
+@app.get("/export/transactions.{fmt}")
+async def export_transactions(request: Request, fmt: str, db: AsyncDBConnection = Depends(get_db)):
+    user = await get_current_user(request, db)
+    if not user:
+        return RedirectResponse("/login", status_code=302)
+    if fmt not in EXPORT_FORMATS:
+        return JSONResponse(status_code=404, content={"error": "Định dạng không hỗ trợ"})
+    try:
+        day_from, day_to = parse_date_range(request)
+    except ValueError:
+        return JSONResponse(status_code=400, content={"error": "Ngày không hợp lệ (YYYY-MM-DD)"})
+    
+    where = []
+    params = []
+    if day_from:
+        where.append("t.created_at >= ?")
+        params.append(day_from)
+    if day_to:
+        where.append("t.created_at < ?")
+        params.append(day_range(day_to)[1])
+    category = request.query_params.get("category")
+    if category:
+        where.append("p.category = ?")
+        params.append(category)
+    if request.query_params.get("type") in ("in", "out"):
+        where.append("t.type = ?")
+        params.append(request.query_params["type"])
+    if user["role"] == "staff":
+        where.append("(p.status = 'approved' OR p.added_by = ?)")
+        params.append(user["id"])
+    
+    # Thứ tự (created_at, id) đi theo idx_transactions_created, không cần sắp xếp tạm
+    return export_response(f'''
+        SELECT t.id, t.created_at, t.type, t.quantity, p.sku, p.name AS product_name,
+               p.category, u.full_name AS user_name, t.notes
+        FROM transactions t
+        LEFT JOIN products p ON p.id = t.product_id
+        LEFT JOIN users u ON u.id = t.user_id
+        WHERE {" AND ".join(where) or "1=1"}
+        ORDER BY t.created_at, t.id
+    ''', params, "transactions", fmt)
+
+@app.get("/export/products.{fmt}")
+async def export_products(request: Request, fmt: str, db: AsyncDBConnection = Depends(get_db)):
+    user = await get_current_user(request, db)
+    if not user:
+        return RedirectResponse("/login", status_code=302)
+    if fmt not in EXPORT_FORMATS:
+        return JSONResponse(status_code=404, content={"error": "Định dạng không hỗ trợ"})
     
-    monthly_data = cursor.fetchall()
+    where = []
+    params = []
+    category = request.query_params.get("category")
+    if category:
+        where.append("p.category = ?")
+        params.append(category)
+    if request.query_params.get("status"):
+        where.append("p.status = ?")
+        params.append(request.query_params["status"])
+    if user["role"] == "staff":
+        where.append("(p.status = 'approved' OR p.added_by = ?)")
+        params.append(user["id"])
+    
+    return export_response(f'''
+        SELECT p.id, p.sku, p.name, p.category, p.stock, p.min_stock, p.price, p.supplier,
+               p.supplier_country, p.manufacturer, p.distributor, p.location, p.status,
+               p.description, p.image_url, p.last_updated
+        FROM products p
+        WHERE {" AND ".join(where) or "1=1"}
+        ORDER BY p.id
+    ''', params, "products", fmt)
+
+@app.get("/export/reports/{report_type}.{fmt}")
+async def export_report(request: Request, report_type: str, fmt: str, db: AsyncDBConnection = Depends(get_db)):
+    user = await get_current_user(request, db)
+    if not user:
+        return RedirectResponse("/login", status_code=302)
+    if fmt not in EXPORT_FORMATS:
+        return JSONResponse(status_code=404, content={"error": "Định dạng không hỗ trợ"})
+    try:
+        day_from, day_to = parse_date_range(request)
+    except ValueError:
+        return JSONResponse(status_code=400, content={"error": "Ngày không hợp lệ (YYYY-MM-DD)"})
     
-    conn.close()
+    sql, params = report_query(report_type, user, day_from, day_to, request.query_params.get("category"))
+    return export_response(sql, params, f"report_{report_type}", fmt)
+
+# ===== API ENDPOINTS =====
+@app.get("/api/stats")
+async def get_stats(request: Request, db: AsyncDBConnection = Depends(get_db)):
+    # Tương thích ngược: nhập/xuất theo tháng trong 6 tháng gần nhất
+    today = datetime.now()
+    etag, not_modified = await check_etag(request, db, ("transactions",), None, today.strftime('%Y-%m-%d'))
+    if not_modified:
+        return not_modified
+    
+    day_from = (today.replace(day=1) - timedelta(days=150)).replace(day=1).strftime('%Y-%m-%d')
+    data = await db.run(build_time_series, "month", day_from, today.strftime('%Y-%m-%d'))
+    
+    return JSONResponse(content={
+        "months": data["labels"],
+        "in_qty": data["in_qty"],
+        "out_qty": data["out_qty"]
+    }, headers=etag_headers(etag))
+
+@app.get("/api/stats/series")
+async def get_stats_series(request: Request, db: AsyncDBConnection = Depends(get_db)):
+    # ?bucket=hour|day|week|month&from=YYYY-MM-DD&to=YYYY-MM-DD&category=&product_id=&max_points=
+    user = await get_current_user(request, db)
+    if not user:
+        return JSONResponse(status_code=401, content={"error": "Vui lòng đăng nhập"})
     
-    return {
-        "months": [row[0] for row in monthly_data],
-        "in_qty": [row[1] or 0 for row in monthly_data],
-        "out_qty": [row[2] or 0 for row in monthly_data]
-    }
+    bucket = request.query_params.get("bucket", "day")
+    if bucket not in STATS_BUCKETS:
+        return JSONResponse(status_code=400, content={"error": f"bucket phải là một trong: {', '.join(STATS_BUCKETS)}"})
+    try:
+        day_from, day_to = parse_date_range(request)
+        product_id = int(request.query_params["product_id"]) if request.query_params.get("product_id") else None
+        max_points = int(request.query_params.get("max_points", STATS_DEFAULT_POINTS))
+    except ValueError:
+        return JSONResponse(status_code=400, content={"error": "Tham số không hợp lệ"})
+    
+    day_to = day_to or datetime.now().strftime('%Y-%m-%d')
+    day_from = day_from or (datetime.strptime(day_to, '%Y-%m-%d') - timedelta(days=STATS_DEFAULT_DAYS[bucket] - 1)).strftime('%Y-%m-%d')
+    if day_from > day_to:
+        return JSONResponse(status_code=400, content={"error": "Ngày bắt đầu phải trước ngày kết thúc"})
+    if bucket == "hour" and (datetime.strptime(day_to, '%Y-%m-%d') - datetime.strptime(day_from, '%Y-%m-%d')).days >= STATS_HOUR_MAX_DAYS:
+        return JSONResponse(status_code=400, content={"error": f"Thống kê theo giờ tối đa {STATS_HOUR_MAX_DAYS} ngày"})
+    
+    # Khoảng ngày mặc định phụ thuộc ngày hiện tại nên đưa vào ETag
+    etag, not_modified = await check_etag(request, db, ("transactions",), None, day_from, day_to)
+    if not_modified:
+        return not_modified
+    
+    data = await db.run(build_time_series, bucket, day_from, day_to,
+                        request.query_params.get("category") or None, product_id,
+                        max(1, min(max_points, STATS_MAX_POINTS)))
+    return JSONResponse(content=data, headers=etag_headers(etag))
 
 @app.get("/api/pending-count")
-async def get_pending_count(request: Request):
-    user = get_current_user(request)
+async def get_pending_count(request: Request, db: AsyncDBConnection = Depends(get_db)):
+    user = await get_current_user(request, db)
     if not user:
         return {"admin_pending": 0, "staff_pending": 0}
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    etag, not_modified = await check_etag(request, db, ("products",), user)
+    if not_modified:
+        return not_modified
     
-    cursor.execute("SELECT COUNT(*) FROM products WHERE status = 'pending'")
-    admin_pending = cursor.fetchone()[0]
+    stats = await db.run(read_dashboard_stats, None if user["role"] == "admin" else user["id"])
+    admin_pending = int(stats["all"].get("status:pending", 0))
     
     if user["role"] == "staff":
-        cursor.execute("SELECT COUNT(*) FROM products WHERE status = 'pending' AND added_by = ?", (user["id"],))
-        staff_pending = cursor.fetchone()[0]
+        staff_pending = int(stats[f"user:{user['id']}"].get("status:pending", 0))
     else:
         staff_pending = 0
     
-    conn.close()
-    
-    return {
+    return JSONResponse(content={
         "admin_pending": admin_pending,
         "staff_pending": staff_pending
-    }
+    }, headers=etag_headers(etag))
+
+@app.get("/api/events")
+async def get_events(request: Request):
+    # Kết nối DB chỉ dùng để xác thực rồi trả ngay, không giữ suốt thời gian stream
+    try:
+        async with db_session() as db:
+            user = await get_current_user(request, db)
+    except PoolTimeoutError:
+        return JSONResponse(status_code=503, content={"error": "Hệ thống đang bận"})
+    if not user:
+        return JSONResponse(status_code=401, content={"error": "Vui lòng đăng nhập"})
+    
+    subscription = event_broker.subscribe(user)
+    if subscription is None:
+        # Client sẽ chuyển sang hỏi định kỳ /api/pending-count
+        return JSONResponse(status_code=503, content={"error": "Quá nhiều kết nối"})
+    
+    return StreamingResponse(
+        event_stream(request, subscription),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.post("/api/stock-movements")
+async def post_stock_movements(request: Request, db: AsyncDBConnection = Depends(get_db)):
+    # Body: {"movements": [{"product_id"|"sku", "type": "in"|"out", "quantity", "notes"}], "atomic": false}
+    # Header Idempotency-Key (hoặc "idempotency_key" trong body) để gửi lại an toàn
+    user = await get_current_user(request, db)
+    if not user:
+        return JSONResponse(status_code=401, content={"error": "Vui lòng đăng nhập"})
+    
+    try:
+        payload = await request.json()
+    except ValueError:
+        return JSONResponse(status_code=400, content={"error": "Dữ liệu JSON không hợp lệ"})
+    if isinstance(payload, list):
+        payload = {"movements": payload}
+    movements = payload.get("movements") if isinstance(payload, dict) else None
+    if not isinstance(movements, list) or not movements:
+        return JSONResponse(status_code=400, content={"error": "Thiếu danh sách movements"})
+    if len(movements) > STOCK_MOVEMENT_MAX_LINES:
+        return JSONResponse(status_code=413, content={"error": f"Tối đa {STOCK_MOVEMENT_MAX_LINES} dòng mỗi lần gửi"})
+    
+    idem_key = request.headers.get("Idempotency-Key") or payload.get("idempotency_key")
+    if idem_key is not None and (not isinstance(idem_key, str) or not 0 < len(idem_key) <= 128):
+        return JSONResponse(status_code=400, content={"error": "Idempotency-Key không hợp lệ (tối đa 128 ký tự)"})
+    
+    try:
+        body, replayed, changes = await db.write(
+            write_stock_movements, user, idem_key, movements, bool(payload.get("atomic")))
+    except Exception as e:
+        print(f"Error applying stock movements: {e}")
+        return JSONResponse(status_code=500, content={"error": "Không thể cập nhật tồn kho, vui lòng thử lại"})
+    
+    notify_stock_event(changes)
+    headers = {"Idempotent-Replayed": "true"} if replayed else None
+    return JSONResponse(status_code=409 if body.get("rolled_back") else 200, content=body, headers=headers)
+
+@app.get("/api/pool-stats")
+async def get_pool_stats(request: Request, db: AsyncDBConnection = Depends(get_db)):
+    user = await get_current_user(request, db)
+    if not user or user["role"] != "admin":
+        return JSONResponse(status_code=403, content={"error": "Chỉ quản trị viên được xem"})
+    
+    return {**db_pool.metrics(), "statements": statement_registry.metrics(), "events": event_broker.metrics(),
+            "write_queue": write_queue.metrics() if write_queue is not None else {"enabled": False}}
+
+@app.get("/metrics")
+async def get_metrics(request: Request):
+    # Prometheus gửi "Authorization: Bearer <METRICS_TOKEN>": không mượn kết nối nào từ pool đang được đo.
+    # Chỉ khi xem bằng cookie đăng nhập mới cần đọc DB để kiểm tra quyền admin
+    authorization = request.headers.get("authorization", "")
+    if not (METRICS_TOKEN and hmac.compare_digest(authorization, f"Bearer {METRICS_TOKEN}")):
+        async with db_session() as db:
+            user = await get_current_user(request, db)
+        if not user or user["role"] != "admin":
+            return JSONResponse(status_code=403, content={"error": "Chỉ quản trị viên được xem"})
+    
+    return Response(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 @app.get("/logout")
 async def logout():
     response = RedirectResponse("/login", status_code=302)
-    response.delete_cookie("user_id")
+    response.delete_cookie(SESSION_COOKIE)
     return response
 
+def cli_backfill_daily(args):
+    # python main.py backfill-daily [từ-ngày] [đến-ngày]
+    prepare_database()
+    conn = get_db_connection()
+    try:
+        windows = backfill_transactions_daily(conn, *args[:2])
+    finally:
+        conn.close()
+    print(f"✅ Đã dựng lại transactions_daily ({windows} khoảng thời gian)")
+
+def cli_ingest_images(args):
+    # python main.py ingest-images: chuyển ảnh sản phẩm đang trỏ tới /static/... vào kho ảnh (có ảnh thu nhỏ/WebP)
+    prepare_database()
+    conn = get_db_connection()
+    converted = 0
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT DISTINCT image_url FROM products WHERE image_url LIKE '/static/%'")
+        for (url,) in cursor.fetchall():
+            source = os.path.normpath(url.lstrip("/"))
+            if not source.startswith("static" + os.sep) or not os.path.isfile(source):
+                print(f"⚠️ Bỏ qua {url}: không tìm thấy file")
+                continue
+            try:
+                new_url = ingest_local_image(source)
+            except ValueError as e:
+                print(f"⚠️ Bỏ qua {url}: {e}")
+                continue
+            cursor.execute("UPDATE products SET image_url = ? WHERE image_url = ?", (new_url, url))
+            converted += 1
+        if converted:
+            bump_data_versions(cursor, "products")
+        conn.commit()
+    finally:
+        conn.close()
+    print(f"✅ Đã chuyển {converted} ảnh sản phẩm vào {MEDIA_DIR}")
+
+def cli_build_assets(args):
+    # python main.py build-assets: chạy khi triển khai, trước khi khởi động ứng dụng
+    manifest, compressed = build_assets()
+    print(f"✅ Đã build {len(manifest)} file tĩnh vào {ASSETS_DIR} ({compressed} bản nén sẵn)")
+
+def cli_precompile_templates(args):
+    # python main.py precompile-templates: chạy khi triển khai (sau khi sửa template phải chạy lại)
+    count = precompile_templates()
+    print(f"✅ Đã biên dịch sẵn {count} template vào {TEMPLATES_COMPILED_DIR}")
+
+def cli_seed_snapshot(args):
+    # python main.py seed-snapshot <file>: dựng sẵn database (migration + dữ liệu mẫu) để dùng với SEED_DB_SNAPSHOT
+    global DB_PATH
+    if IS_POSTGRES:
+        print("❌ seed-snapshot chỉ dùng cho SQLite")
+        sys.exit(1)
+    if not args:
+        print("❌ Thiếu đường dẫn file: python main.py seed-snapshot <file>")
+        sys.exit(1)
+    if os.path.exists(args[0]):
+        print(f"❌ File đã tồn tại: {args[0]}")
+        sys.exit(1)
+    DB_PATH = args[0]
+    prepare_database()
+    # Dồn WAL vào file chính để chỉ cần chép một file
+    conn = get_db_connection()
+    try:
+        conn.cursor().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        conn.close()
+    print(f"✅ Đã tạo database dựng sẵn {DB_PATH} (phiên bản {LATEST_SCHEMA_VERSION})")
+
+def cli_verify_stats(args):
+    # python main.py verify-stats: kiểm tra bộ đếm dashboard có lệch so với tính lại từ dữ liệu gốc;
+    # thêm --fix để ghi lại bộ đếm đã tính
+    prepare_database()
+    conn = get_db_connection()
+    try:
+        drift = dashboard_stats_drift(conn.cursor())
+        if drift and "--fix" in args:
+            conn.commit()
+        else:
+            conn.rollback()
+    finally:
+        conn.close()
+    if not drift:
+        print("✅ Bộ đếm dashboard khớp với dữ liệu gốc")
+        return
+    for (scope, metric), (live, rebuilt) in sorted(drift.items()):
+        print(f"⚠️ {scope} / {metric}: đang lưu {live}, tính lại {rebuilt}")
+    if "--fix" in args:
+        print(f"✅ Đã tính lại {len(drift)} bộ đếm bị lệch")
+        return
+    print(f"❌ {len(drift)} bộ đếm bị lệch (chạy lại với --fix để sửa)")
+    sys.exit(1)
+
+CLI_COMMANDS = {
+    "backfill-daily": cli_backfill_daily,
+    "ingest-images": cli_ingest_images,
+    "build-assets": cli_build_assets,
+    "precompile-templates": cli_precompile_templates,
+    "seed-snapshot": cli_seed_snapshot,
+    "verify-stats": cli_verify_stats,
+}
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        command = CLI_COMMANDS.get(sys.argv[1])
+        if command is None:
+            print(f"❌ Lệnh không hợp lệ: {sys.argv[1]} (có: {', '.join(CLI_COMMANDS)})")
+            sys.exit(1)
+        command(sys.argv[2:])
+        sys.exit(0)
+    
     import uvicorn
     uvicorn.run(
         "main:app",